@@ -0,0 +1,181 @@
+"""
+Reproducible ingest benchmark.
+
+    python -m benchmarks.run_ingest -sizes 256x256,1024x1024 -files 3
+    python -m benchmarks.run_ingest -save_baseline          # record this machine's numbers
+    python -m benchmarks.run_ingest                         # compare against them
+
+Synthetic granules are generated into a temporary directory and loaded through the
+ingest path into each sink:
+    null      the ingest path with the null sink: extraction only, rows are counted and dropped
+    sqlite    a file-backed sqlite table, a stand-in for a real database
+    postgres  the real load (Db, COPY, checkpoints), when POSTGRES_* settings are available.
+              Use a scratch database: the synthetic files are loaded with -force.
+Each case runs in a fresh process so its peak RSS is its own.  Results are compared
+with the stored baseline, and the exit status is 1 when a case is slower than
+the baseline by more than the tolerance.
+"""
+import argparse
+import json
+import os
+import resource
+import sqlite3
+import sys
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+from time import perf_counter
+
+from benchmarks.synthetic import make_granules
+
+BASELINE = os.path.join(os.path.dirname(__file__), 'baseline.json')
+
+
+def postgres_args()->dict[str,str]|None:
+    """
+    Connection settings from the environment (or .env), or None when incomplete
+    """
+    from dotenv import load_dotenv
+    load_dotenv(".env")
+    args={"host":os.getenv("POSTGRES_HOST",""),
+          "port":os.getenv("POSTGRES_PORT",""),
+          "user":os.getenv("POSTGRES_USER",""),
+          "password":os.getenv("POSTGRES_PASSWORD",""),
+          "db":os.getenv("POSTGRES_DB","")}
+    return args if all(len(value) for value in args.values()) else None
+
+
+def ingest_null(file_name:str, args:dict, scratch:str)->int:
+    from methane.process_a_file import methane_specific
+    return methane_specific(file_name=file_name, args={**args, 'sink':'null'}, nodb=True)
+
+
+def ingest_sqlite(file_name:str, args:dict, scratch:str)->int:
+    from methane.process_a_file import add_file_record, group_tiles
+    from methane.extraction import iter_methane_batches, grid_subset
+    metadata = add_file_record(file_name=file_name, args=args, nodb=True)
+    connection = sqlite3.connect(os.path.join(scratch, 'benchmark.sqlite'))
+    connection.execute('CREATE TABLE IF NOT EXISTS methane_data (methane_data_file_id INTEGER, recorded_at TEXT, '
+                       'latitude REAL, longitude REAL, methane REAL)')
+    rows = 0
+    try:
+        for tile in group_tiles(iter_methane_batches(metadata.ds,
+                                                     batch_size=args['batch_size'],
+                                                     tile_size=args['tile_size'],
+                                                     subset=grid_subset())):
+            for batch in tile:
+                connection.executemany('INSERT INTO methane_data VALUES (?,?,?,?,?)',
+                                       ((file_id, recorded_at.isoformat(), latitude, longitude, methane)
+                                        for file_id, recorded_at, latitude, longitude, methane in batch.rows(1)))
+                rows += len(batch)
+            connection.commit()
+    finally:
+        connection.close()
+    return rows
+
+
+def ingest_postgres(file_name:str, args:dict, scratch:str)->int:
+    from methane.process_a_file import methane_specific
+    return methane_specific(file_name=file_name, args={**args, **postgres_args(), 'force':True})
+
+
+SINKS = {'null':ingest_null, 'sqlite':ingest_sqlite, 'postgres':ingest_postgres}
+
+
+def run_case(sink:str, file_names:list[str], args:dict, scratch:str)->dict:
+    """
+    Load every file into one sink; runs in its own process
+    """
+    latencies = []
+    rows = 0
+    for file_name in file_names:
+        start = perf_counter()
+        rows += SINKS[sink](file_name, args, scratch)
+        latencies.append(perf_counter() - start)
+    seconds = sum(latencies)
+    return {"rows":rows,
+            "seconds":seconds,
+            "rows_per_second":rows / seconds if seconds > 0 else 0.0,
+            "file_latency_seconds":{"min":min(latencies),
+                                    "mean":seconds / len(latencies),
+                                    "max":max(latencies)},
+            # ru_maxrss is in kilobytes on linux
+            "peak_rss_bytes":resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024}
+
+
+def parse_size(value:str)->tuple[int,int]:
+    try:
+        num_lats, num_lons = (int(part) for part in value.lower().split('x'))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"expected LATSxLONS, got {value}")
+    return num_lats, num_lons
+
+
+def process_args()->dict:
+    parser = argparse.ArgumentParser(description="cdfreader ingest benchmark")
+    parser.add_argument("-sizes", default="256x256,1024x1024", help="Comma separated grid sizes, LATSxLONS")
+    parser.add_argument("-files", default=3, type=int, help="Granules per size")
+    parser.add_argument("-chunk", default=128, type=int, help="HDF5 chunk edge of the synthetic variables")
+    parser.add_argument("-sinks", default="null,sqlite,postgres", help="Comma separated sinks to load into")
+    parser.add_argument("-batch_size", default=50000, type=int)
+    parser.add_argument("-tile_size", default=512, type=int)
+    parser.add_argument("-baseline", default=BASELINE, help="Baseline results to compare against")
+    parser.add_argument("-save_baseline", action="store_true", help="Store this run's results as the baseline")
+    parser.add_argument("-tolerance", default=0.15, type=float, help="Allowed fractional slowdown before a case counts as a regression")
+    parser.add_argument("-out", default="", help="Also write the results as JSON to this file")
+    return vars(parser.parse_args())
+
+
+def compare(results:dict, baseline:dict, tolerance:float)->list[str]:
+    regressions = []
+    for case, result in sorted(results.items()):
+        before = baseline.get(case, {}).get("rows_per_second")
+        if not before:
+            print(f'{case:28} {result["rows_per_second"]:14,.0f} rows/s   (no baseline)')
+            continue
+        change = result["rows_per_second"] / before - 1
+        flag = ''
+        if change < -tolerance:
+            flag = '  REGRESSION'
+            regressions.append(case)
+        print(f'{case:28} {result["rows_per_second"]:14,.0f} rows/s   {change:+7.1%} vs baseline{flag}')
+    return regressions
+
+
+def main()->int:
+    args = process_args()
+    sinks = [sink for sink in args["sinks"].split(",") if sink]
+    if "postgres" in sinks and postgres_args() is None:
+        print("no POSTGRES_* settings, skipping the postgres sink")
+        sinks.remove("postgres")
+    load_args = {"batch_size":args["batch_size"], "tile_size":args["tile_size"]}
+    results = {}
+    with tempfile.TemporaryDirectory(prefix="cdfreader-bench-") as scratch:
+        for size in args["sizes"].split(","):
+            num_lats, num_lons = parse_size(size)
+            file_names = make_granules(scratch, args["files"], num_lats, num_lons, args["chunk"])
+            for sink in sinks:
+                with ProcessPoolExecutor(max_workers=1, mp_context=get_context("spawn")) as executor:
+                    results[f'{sink}:{num_lats}x{num_lons}'] = executor.submit(run_case, sink, file_names, load_args, scratch).result()
+            for file_name in file_names:
+                os.remove(file_name)
+    for case, result in sorted(results.items()):
+        print(f'{case:28} rows={result["rows"]:,} mean latency={result["file_latency_seconds"]["mean"]:.3f}s '
+              f'peak rss={result["peak_rss_bytes"] / 2**20:,.1f} MiB')
+    if args["out"]:
+        with open(args["out"], "w") as out:
+            json.dump(results, out, indent=2)
+    if args["save_baseline"]:
+        with open(args["baseline"], "w") as baseline_file:
+            json.dump(results, baseline_file, indent=2)
+        print(f'baseline saved to {args["baseline"]}')
+        return 0
+    baseline = {}
+    if os.path.exists(args["baseline"]):
+        with open(args["baseline"]) as baseline_file:
+            baseline = json.load(baseline_file)
+    return 1 if compare(results, baseline, args["tolerance"]) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,99 @@
+"""
+Start-up cost of each command.
+
+    python -m benchmarks.startup -save_baseline     # record this machine's numbers
+    python -m benchmarks.startup                    # compare against them
+
+Each case imports, in a fresh interpreter, what its command imports before it
+touches a file or the database, and is timed over -repeat runs (the median is kept).
+A case fails when it is slower than the baseline by more than the tolerance, or
+when it imports a module it must not: the csv load never needs netCDF4, and
+metadata never needs the postgres driver.  The exit status is 1 on any failure.
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+BASELINE = os.path.join(os.path.dirname(__file__), 'startup_baseline.json')
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+HEAVY_MODULES = ('netCDF4', 'numpy', 'psycopg2', 'xmltodict', 'dotenv', 'pyarrow')
+
+# command -> (modules it imports, modules it must not import)
+CASES = {
+    'cli':        (['main'], list(HEAVY_MODULES)),
+    'ingest-csv': (['main', 'dotenv', 'methane.utilities', 'methane.runner', 'methane.by_year'], ['netCDF4', 'numpy', 'xmltodict']),
+    'metadata':   (['main', 'methane.utilities', 'netCDF4'], ['psycopg2', 'dotenv']),
+    'query':      (['main', 'dotenv', 'core.query'], ['netCDF4', 'xmltodict']),
+    'migrate':    (['main', 'dotenv', 'core.migrations'], ['netCDF4', 'numpy', 'xmltodict']),
+    'ingest-nc':  (['main', 'dotenv', 'netCDF4', 'methane.utilities', 'methane.runner', 'methane.process_a_file'], []),
+}
+
+PROBE = """
+import json, sys, time
+start = time.perf_counter()
+for module in {modules!r}:
+    __import__(module)
+seconds = time.perf_counter() - start
+print(json.dumps({{"seconds": seconds, "loaded": [m for m in {heavy!r} if m in sys.modules]}}))
+"""
+
+
+def measure(modules:list[str], repeat:int)->dict:
+    """
+    Median import time of modules over repeat fresh interpreters, and the heavy modules they pulled in
+    """
+    runs = []
+    for _ in range(repeat):
+        output = subprocess.run([sys.executable, '-c', PROBE.format(modules=modules, heavy=HEAVY_MODULES)],
+                                cwd=ROOT, capture_output=True, text=True, check=True).stdout
+        runs.append(json.loads(output))
+    return {"seconds":statistics.median(run["seconds"] for run in runs),
+            "loaded":runs[0]["loaded"]}
+
+
+def process_args()->dict:
+    parser = argparse.ArgumentParser(description="cdfreader start-up benchmark")
+    parser.add_argument("-repeat", default=5, type=int, help="Fresh interpreters per case")
+    parser.add_argument("-baseline", default=BASELINE, help="Baseline results to compare against")
+    parser.add_argument("-save_baseline", action="store_true", help="Store this run's results as the baseline")
+    parser.add_argument("-tolerance", default=0.25, type=float, help="Allowed fractional slowdown before a case counts as a regression")
+    return vars(parser.parse_args())
+
+
+def main()->int:
+    args = process_args()
+    results = {}
+    failures = []
+    for case, (modules, forbidden) in CASES.items():
+        results[case] = measure(modules, args["repeat"])
+        leaked = [module for module in forbidden if module in results[case]["loaded"]]
+        if leaked:
+            failures.append(case)
+            print(f'{case:12} imports {", ".join(leaked)}, which it must not')
+    if args["save_baseline"]:
+        with open(args["baseline"], "w") as baseline_file:
+            json.dump(results, baseline_file, indent=2)
+        print(f'baseline saved to {args["baseline"]}')
+    baseline = {}
+    if os.path.exists(args["baseline"]) and not args["save_baseline"]:
+        with open(args["baseline"]) as baseline_file:
+            baseline = json.load(baseline_file)
+    for case, result in results.items():
+        before = baseline.get(case, {}).get("seconds")
+        if not before:
+            print(f'{case:12} {result["seconds"]*1000:8.1f} ms   (no baseline)')
+            continue
+        change = result["seconds"] / before - 1
+        flag = ''
+        if change > args["tolerance"]:
+            flag = '  REGRESSION'
+            failures.append(case)
+        print(f'{case:12} {result["seconds"]*1000:8.1f} ms   {change:+7.1%} vs baseline{flag}')
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
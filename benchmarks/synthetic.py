@@ -0,0 +1,86 @@
+"""
+Synthetic TROPOMI-like granules for benchmarking the ingest path.
+
+The files have what methane_specific and storable_metadata_json read: 1-D lat and lon,
+(lat, lon) time and xch4 variables with fill values, and apriori_data / geolocation
+groups whose variables carry attributes.
+"""
+import os
+from datetime import datetime, timezone
+import numpy as np
+import  netCDF4 as nc
+
+FILL_VALUE = 9.96921e36
+
+
+def make_granule(file_name:str,
+                 num_lats:int=512,
+                 num_lons:int=512,
+                 chunk:int=128,
+                 fill_fraction:float=0.3,
+                 start:datetime=datetime(2024, 1, 1, tzinfo=timezone.utc),
+                 seed:int=0,
+                 with_xml:bool=True)->str:
+    """
+    Write one synthetic granule (and its xml sidecar) and return its path
+    :param file_name: .nc path to write
+    :param num_lats:
+    :param num_lons:
+    :param chunk: HDF5 chunk edge for the (lat, lon) variables
+    :param fill_fraction: share of cells with a fill value instead of an xch4 retrieval
+    :param start: time of the first cell; cells are a second apart
+    :param seed: random seed, so the same arguments always give the same file
+    :param with_xml: also write the .xml sidecar add_file_record looks for
+    """
+    rng = np.random.default_rng(seed)
+    with nc.Dataset(file_name, 'w', format='NETCDF4') as ds:
+        ds.createDimension('lat', num_lats)
+        ds.createDimension('lon', num_lons)
+        lat = ds.createVariable('lat', 'f4', ('lat',))
+        lat.units = 'degrees_north'
+        lat[:] = np.linspace(-89.5, 89.5, num_lats)
+        lon = ds.createVariable('lon', 'f4', ('lon',))
+        lon.units = 'degrees_east'
+        lon[:] = np.linspace(-179.5, 179.5, num_lons)
+        chunks = (min(chunk, num_lats), min(chunk, num_lons))
+        time = ds.createVariable('time', 'f8', ('lat', 'lon'), zlib=True, chunksizes=chunks, fill_value=FILL_VALUE)
+        time.units = 'seconds since 1970-01-01 00:00:00'
+        time.calendar = 'gregorian'
+        time[:, :] = start.timestamp() + np.arange(num_lats * num_lons, dtype='f8').reshape(num_lats, num_lons)
+        xch4 = ds.createVariable('xch4', 'f4', ('lat', 'lon'), zlib=True, chunksizes=chunks, fill_value=FILL_VALUE)
+        xch4.units = '1e-9'
+        xch4.long_name = 'column averaged dry air mole fraction of methane'
+        values = (1850 + 40 * rng.standard_normal((num_lats, num_lons))).astype('f4')
+        values[rng.random((num_lats, num_lons)) < fill_fraction] = FILL_VALUE
+        xch4[:, :] = values
+        for group_name, variable_names in (('apriori_data', ('methane_profile_apriori', 'surface_pressure')),
+                                           ('geolocation', ('solar_zenith_angle', 'viewing_zenith_angle'))):
+            group = ds.createGroup(group_name)
+            for variable_name in variable_names:
+                variable = group.createVariable(variable_name, 'f4', ('lat', 'lon'), zlib=True, chunksizes=chunks)
+                variable.units = '1'
+                variable.long_name = variable_name.replace('_', ' ')
+                variable.comment = 'synthetic'
+                variable[:, :] = rng.random((num_lats, num_lons)).astype('f4')
+    if with_xml:
+        with open(os.path.splitext(file_name)[0] + '.xml', 'w') as xml_file:
+            xml_file.write(f'<?xml version="1.0"?>\n<granule><product version="synthetic">'
+                           f'<grid lats="{num_lats}" lons="{num_lons}"/><orbit>{seed}</orbit></product></granule>\n')
+    return file_name
+
+
+def make_granules(directory:str,
+                  count:int,
+                  num_lats:int,
+                  num_lons:int,
+                  chunk:int=128)->list[str]:
+    """
+    Write count granules of one size into directory, one day apart
+    """
+    return [make_granule(os.path.join(directory, f'synthetic_{num_lats}x{num_lons}_{index:03d}.nc'),
+                         num_lats=num_lats,
+                         num_lons=num_lons,
+                         chunk=chunk,
+                         start=datetime(2024, 1, 1 + index % 28, tzinfo=timezone.utc),
+                         seed=index)
+            for index in range(count)]
@@ -1,11 +1,14 @@
 import sys
 from typing import Sequence
 import psycopg2
-from psycopg2.extras import NamedTupleCursor
+import psycopg2.pool
+from psycopg2.extras import NamedTupleCursor, execute_values
+from core.metrics import Metrics, timed
 
 class Database:
-    def __init__(self,args:dict[str,str]):
-        self.conn = self.connect(args)
+    def __init__(self,args:dict[str,str],pool:psycopg2.pool.AbstractConnectionPool=None):
+        self.pool = pool
+        self.conn = self.connect(args) if pool is None else pool.getconn()
 
     def connect(self,args:dict[str,str]):
         """
@@ -39,15 +42,25 @@ class Database:
     def execute(self, line: str, parms: Sequence):
         return self.cursor().execute( line, parms )
     def close(self):
-        if self.conn is not None:
+        """
+        Close the connection, or hand it back if it came from a pool
+        """
+        if self.conn is None:
+            return
+        if self.pool is None:
             self.conn.close()
+        elif not self.pool.closed:
+            self.pool.putconn(self.conn)
+        self.conn = None
 
 
 
 class Db:
-    def __init__(self,args:dict[str,str]):
-        self.db = Database(args)
+    def __init__(self,args:dict[str,str],pool:psycopg2.pool.AbstractConnectionPool=None,metrics:Metrics=None):
+        self.db = Database(args,pool=pool)
         self.cursor = None
+        # insert and commit time is added to metrics, when given
+        self.metrics = metrics
 
     def __enter__(self):
         return self
@@ -65,18 +78,50 @@ class Db:
                with_get_id: bool = False,
                parms: Sequence = None) -> None | int:
         id_to_ret = 0
-        with self.db.cursor() as curs:
+        with timed(self.metrics,'insert'), self.db.cursor() as curs:
             if parms is None:
                 curs.execute(insert_str)
             else:
                 curs.execute(insert_str, parms)
             if with_get_id:
                 id_to_ret = curs.fetchone()[0]
-        self.db.commit()
+        with timed(self.metrics,'commit'):
+            self.db.commit()
         if with_get_id:
             return id_to_ret
 
 
+    def copy_from(self, table: str,
+                  columns: Sequence[str],
+                  buffer,
+                  binary: bool = False) -> None:
+        """
+        Stream an in-memory buffer into table with COPY FROM STDIN.  Not committed.
+        :param table: target table
+        :param columns: column names, in the order they appear in the buffer
+        :param buffer: file-like object holding text (tab separated) or binary COPY data
+        :param binary: buffer is in postgres binary COPY format
+        """
+        copy_str = f'COPY {table} ({",".join(columns)}) FROM STDIN WITH (FORMAT {"binary" if binary else "text"})'
+        with timed(self.metrics,'insert'), self.db.cursor() as curs:
+            curs.copy_expert(copy_str, buffer)
+
+    def insert_values(self, insert_str: str,
+                      rows: Sequence[Sequence],
+                      page_size: int = 1000,
+                      fetch: bool = False) -> None | list:
+        """
+        Multi-row INSERT for callers that can't use COPY.  Not committed.
+        :param insert_str: INSERT statement with a single VALUES %s placeholder
+        :param rows: parameter tuples
+        :param page_size: rows per generated statement
+        :param fetch: return the rows produced by a RETURNING clause
+        """
+        with timed(self.metrics,'insert'), self.db.cursor() as curs:
+            returned = execute_values(curs, insert_str, rows, page_size=page_size, fetch=fetch)
+        if fetch:
+            return returned
+
     def get_cursor(self):
         return self.db.cursor()
 
@@ -86,12 +131,13 @@ class Db:
         id_to_ret = 0
         if self.cursor is None:
             self.cursor = self.get_cursor()
-        if parms is None:
-            self.cursor.execute(insert_str)
-        else:
-            self.cursor.execute(insert_str, parms)
-        if with_get_id:
-            id_to_ret = self.cursor.fetchone()[0]
+        with timed(self.metrics,'insert'):
+            if parms is None:
+                self.cursor.execute(insert_str)
+            else:
+                self.cursor.execute(insert_str, parms)
+            if with_get_id:
+                id_to_ret = self.cursor.fetchone()[0]
         if with_get_id:
             return id_to_ret
 
@@ -102,9 +148,64 @@ class Db:
 
     def commit(self)->None:
         self.close_cursor()
-        self.db.commit()
+        with timed(self.metrics,'commit'):
+            self.db.commit()
 
+    def rollback(self)->None:
+        self.close_cursor()
+        self.db.rollback()
 
-    def __exit__(self, exc_type, exc_val, exc_tb):
+
+    def close(self)->None:
+        self.close_cursor()
         self.db.close()
 
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+
+class DbPool:
+    """
+    One set of connections shared by a whole run.  Create it once, hand out Db
+    objects with db(), and close() it when the run is over.
+    """
+    def __init__(self,args:dict[str,str],size:int=4):
+        self.args = args
+        try:
+            self.pool = psycopg2.pool.ThreadedConnectionPool(
+                    1,
+                    max(size,1),
+                    host = args["host"],
+                    dbname = args["db"],
+                    user = args["user"],
+                    password = args["password"],
+                    port = args["port"],
+                    cursor_factory=NamedTupleCursor)
+        except psycopg2.OperationalError as e:
+            print(f"Could not connect to Database: {e}")
+            sys.exit(1)
+
+    def __enter__(self):
+        return self
+
+    def db(self,metrics:Metrics=None)->Db:
+        """
+        A Db on a pooled connection.  Closing it returns the connection to the pool
+        """
+        return Db(args=self.args,pool=self.pool,metrics=metrics)
+
+    def close(self)->None:
+        if not self.pool.closed:
+            self.pool.closeall()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+def get_db(args:dict[str,str],pool:DbPool|None=None,metrics:Metrics|None=None)->Db:
+    """
+    A Db from the run's pool when there is one, otherwise on its own connection
+    """
+    return Db(args=args,metrics=metrics) if pool is None else pool.db(metrics=metrics)
+
@@ -0,0 +1,83 @@
+import json
+import threading
+import tracemalloc
+from collections import defaultdict
+from contextlib import contextmanager, nullcontext
+from datetime import datetime, timezone
+from time import perf_counter
+
+
+class Metrics:
+    """
+    Seconds spent per stage and running counters for one file, safe to share between
+    the threads of a pipelined load
+    """
+    def __init__(self,name:str=''):
+        self.name = name
+        self.stages:dict[str,float] = defaultdict(float)
+        self.counters:dict[str,int] = defaultdict(int)
+        self.peak_memory_bytes = 0
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def stage(self,stage_name:str):
+        start = perf_counter()
+        try:
+            yield self
+        finally:
+            self.add_time(stage_name, perf_counter()-start)
+
+    def add_time(self,stage_name:str,seconds:float)->None:
+        with self.lock:
+            self.stages[stage_name] += seconds
+
+    def count(self,counter_name:str,amount:int=1)->None:
+        with self.lock:
+            self.counters[counter_name] += amount
+
+    def start_memory(self)->None:
+        """
+        Start measuring this file's peak traced memory, if tracemalloc is running
+        """
+        if tracemalloc.is_tracing():
+            tracemalloc.reset_peak()
+
+    def stop_memory(self)->None:
+        if tracemalloc.is_tracing():
+            self.peak_memory_bytes = max(self.peak_memory_bytes, tracemalloc.get_traced_memory()[1])
+
+    def to_dict(self)->dict:
+        with self.lock:
+            return {"stages":dict(self.stages),
+                    "counters":dict(self.counters),
+                    "peak_memory_bytes":self.peak_memory_bytes}
+
+
+def timed(metrics:Metrics|None,stage_name:str):
+    """
+    metrics.stage(stage_name), or nothing when there are no metrics to record into
+    """
+    return nullcontext() if metrics is None else metrics.stage(stage_name)
+
+
+def counted(metrics:Metrics|None,counter_name:str,amount:int=1)->None:
+    if metrics is not None:
+        metrics.count(counter_name, amount)
+
+
+def rate(records:int,seconds:float)->float:
+    """
+    records per second, without dividing by zero on sub-second runs
+    """
+    return records/seconds if seconds>0 else 0.0
+
+
+def write_report(path:str,file_reports:list[dict],run_report:dict)->None:
+    """
+    Append one NDJSON line per file and a closing line for the run to path
+    """
+    written_at = datetime.now(timezone.utc).isoformat()
+    with open(path,'a') as report:
+        for file_report in file_reports:
+            report.write(json.dumps({"type":"file","written_at":written_at,**file_report})+"\n")
+        report.write(json.dumps({"type":"run","written_at":written_at,**run_report})+"\n")
@@ -0,0 +1,64 @@
+import glob
+import re
+from os import path
+from core.database import Db
+
+MIGRATION_FILE = re.compile(r'^(\d+)\.ddl$')
+
+
+def migration_files(directory:str)->list[tuple[int,str]]:
+    """
+    The numbered .ddl files in directory (001.ddl, 002.ddl, ...) as (version, path), in order
+    """
+    files = []
+    for file_name in glob.glob(path.join(directory,'*.ddl')):
+        match = MIGRATION_FILE.match(path.basename(file_name))
+        if match:
+            files.append((int(match.group(1)),file_name))
+    return sorted(files)
+
+
+def applied_versions(db:Db)->set[int]:
+    """
+    Versions recorded in schema_migrations, which is created when missing
+    """
+    db.insert_continuous(insert_str='CREATE TABLE IF NOT EXISTS schema_migrations ('
+                                    'version INT PRIMARY KEY, '
+                                    'file_name VARCHAR(250) NOT NULL, '
+                                    'applied_at TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT CURRENT_TIMESTAMP)')
+    db.commit()
+    return {row.version for row in db.query('SELECT version FROM schema_migrations')}
+
+
+def migrate(db:Db,directory:str,verbose:bool=False)->list[int]:
+    """
+    Apply every migration in directory that schema_migrations doesn't list, in order.
+    Each file commits together with its schema_migrations row, so a migration that
+    fails leaves nothing behind and is tried again next time
+    :param db:
+    :param directory: holds the numbered .ddl files
+    :param verbose:
+    :return: the versions applied
+    """
+    # one migrating process at a time; the others wait here and then find nothing to do
+    db.query("SELECT pg_advisory_lock(hashtext('schema_migrations'))")
+    try:
+        applied = applied_versions(db)
+        done = []
+        for version,file_name in migration_files(directory):
+            if version in applied:
+                if verbose:
+                    print(f'migration {path.basename(file_name)} is already applied')
+                continue
+            with open(file_name) as ddl:
+                db.insert_continuous(insert_str=ddl.read())
+            db.insert_continuous(insert_str='INSERT INTO schema_migrations (version,file_name) values (%s,%s)',
+                                 parms=(version,path.basename(file_name),))
+            db.commit()
+            print(f'applied migration {path.basename(file_name)}')
+            done.append(version)
+    finally:
+        db.rollback()
+        db.query("SELECT pg_advisory_unlock(hashtext('schema_migrations'))")
+        db.commit()
+    return done
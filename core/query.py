@@ -0,0 +1,331 @@
+import json
+import math
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from datetime import datetime
+import numpy as np
+from core.database import Db, DbPool, get_db
+
+RAW_COLUMNS = ('recorded_at','latitude','longitude','methane')
+ROLLUP_COLUMNS = ('bucket_start','latitude','longitude','cell_count','methane_mean','methane_min','methane_max')
+COLUMN_TYPES = {'recorded_at':'datetime64[us]',
+                'bucket_start':'datetime64[us]',
+                'cell_count':'int64'}
+# tables shaped like methane_data that raw queries can read
+QUERY_TABLES = ('methane_data','methane_cell_data_located')
+DEFAULT_TILE_DEGREES = 5.0
+DEFAULT_CACHE_BYTES = 256 * 2**20
+# the JSONB methane_data_file columns find_files can match on (migration 006)
+CATALOG_COLUMNS = ('metadata','xmlmetadata')
+
+
+
+@dataclass
+class methane_result:
+    """
+    Query result as one numpy array per column: RAW_COLUMNS for raw rows,
+    ROLLUP_COLUMNS for rollup bins
+    """
+    columns: dict[str,np.ndarray] = field(default_factory=dict)
+
+    def __len__(self)->int:
+        return len(next(iter(self.columns.values()))) if len(self.columns) else 0
+
+    def __getitem__(self, column:str)->np.ndarray:
+        return self.columns[column]
+
+    @property
+    def nbytes(self)->int:
+        return sum(values.nbytes for values in self.columns.values())
+
+    def where(self, keep:np.ndarray)->'methane_result':
+        return methane_result({column:values[keep] for column,values in self.columns.items()})
+
+    @staticmethod
+    def from_rows(rows:list, column_names:tuple[str,...])->'methane_result':
+        values = list(zip(*rows)) if len(rows) else [()] * len(column_names)
+        return methane_result({column:np.array(column_values, dtype=COLUMN_TYPES.get(column,'float64'))
+                               for column,column_values in zip(column_names, values)})
+
+    @staticmethod
+    def concat(results:list['methane_result'], column_names:tuple[str,...])->'methane_result':
+        if len(results) == 0:
+            return methane_result.from_rows([], column_names)
+        return methane_result({column:np.concatenate([result.columns[column] for result in results])
+                               for column in column_names})
+
+    def to_dataframe(self):
+        try:
+            import pandas
+        except ImportError:
+            raise ValueError('to_dataframe needs pandas: pip install pandas')
+        return pandas.DataFrame(self.columns)
+
+
+
+class ResultCache:
+    """
+    LRU of query tiles that evicts the least recently used once the cached arrays
+    go over max_bytes.  Everything is dropped when the generation changes
+    """
+    def __init__(self, max_bytes:int=DEFAULT_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.entries:OrderedDict[tuple,methane_result] = OrderedDict()
+        self.bytes = 0
+        self.generation = None
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def validate(self, generation:tuple)->None:
+        with self.lock:
+            if generation != self.generation:
+                self.entries.clear()
+                self.bytes = 0
+                self.generation = generation
+
+    def get(self, key:tuple)->methane_result|None:
+        with self.lock:
+            result = self.entries.get(key)
+            if result is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return result
+
+    def put(self, key:tuple, result:methane_result)->None:
+        with self.lock:
+            if key in self.entries:
+                self.bytes -= self.entries.pop(key).nbytes
+            if result.nbytes > self.max_bytes:
+                return
+            self.entries[key] = result
+            self.bytes += result.nbytes
+            while self.bytes > self.max_bytes:
+                _, evicted = self.entries.popitem(last=False)
+                self.bytes -= evicted.nbytes
+
+
+
+class MethaneQuery:
+    """
+    Region and time queries over methane_data (or its compact view) and methane_rollup.
+    The globe is cut into tile_degrees square tiles; a query is answered from the
+    tiles its bounding box touches, and the tiles that aren't cached, and only those,
+    are fetched with one query and cached one by one, so overlapping queries share the work.
+    The cache is emptied whenever methane_data_file changes.
+    """
+    def __init__(self,
+                 args:dict[str,str],
+                 pool:DbPool|None=None,
+                 table:str='methane_data',
+                 tile_degrees:float=DEFAULT_TILE_DEGREES,
+                 cache_bytes:int=DEFAULT_CACHE_BYTES):
+        if table not in QUERY_TABLES:
+            raise ValueError(f'unknown table {table}, expected one of {", ".join(QUERY_TABLES)}')
+        self.args = args
+        self.pool = pool
+        self.table = table
+        self.tile_degrees = tile_degrees
+        self.cache = ResultCache(max_bytes=cache_bytes)
+
+    def generation(self, db:Db)->tuple:
+        """
+        Changes whenever a methane_data_file row is added, reloaded or completed
+        """
+        row = db.query('SELECT count(*) AS files, max(processed_at) AS processed, max(completed_at) AS completed '
+                       'FROM methane_data_file')[0]
+        return row.files, row.processed, row.completed
+
+    def tile_range(self, low:float, high:float)->range:
+        return range(math.floor(low / self.tile_degrees), math.floor(high / self.tile_degrees) + 1)
+
+    def get_methane(self,
+                    bbox:tuple[float,float,float,float],
+                    start:datetime|None=None,
+                    end:datetime|None=None,
+                    resolution:float=0,
+                    time_bucket:str='day')->methane_result:
+        """
+        Methane inside bbox recorded in [start, end)
+        :param bbox: (min_lon, min_lat, max_lon, max_lat), inclusive
+        :param start: naive UTC, None for unbounded
+        :param end: naive UTC, None for unbounded
+        :param resolution: 0 for the raw rows, otherwise the methane_rollup bins of this many degrees
+        :param time_bucket: the rollup time bucket, with a resolution
+        :return: RAW_COLUMNS, or ROLLUP_COLUMNS for rollup bins (whose centre is inside bbox)
+        """
+        min_lon, min_lat, max_lon, max_lat = bbox
+        column_names = ROLLUP_COLUMNS if resolution else RAW_COLUMNS
+        source = ('methane_rollup', resolution, time_bucket) if resolution else (self.table,)
+        tiles = [(lat_tile, lon_tile) for lat_tile in self.tile_range(min_lat, max_lat)
+                                      for lon_tile in self.tile_range(min_lon, max_lon)]
+        with get_db(self.args, self.pool) as db:
+            self.cache.validate(self.generation(db))
+            found = {}
+            for tile in tiles:
+                result = self.cache.get(source + (start, end) + tile)
+                if result is not None:
+                    found[tile] = result
+            missing = [tile for tile in tiles if tile not in found]
+            if len(missing):
+                found.update(self.fetch_tiles(db, missing, start, end, resolution, time_bucket, source))
+        result = methane_result.concat([found[tile] for tile in tiles], column_names)
+        return result.where((result['latitude'] >= min_lat) & (result['latitude'] <= max_lat) &
+                            (result['longitude'] >= min_lon) & (result['longitude'] <= max_lon))
+
+    def fetch_tiles(self,
+                    db:Db,
+                    missing:list[tuple[int,int]],
+                    start:datetime|None,
+                    end:datetime|None,
+                    resolution:float,
+                    time_bucket:str,
+                    source:tuple)->dict[tuple[int,int],methane_result]:
+        """
+        Read the missing tiles, and only those, in one query of a part per rectangle of
+        tile_rectangles, then split and cache them by tile
+        """
+        column_names = ROLLUP_COLUMNS if resolution else RAW_COLUMNS
+        rectangles = tile_rectangles(missing)
+        parts = [self.rectangle_query(lat_tiles, lon_tiles, start, end, resolution, time_bucket)
+                 for lat_tiles, lon_tiles in rectangles]
+        query_str = ' UNION ALL '.join(f'SELECT {",".join(column_names)},{part} AS part FROM ({part_str}) AS part_{part}'
+                                       for part, (part_str, _) in enumerate(parts))
+        fetched = methane_result.from_rows(db.query(query_str, [parm for _, part_parms in parts for parm in part_parms]),
+                                           column_names + ('part',))
+        part_keys = fetched.columns.pop('part').astype('int64')
+        tiles = {}
+        for part, (lat_tiles, lon_tiles) in enumerate(rectangles):
+            tiles.update(self.split_tiles(fetched.where(part_keys == part), lat_tiles, lon_tiles, start, end, source))
+        return tiles
+
+    def rectangle_query(self,
+                        lat_tiles:range,
+                        lon_tiles:range,
+                        start:datetime|None,
+                        end:datetime|None,
+                        resolution:float,
+                        time_bucket:str)->tuple[str,list]:
+        """
+        The query, and its parameters, for the rows of a rectangle of tiles
+        """
+        low_lat, high_lat = lat_tiles.start * self.tile_degrees, lat_tiles.stop * self.tile_degrees
+        low_lon, high_lon = lon_tiles.start * self.tile_degrees, lon_tiles.stop * self.tile_degrees
+        time_column = 'bucket_start' if resolution else 'recorded_at'
+        conditions = ['latitude >= %s', 'latitude < %s', 'longitude >= %s', 'longitude < %s']
+        parms = [low_lat, high_lat, low_lon, high_lon]
+        if start is not None:
+            conditions.append(f'{time_column} >= %s')
+            parms.append(start)
+        if end is not None:
+            conditions.append(f'{time_column} < %s')
+            parms.append(end)
+        if resolution:
+            conditions = ['resolution = %s', 'time_bucket = %s'] + conditions
+            parms = [resolution, time_bucket] + parms
+            return f'SELECT {",".join(ROLLUP_COLUMNS)} FROM methane_rollup WHERE {" AND ".join(conditions)}', parms
+        # the box lets the GiST index on point(longitude, latitude) find the rows
+        conditions = ['point(longitude, latitude) <@ box(point(%s, %s), point(%s, %s))'] + conditions
+        parms = [low_lon, low_lat, high_lon, high_lat] + parms
+        return f'SELECT {",".join(RAW_COLUMNS)} FROM {self.table} WHERE {" AND ".join(conditions)}', parms
+
+    def split_tiles(self,
+                    fetched:methane_result,
+                    lat_tiles:range,
+                    lon_tiles:range,
+                    start:datetime|None,
+                    end:datetime|None,
+                    source:tuple)->dict[tuple[int,int],methane_result]:
+        """
+        Split the rows of a rectangle of tiles by tile, caching each
+        """
+        lat_keys = np.clip(np.floor(fetched['latitude'] / self.tile_degrees), lat_tiles.start, lat_tiles.stop - 1).astype('int64')
+        lon_keys = np.clip(np.floor(fetched['longitude'] / self.tile_degrees), lon_tiles.start, lon_tiles.stop - 1).astype('int64')
+        tile_keys = (lat_keys - lat_tiles.start) * len(lon_tiles) + (lon_keys - lon_tiles.start)
+        order = np.argsort(tile_keys, kind='stable')
+        bounds = np.searchsorted(tile_keys[order], np.arange(len(lat_tiles) * len(lon_tiles) + 1))
+        tiles = {}
+        for lat_offset, lat_tile in enumerate(lat_tiles):
+            for lon_offset, lon_tile in enumerate(lon_tiles):
+                key = lat_offset * len(lon_tiles) + lon_offset
+                tile = fetched.where(order[bounds[key]:bounds[key + 1]])
+                self.cache.put(source + (start, end, lat_tile, lon_tile), tile)
+                tiles[(lat_tile, lon_tile)] = tile
+        return tiles
+
+
+
+def tile_rectangles(tiles:list[tuple[int,int]])->list[tuple[range,range]]:
+    """
+    Cover exactly the given (lat tile, lon tile) keys with (lat range, lon range)
+    rectangles: each row's runs of adjacent lon tiles, merged with the same run on
+    the rows next to it.  Cached tiles between missing ones are never read again
+    """
+    rows:dict[int,list[int]] = {}
+    for lat_tile, lon_tile in sorted(set(tiles)):
+        rows.setdefault(lat_tile, []).append(lon_tile)
+    rectangles = []
+    # lon run -> (first lat tile, last lat tile) of the rectangle still growing downwards
+    growing:dict[range,tuple[int,int]] = {}
+    for lat_tile, lon_tiles in sorted(rows.items()):
+        runs = []
+        for lon_tile in lon_tiles:
+            if len(runs) and runs[-1].stop == lon_tile:
+                runs[-1] = range(runs[-1].start, lon_tile + 1)
+            else:
+                runs.append(range(lon_tile, lon_tile + 1))
+        for run, (first, last) in list(growing.items()):
+            if run not in runs or last != lat_tile - 1:
+                rectangles.append((range(first, last + 1), run))
+                del growing[run]
+        for run in runs:
+            growing[run] = (growing[run][0] if run in growing else lat_tile, lat_tile)
+    rectangles.extend((range(first, last + 1), run) for run, (first, last) in growing.items())
+    return rectangles
+
+
+
+# one MethaneQuery, and so one cache, per database and table in a process
+_queries:dict[tuple,MethaneQuery] = {}
+_queries_lock = threading.Lock()
+
+def get_methane(bbox:tuple[float,float,float,float],
+                start:datetime|None=None,
+                end:datetime|None=None,
+                resolution:float=0,
+                args:dict[str,str]|None=None,
+                pool:DbPool|None=None,
+                time_bucket:str='day',
+                table:str='methane_data')->methane_result:
+    """
+    MethaneQuery.get_methane through a cache shared by every call in the process
+    :param args: connection settings (host, port, user, password, db)
+    """
+    args = pool.args if args is None and pool is not None else args
+    key = (args.get('host'), args.get('port'), args.get('db'), args.get('user'), table)
+    with _queries_lock:
+        if key not in _queries:
+            _queries[key] = MethaneQuery(args=args, pool=pool, table=table)
+        query = _queries[key]
+    return query.get_methane(bbox=bbox, start=start, end=end, resolution=resolution, time_bucket=time_bucket)
+
+
+
+def find_files(containing:dict,
+               args:dict[str,str]|None=None,
+               pool:DbPool|None=None,
+               column:str='xmlmetadata')->list:
+    """
+    The methane_data_file rows whose column contains the given document, e.g.
+    {"granule": {"product": {"@version": "X"}}}, found through the column's GIN index
+    :return: (methane_data_file_id, file_name, processed_at, completed_at) rows
+    """
+    if column not in CATALOG_COLUMNS:
+        raise ValueError(f'unknown column {column}, expected one of {", ".join(CATALOG_COLUMNS)}')
+    with get_db(args, pool) as db:
+        return db.query('SELECT methane_data_file_id,file_name,processed_at,completed_at FROM methane_data_file '
+                        f'WHERE {column} @> %s::jsonb ORDER BY file_name',
+                        (json.dumps(containing),))
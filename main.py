@@ -1,32 +1,182 @@
 import os
-import glob
+import importlib.util
+import csv
 import argparse
 import sys
-from dotenv import load_dotenv
-from methane.utilities import get_files,get_file_dataset,display_dataset_metadata
-from methane.process_a_file import process
-import  netCDF4 as nc
+from datetime import datetime, timezone
 
-def process_args()->dict[str,str]:
-    parser = argparse.ArgumentParser(description="cdfreader utility")
+# Every subsystem (netCDF4, psycopg2, numpy, dotenv, ...) is imported by the command that
+# uses it, so a csv load never starts netCDF and metadata never loads the postgres driver.
+# See benchmarks/startup.py.
 
-    # 2. Add arguments
-    parser.add_argument("-file","-f", required=True, help="Absolute path for file to read.  Use wildcards for multiple files")
-    parser.add_argument("-metadata", "-m",action="store_true",help="Read file metadata only")
-    parser.add_argument("-dryrun", "-d", action="store_true", help="Don't save to db")
-    parser.add_argument("-commit_batching", "-b", required=False, default=0,type=int, help="Number of inserts before committing")
-    parser.add_argument("-maxrecords", "-max", required=False, default=0, help="Maximum records to load")
-    parser.add_argument("-csv", "-c", action="store_true", help="Read counties by year")
-    parser.add_argument("-verbose", "-v", action="store_true", help="Increase output verbosity")
+MIGRATIONS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),"methane","migrations")
+COMMANDS = ("ingest-nc","ingest-csv","metadata","query","migrate","watch")
+
+def parse_bbox(value:str)->tuple[float,float,float,float]:
+    try:
+        min_lon, min_lat, max_lon, max_lat = (float(part) for part in value.split(","))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"expected MIN_LON,MIN_LAT,MAX_LON,MAX_LAT, got {value}")
+    if min_lon > max_lon or min_lat > max_lat:
+        raise argparse.ArgumentTypeError(f"bounding box {value} has a minimum above its maximum")
+    return min_lon, min_lat, max_lon, max_lat
+
+def parse_utc(value:str)->datetime:
+    try:
+        when = datetime.fromisoformat(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"expected an ISO date or datetime, got {value}")
+    # recorded_at is stored as naive UTC
+    return when if when.tzinfo is None else when.astimezone(timezone.utc).replace(tzinfo=None)
+
+def add_db_arguments(parser:argparse.ArgumentParser)->None:
+    """
+    postgres connection settings; anything left empty comes from POSTGRES_* (see check_for_env)
+    """
     parser.add_argument("-host", help="postgres host", required=False,  default="localhost")
     parser.add_argument("-port", help="postgres port", required=False, default="5432")
     parser.add_argument("-user", help="postgres port", required=False,default="")
     parser.add_argument("-password", help="postgres port", required=False,default="")
     parser.add_argument("-db", help="postgres port", required=False,default="")
-    return vars(parser.parse_args())
+    parser.add_argument("-pool_size", help="maximum pooled postgres connections (env POSTGRES_POOL_SIZE)", required=False,default="")
+
+def add_run_arguments(parser:argparse.ArgumentParser)->None:
+    """
+    How a set of files is run
+    """
+    parser.add_argument("-workers", "-w", required=False, default=0, type=int, help="Number of worker processes to spread the files over")
+    parser.add_argument("-metrics_out", "-metrics-out", required=False, default="", help="Append per-file and per-run timings, counters and peak memory to this NDJSON file")
+    parser.add_argument("-verbose", "-v", action="store_true", help="Increase output verbosity")
+
+def add_extract_arguments(parser:argparse.ArgumentParser)->None:
+    """
+    Reading granules and writing what they hold
+    """
+    parser.add_argument("-dryrun", "-d", action="store_true", help="Don't save to db.  Extracted rows go to the -sink, null unless given")
+    parser.add_argument("-sink", required=False, default="", choices=["postgres","null","ndjson","csv","preview","parquet","arrow"], help="Where extracted rows go: postgres (default), null (count only), ndjson or csv staging files, a stdout preview, or date-partitioned parquet / arrow files")
+    parser.add_argument("-sink_out", required=False, default=".", help="Directory for ndjson/csv/parquet/arrow output")
+    parser.add_argument("-preview_rows", required=False, default=10, type=int, help="Rows per file shown by the preview sink")
+    parser.add_argument("-commit_batching", "-b", required=False, default=0,type=int, help="No longer used: rows are committed once per tile, see -tile_size")
+    parser.add_argument("-batch_size", required=False, default=50000, type=int, help="Number of cells extracted and written per batch")
+    parser.add_argument("-tile_size", required=False, default=512, type=int, help="Edge length, in cells, of the lat/lon tiles read from each file.  Bounds memory use")
+    parser.add_argument("-bbox", required=False, default=None, type=parse_bbox, help="Only load cells inside MIN_LON,MIN_LAT,MAX_LON,MAX_LAT")
+    parser.add_argument("-since", required=False, default=None, type=parse_utc, help="Only load cells recorded at or after this UTC date/time")
+    parser.add_argument("-until", required=False, default=None, type=parse_utc, help="Only load cells recorded before this UTC date/time")
+    parser.add_argument("-writer", required=False, default="copy", choices=["copy","values","insert"], help="How methane rows are written: COPY FROM STDIN, multi-row INSERT, or one INSERT per row")
+    parser.add_argument("-copy_format", required=False, default="text", choices=["text","binary"], help="COPY format used by the copy writer")
+    parser.add_argument("-maxrecords", "-max", required=False, default=0, help="Stop each file once this many records are loaded, at the end of the tile the limit falls in.  The file is left incomplete, to be resumed")
+    parser.add_argument("-storage", required=False, default="wide", choices=["wide","cell"], help="wide: methane_data rows with their coordinates.  cell: compact methane_cell_data rows keyed by grid_cell id (migration 004)")
+    parser.add_argument("-variables", required=False, default="", help="JSON map of the netCDF variables to load and the tables and columns they go to (default methane/variables.json: xch4 alone)")
+    parser.add_argument("-rollup", required=False, default=0, type=float, help="Also roll methane up into methane_rollup bins of this many degrees as files load (migration 005).  0 for none")
+    parser.add_argument("-rollup_bucket", required=False, default="day", choices=["hour","day","month"], help="Time bucket of the -rollup bins")
+    parser.add_argument("-defer_indexes", action="store_true", help="Bulk load: months that have no methane_data partition yet are loaded into bare tables, then indexed and attached when the run ends.  Tables a run leaves behind when it dies are attached by the next run (migration 009)")
+    parser.add_argument("-force", action="store_true", help="Reload files that are already in the database, replacing their rows")
+    parser.add_argument("-replace", action="store_true", help="Reload reissued files that are already in the database into an unlogged staging table, then swap their rows in one transaction, so readers never see a half-replaced file")
+    parser.add_argument("-pipeline", action="store_true", help="Overlap netCDF reads and database writes within each file")
+    parser.add_argument("-queue_depth", required=False, default=4, type=int, help="With -pipeline, batches that may wait between the reader and the writers")
+    parser.add_argument("-writers", required=False, default=1, type=int, help="With -pipeline, number of writer threads")
+
+def add_watch_arguments(parser:argparse.ArgumentParser)->None:
+    """
+    Tuning for -watch / the watch command
+    """
+    parser.add_argument("-poll_seconds", required=False, default=2.0, type=float, help="With -watch, seconds between looks at the directory")
+    parser.add_argument("-settle_seconds", required=False, default=5.0, type=float, help="With -watch, seconds a granule and its sidecar must go unchanged before it is loaded")
+    parser.add_argument("-xml_wait_seconds", required=False, default=30.0, type=float, help="With -watch, seconds to wait for a granule's xml sidecar before loading it without one")
+    parser.add_argument("-retry_seconds", required=False, default=30.0, type=float, help="With -watch, seconds before a granule that failed is tried again; doubled after each further failure, up to an hour")
+    parser.add_argument("-max_attempts", required=False, default=0, type=int, help="With -watch, give up on a granule after this many failed loads, until it changes.  0 to keep retrying")
+    parser.add_argument("-watch_state", required=False, default="", help="With -watch, the json file recording the granules already handled.  Default DIR/.cdfreader-state.json")
+
+def add_query_arguments(parser:argparse.ArgumentParser)->None:
+    parser.add_argument("-bbox", dest="query", metavar="MIN_LON,MIN_LAT,MAX_LON,MAX_LAT", required=True, type=parse_bbox, help="Region to read")
+    parser.add_argument("-since", required=False, default=None, type=parse_utc, help="Only cells recorded at or after this UTC date/time")
+    parser.add_argument("-until", required=False, default=None, type=parse_utc, help="Only cells recorded before this UTC date/time")
+    parser.add_argument("-resolution", required=False, default=0, type=float, help="Read the -rollup_bucket rollup bins of this many degrees instead of the raw rows")
+    parser.add_argument("-rollup_bucket", required=False, default="day", choices=["hour","day","month"], help="Time bucket of the -resolution bins")
+    parser.add_argument("-storage", required=False, default="wide", choices=["wide","cell"], help="Read methane_data (wide) or the compact methane_cell_data (cell)")
+    parser.add_argument("-query_out", required=False, default="", help="Write the result to this csv file instead of printing it")
+    parser.add_argument("-preview_rows", required=False, default=10, type=int, help="Rows printed without -query_out")
+
+def command_parser()->argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description="cdfreader utility",
+                                     epilog="The single-dash options of earlier versions (-f, -csv, -m, -query, -watch, -migrate ...) still work without a command")
+    commands = parser.add_subparsers(dest="command", required=True)
+    ingest_nc = commands.add_parser("ingest-nc", help="Load netCDF methane granules")
+    ingest_nc.add_argument("-file","-f", required=True, help="Path of the granules to load.  Use wildcards for multiple files")
+    ingest_nc.add_argument("-metadata", "-m",action="store_true",help="Also print the first granule's metadata")
+    ingest_nc.add_argument("-migrate", action="store_true", help="Apply pending schema migrations first")
+    add_extract_arguments(ingest_nc)
+    add_run_arguments(ingest_nc)
+    add_db_arguments(ingest_nc)
+    ingest_csv = commands.add_parser("ingest-csv", help="Load countries-by-year csv files")
+    ingest_csv.add_argument("-file","-f", required=True, help="Path of the csv files to load: plain, .gz, .bz2, or zip archive members (data/x.zip for its csv files, data/*.zip/*.csv).  Use wildcards for multiple files")
+    ingest_csv.add_argument("-csv_by_line", action="store_true", help="Load one line per transaction instead of the whole file at once")
+    ingest_csv.add_argument("-migrate", action="store_true", help="Apply pending schema migrations first")
+    add_run_arguments(ingest_csv)
+    add_db_arguments(ingest_csv)
+    ingest_csv.set_defaults(csv=True)
+    metadata = commands.add_parser("metadata", help="Print a granule's metadata; needs no database")
+    metadata.add_argument("-file","-f", required=True, help="Path of the granule.  With wildcards, the first match")
+    metadata.set_defaults(metadata=True)
+    query = commands.add_parser("query", help="Read methane for a region and time window")
+    add_query_arguments(query)
+    add_db_arguments(query)
+    migrate = commands.add_parser("migrate", help="Apply the schema migrations the database doesn't have yet")
+    migrate.add_argument("-verbose", "-v", action="store_true", help="Also list the migrations already applied")
+    add_db_arguments(migrate)
+    migrate.set_defaults(migrate=True)
+    watch = commands.add_parser("watch", help="Keep running and load the granules that arrive in a directory")
+    watch.add_argument("watch", metavar="DIR", help="Directory to watch for .nc granules and their .xml sidecars")
+    watch.add_argument("-migrate", action="store_true", help="Apply pending schema migrations first")
+    add_watch_arguments(watch)
+    add_extract_arguments(watch)
+    add_run_arguments(watch)
+    add_db_arguments(watch)
+    return parser
+
+def legacy_parser()->argparse.ArgumentParser:
+    """
+    The options-only command line of earlier versions
+    """
+    parser = argparse.ArgumentParser(description="cdfreader utility.  Run with a command (ingest-nc, ingest-csv, metadata, query, migrate, watch) for its own options")
+    parser.add_argument("-file","-f", required=False, default="", help="Absolute path for file to read.  Use wildcards for multiple files.  Required unless -watch, -migrate or -query is given")
+    parser.add_argument("-migrate", action="store_true", help="Apply the schema migrations in methane/migrations that the database doesn't have yet, before loading anything")
+    parser.add_argument("-query", required=False, default=None, type=parse_bbox, help="Print (or write to -query_out) the methane inside MIN_LON,MIN_LAT,MAX_LON,MAX_LAT between -since and -until, instead of loading files")
+    parser.add_argument("-resolution", required=False, default=0, type=float, help="With -query, read the -rollup_bucket rollup bins of this many degrees instead of the raw rows")
+    parser.add_argument("-query_out", required=False, default="", help="With -query, write the result to this csv file")
+    parser.add_argument("-watch", required=False, default="", help="Keep running and load the .nc granules (and .xml sidecars) that arrive in this directory")
+    add_watch_arguments(parser)
+    parser.add_argument("-metadata", "-m",action="store_true",help="Read file metadata only")
+    add_extract_arguments(parser)
+    parser.add_argument("-csv", "-c", action="store_true", help="Read counties by year")
+    parser.add_argument("-csv_by_line", action="store_true", help="With -csv, load one line per transaction instead of the whole file at once")
+    add_run_arguments(parser)
+    add_db_arguments(parser)
+    return parser
+
+def legacy_command(args:dict[str,str])->str:
+    if args.get("query") is not None:
+        return "query"
+    if len(args.get("watch","")):
+        return "watch"
+    if len(args.get("file",""))==0:
+        if args.get("migrate",False):
+            return "migrate"
+        print("-file is required unless -watch, -migrate or -query is given")
+        sys.exit(1)
+    return "ingest-csv" if args.get("csv",False) else "ingest-nc"
+
+def process_args(argv:list[str]|None=None)->dict[str,str]:
+    argv = sys.argv[1:] if argv is None else argv
+    if len(argv) and argv[0] in COMMANDS:
+        return vars(command_parser().parse_args(argv))
+    args = vars(legacy_parser().parse_args(argv))
+    args["command"] = legacy_command(args)
+    return args
 
 def check_for_env(developing_dict:dict[str,str])->None:
     if len(os.getenv("POSTGRES_USER",""))==0 or len(os.getenv("POSTGRES_PASSWORD",""))==0:
+        from dotenv import load_dotenv
         load_dotenv(".env")
     if len(developing_dict.get("host",""))==0:
         developing_dict.update({"host":os.getenv("POSTGRES_HOST","")})
@@ -38,13 +188,75 @@ def check_for_env(developing_dict:dict[str,str])->None:
         developing_dict.update({"password":os.getenv("POSTGRES_PASSWORD","")})
     if len(developing_dict.get("db",""))==0:
         developing_dict.update({"db":os.getenv("POSTGRES_DB","")})
+    if len(developing_dict.get("pool_size",""))==0:
+        developing_dict.update({"pool_size":os.getenv("POSTGRES_POOL_SIZE","4")})
 
 
-def main():
+def print_banner()->None:
+    import  netCDF4 as nc
     print(f'cdfreader is ready.  Utilizing CDFlib Version\n{nc.__version__}')
-    args=process_args()
+
+
+def run_migrate(args:dict[str,str])->None:
+    from core.database import Db
+    from core.migrations import migrate
+    check_for_env(args)
+    with Db(args=args) as db:
+        migrate(db=db,directory=MIGRATIONS_DIR,verbose=args.get('verbose',False))
+
+
+def run_metadata(args:dict[str,str])->None:
+    from methane.utilities import get_files,get_file_dataset,display_dataset_metadata
+    print_banner()
     file_names = get_files(args.get("file",""))
-    if len(file_names)==0:
+    if len(file_names):
+        display_dataset_metadata(get_file_dataset(file_names[0]))
+
+
+def run_query(args:dict[str,str])->None:
+    from core.query import get_methane
+    check_for_env(args)
+    result = get_methane(bbox=args["query"],
+                         start=args.get("since"),
+                         end=args.get("until"),
+                         resolution=args.get("resolution",0),
+                         args=args,
+                         time_bucket=args.get("rollup_bucket","day"),
+                         table="methane_cell_data_located" if args.get("storage")=="cell" else "methane_data")
+    columns = list(result.columns)
+    rows = zip(*(result[column].tolist() for column in columns))
+    if len(args.get("query_out","")):
+        with open(args["query_out"],"w",newline="") as out:
+            writer = csv.writer(out)
+            writer.writerow(columns)
+            writer.writerows(rows)
+        print(f'wrote {len(result)} rows to {args["query_out"]}')
+        return
+    print(",".join(columns))
+    for index,row in enumerate(rows):
+        if index>=int(args.get("preview_rows",10)):
+            print(f'... and {len(result)-index} more rows')
+            break
+        print(",".join(str(value) for value in row))
+    print(f'{len(result)} rows')
+
+
+def run_ingest(args:dict[str,str])->None:
+    """
+    ingest-nc, ingest-csv and watch
+    """
+    from methane.utilities import get_files
+    from methane.runner import process,pool_size_needed
+    from core.database import DbPool
+    csv_files = args.get("csv",False)
+    if not csv_files:
+        print_banner()
+    watch_directory = args.get("watch","") if args["command"]=="watch" else ""
+    if len(watch_directory) and not os.path.isdir(watch_directory):
+        print(f"cannot watch {watch_directory}: not a directory")
+        sys.exit(1)
+    file_names = [] if len(watch_directory) else get_files(args.get("file",""))
+    if len(file_names)==0 and len(watch_directory)==0:
         sys.exit(0)
     # we might need db values.  double check for them
     check_for_env(args)
@@ -54,19 +266,54 @@ def main():
             len(args["user"]) == 0 or
             len(args["password"]) == 0 or
             len(args["db"]) == 0)
-    if (args.get("metadata","")):
+    args["sink"] = args.get("sink") or ("null" if nodb else "postgres")
+    if args["sink"] == "postgres" and nodb and not csv_files:
+        print("the postgres sink needs database settings (-host, -port, -user, -password, -db or POSTGRES_*) and no -dryrun")
+        sys.exit(1)
+    if args["sink"] in ("parquet","arrow") and importlib.util.find_spec("pyarrow") is None:
+        print(f"the {args['sink']} sink needs pyarrow: pip install pyarrow")
+        sys.exit(1)
+    # only the postgres sink records files and rows in the database
+    nodb = nodb or (args["sink"] != "postgres" and not csv_files)
+    if args.get("metadata","") and len(file_names):
+        from methane.utilities import get_file_dataset,display_dataset_metadata
         display_dataset_metadata(get_file_dataset(file_names[0]))
-    process(file_names=file_names,
-            args=args,
-            nodb=nodb,
-            batch_commits=args.get('commit_batching',0),
-            verbose=args.get('verbose',False))
-
-if __name__ == "__main__":
-    main()
-
-
-
+    pool = None if nodb else DbPool(args=args,size=max(int(args["pool_size"]),pool_size_needed(args)))
+    try:
+        if len(watch_directory):
+            from methane.watch import watch
+            watch(directory=watch_directory,
+                  args=args,
+                  nodb=nodb,
+                  verbose=args.get('verbose',False),
+                  pool=pool)
+        else:
+            process(file_names=file_names,
+                    args=args,
+                    nodb=nodb,
+                    batch_commits=args.get('commit_batching',0),
+                    verbose=args.get('verbose',False),
+                    pool=pool)
+    except KeyboardInterrupt:
+        print("stopped")
+    finally:
+        if pool is not None:
+            pool.close()
 
 
+def main(argv:list[str]|None=None):
+    args=process_args(argv)
+    command=args["command"]
+    if args.get("migrate",False):
+        run_migrate(args)
+    if command=="migrate":
+        return
+    if command=="query":
+        run_query(args)
+    elif command=="metadata":
+        run_metadata(args)
+    else:
+        run_ingest(args)
 
+if __name__ == "__main__":
+    main()
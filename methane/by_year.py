@@ -0,0 +1,160 @@
+import csv
+from methane.utilities import open_text,source_exists
+from core.database import Db,DbPool,get_db
+from core.metrics import Metrics
+
+# Loading the countries-by-year csv files (-csv / ingest-csv), plain or compressed.  Nothing here needs netCDF
+
+
+
+def add_methane_by_year_record(fileline:str,
+                               index:int,
+            args:dict[str,str],
+            nodb:bool=False,
+            verbose:bool=False,
+            pool:DbPool|None=None)->int:
+    """
+
+    """
+   # see if there is an associated xml file, and if so then process it
+    records_inserted=0
+    if index==0:
+        return 0
+    vals=fileline.split(",")
+    entity=vals[0]
+    code=vals[1]
+    year=vals[2]
+    quantity=vals[3]
+    if len(entity)==0 or len(year)==0 or len(quantity)==0:
+        raise ValueError(f'problem with line {index}, which looked like this={fileline}.')
+    with get_db(args,pool) as db:
+        country_id =db.query("SELECT methane_data_by_country_id FROM methane_data_by_country WHERE country_name=%s",(entity,))
+        if len(country_id)==0:
+            country_id = db.insert(insert_str=f'INSERT INTO methane_data_by_country (country_name) values (%s) RETURNING methane_data_by_country_id',
+                                   with_get_id=True,
+                                   parms=(entity,))
+        cid=country_id if isinstance(country_id,int) else (country_id[0]).methane_data_by_country_id #if type(country_id)==int else country_id[0]
+
+        insert_str = 'INSERT INTO methane_data_by_country_by_year (methane_data_by_country_id,year,carbon_tons) values (%s,%s,%s)'
+
+        parms=(cid, int(year), float(quantity),)
+        db.insert(insert_str=insert_str,with_get_id=False,parms=parms)
+    return 1
+
+
+
+
+
+
+
+def methane_by_year_by_line(file_name:str,args:dict[str,str],pool:DbPool|None=None)->int:
+    """
+    Load a countries-by-year csv one line (and one transaction) at a time
+    """
+    recs_processed=0
+    f=""
+    i=0
+    try:
+        with open_text(file_name) as file:
+            for index,line in enumerate(file):
+                # Process each line here
+                f=line
+                i=index
+                recs_processed+=add_methane_by_year_record(fileline=line.strip(),
+                                                           index=index,
+                                                           args=args,
+                                                           pool=pool)
+    except Exception as e:
+        # the lines before this one are committed; the file's result records the failure
+        print(f"An error occurred: {e}")
+        print(f"line={f}, line num={i}")
+        raise
+    return recs_processed
+
+
+
+def resolve_country_ids(db:Db,
+                        entities:set[str],
+                        country_cache:dict[str,int])->dict[str,int]:
+    """
+    Get the methane_data_by_country_id for every entity, creating the missing countries
+    with a single upsert.  Does not commit and does not touch country_cache.
+    :param db:
+    :param entities: country names
+    :param country_cache: ids already known in this run
+    :return: entity -> methane_data_by_country_id for the entities not in country_cache
+    """
+    missing=sorted(entities-country_cache.keys())
+    if len(missing)==0:
+        return {}
+    rows=db.insert_values(insert_str='INSERT INTO methane_data_by_country (country_name) values %s '
+                                     'ON CONFLICT (country_name) DO UPDATE SET country_name=EXCLUDED.country_name '
+                                     'RETURNING methane_data_by_country_id,country_name',
+                          rows=[(entity,) for entity in missing],
+                          fetch=True)
+    return {row.country_name:row.methane_data_by_country_id for row in rows}
+
+
+
+def methane_by_year_batched(file_name:str,
+                            args:dict[str,str],
+                            pool:DbPool|None=None,
+                            country_cache:dict[str,int]|None=None,
+                            metrics:Metrics|None=None)->int:
+    """
+    Load a countries-by-year csv in one transaction: one upsert for the countries and
+    one multi-row insert for the years
+    :param file_name:
+    :param args:
+    :param pool:
+    :param country_cache: entity -> methane_data_by_country_id, shared by every file in the run
+    :param metrics:
+    :return: number of year records loaded
+    """
+    country_cache = {} if country_cache is None else country_cache
+    year_rows=[]
+    with open_text(file_name, newline='') as file:
+        reader=csv.reader(file)
+        next(reader,None)
+        for vals in reader:
+            if len(vals)==0:
+                continue
+            try:
+                if len(vals)<4 or len(vals[0])==0 or len(vals[2])==0 or len(vals[3])==0:
+                    raise ValueError('missing values')
+                year_rows.append((vals[0], int(vals[2]), float(vals[3]),))
+            except ValueError as e:
+                raise ValueError(f'problem with line {reader.line_num}, which looked like this={vals}: {e}') from e
+    with get_db(args,pool,metrics) as db:
+        try:
+            new_ids=resolve_country_ids(db=db,
+                                        entities={entity for entity,_,_ in year_rows},
+                                        country_cache=country_cache)
+            ids={**country_cache,**new_ids}
+            db.insert_values(insert_str='INSERT INTO methane_data_by_country_by_year (methane_data_by_country_id,year,carbon_tons) values %s',
+                             rows=[(ids[entity],year,quantity,) for entity,year,quantity in year_rows])
+            db.commit()
+        except Exception:
+            # nothing of the file is kept, and the connection goes back to the pool clean
+            db.rollback()
+            raise
+    country_cache.update(new_ids)
+    return len(year_rows)
+
+
+
+def methane_by_year(file_name:str,
+                    args:dict[str,str],
+                    pool:DbPool|None=None,
+                    country_cache:dict[str,int]|None=None,
+                    metrics:Metrics|None=None)->int:
+    """
+    Load a countries-by-year csv: a plain file, a .gz or .bz2 file, or a zip archive
+    member (archive.zip/member.csv), read straight from the archive
+    """
+    if not source_exists(file_name):
+        print(f'could not find file {file_name}')
+        return 0
+    if args.get("csv_by_line",False):
+        return methane_by_year_by_line(file_name=file_name,args=args,pool=pool)
+    return methane_by_year_batched(file_name=file_name,args=args,pool=pool,country_cache=country_cache,metrics=metrics)
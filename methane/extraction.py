@@ -0,0 +1,372 @@
+import io
+import struct
+from dataclasses import dataclass, field
+from datetime import datetime
+import numpy as np
+import  netCDF4 as nc
+from methane.variables import variable_map, variable_spec
+from core.metrics import Metrics, timed, counted
+
+# The granules store time as "seconds since 1970-1-1 0:0:0.0" (gregorian), which is
+# what methane_specific always assumed.  Decode straight to datetime64 with numpy.
+TIME_EPOCH = np.datetime64('1970-01-01T00:00:00', 'us')
+DEFAULT_BATCH_SIZE = 50000
+DEFAULT_TILE_SIZE = 512
+METHANE_DATA_COLUMNS = ('methane_data_file_id','recorded_at','latitude','longitude','methane')
+METHANE_CELL_DATA_COLUMNS = ('methane_data_file_id','cell_id','recorded_at','methane')
+
+# postgres binary COPY framing: signature, flags, header extension length ... trailer
+PGCOPY_HEADER = b'PGCOPY\n\xff\r\n\x00' + struct.pack('>ii', 0, 0)
+PGCOPY_TRAILER = struct.pack('>h', -1)
+PG_EPOCH = np.datetime64('2000-01-01T00:00:00', 'us')
+PGCOPY_METHANE_ROW = np.dtype([('fields', '>i2'),
+                               ('file_id_len', '>i4'), ('file_id', '>i4'),
+                               ('recorded_at_len', '>i4'), ('recorded_at', '>i8'),
+                               ('latitude_len', '>i4'), ('latitude', '>f8'),
+                               ('longitude_len', '>i4'), ('longitude', '>f8'),
+                               ('methane_len', '>i4'), ('methane', '>f8')])
+PGCOPY_METHANE_CELL_ROW = np.dtype([('fields', '>i2'),
+                                    ('file_id_len', '>i4'), ('file_id', '>i4'),
+                                    ('cell_id_len', '>i4'), ('cell_id', '>i4'),
+                                    ('recorded_at_len', '>i4'), ('recorded_at', '>i8'),
+                                    ('methane_len', '>i4'), ('methane', '>f4')])
+
+
+@dataclass
+class methane_batch:
+    recorded_at: np.ndarray = field(default_factory=lambda: np.empty(0, dtype='datetime64[us]'))
+    latitude: np.ndarray = field(default_factory=lambda: np.empty(0, dtype='float64'))
+    longitude: np.ndarray = field(default_factory=lambda: np.empty(0, dtype='float64'))
+    methane: np.ndarray = field(default_factory=lambda: np.empty(0, dtype='float64'))
+    # variable path -> masked values of the other mapped variables, for the same cells
+    values: dict[str,np.ma.MaskedArray] = field(default_factory=dict)
+    # position of the source tile in the file's tile walk, and whether this batch finishes it
+    tile_index: int = 0
+    last_in_tile: bool = True
+
+    def __len__(self)->int:
+        return len(self.methane)
+
+    def slice(self, start:int, stop:int)->'methane_batch':
+        return methane_batch(recorded_at=self.recorded_at[start:stop],
+                             latitude=self.latitude[start:stop],
+                             longitude=self.longitude[start:stop],
+                             methane=self.methane[start:stop],
+                             values={name:values[start:stop] for name,values in self.values.items()},
+                             tile_index=self.tile_index,
+                             last_in_tile=self.last_in_tile and stop >= len(self))
+
+    def select(self, keep:np.ndarray)->'methane_batch':
+        """
+        The cells where the boolean mask keep is set, with the same tile position
+        """
+        return methane_batch(recorded_at=self.recorded_at[keep],
+                             latitude=self.latitude[keep],
+                             longitude=self.longitude[keep],
+                             methane=self.methane[keep],
+                             values={name:values[keep] for name,values in self.values.items()},
+                             tile_index=self.tile_index,
+                             last_in_tile=self.last_in_tile)
+
+    def rows(self, methane_data_file_id:int):
+        """
+        Yield one parameter tuple per cell, in methane_data column order
+        (methane_data_file_id,recorded_at,latitude,longitude,methane)
+        """
+        recorded_at: list[datetime] = self.recorded_at.tolist()
+        yield from zip([methane_data_file_id]*len(self),
+                       recorded_at,
+                       self.latitude.tolist(),
+                       self.longitude.tolist(),
+                       self.methane.tolist())
+
+    def copy_text(self, methane_data_file_id:int)->io.StringIO:
+        """
+        Render the batch as a COPY ... (FORMAT text) buffer in methane_data column order
+        """
+        stamps = np.datetime_as_string(self.recorded_at, unit='us').tolist()
+        buffer = io.StringIO()
+        buffer.writelines(f'{methane_data_file_id}\t{recorded_at}\t{latitude!r}\t{longitude!r}\t{methane!r}\n'
+                          for recorded_at, latitude, longitude, methane in zip(stamps,
+                                                                               self.latitude.tolist(),
+                                                                               self.longitude.tolist(),
+                                                                               self.methane.tolist()))
+        buffer.seek(0)
+        return buffer
+
+    def copy_binary(self, methane_data_file_id:int)->io.BytesIO:
+        """
+        Render the batch as a COPY ... (FORMAT binary) buffer in methane_data column order
+        """
+        rows = np.empty(len(self), dtype=PGCOPY_METHANE_ROW)
+        rows['fields'] = len(METHANE_DATA_COLUMNS)
+        rows['file_id_len'] = 4
+        rows['file_id'] = methane_data_file_id
+        rows['recorded_at_len'] = 8
+        rows['recorded_at'] = (self.recorded_at - PG_EPOCH).astype('int64')
+        rows['latitude_len'] = 8
+        rows['latitude'] = self.latitude
+        rows['longitude_len'] = 8
+        rows['longitude'] = self.longitude
+        rows['methane_len'] = 8
+        rows['methane'] = self.methane
+        return io.BytesIO(PGCOPY_HEADER + rows.tobytes() + PGCOPY_TRAILER)
+
+    def cell_rows(self, methane_data_file_id:int, cell_ids:np.ndarray):
+        """
+        Yield one parameter tuple per cell, in methane_cell_data column order
+        (methane_data_file_id,cell_id,recorded_at,methane)
+        """
+        recorded_at: list[datetime] = self.recorded_at.tolist()
+        yield from zip([methane_data_file_id]*len(self),
+                       cell_ids.tolist(),
+                       recorded_at,
+                       self.methane.tolist())
+
+    def cell_copy_text(self, methane_data_file_id:int, cell_ids:np.ndarray)->io.StringIO:
+        """
+        Render the batch as a COPY ... (FORMAT text) buffer in methane_cell_data column order
+        """
+        stamps = np.datetime_as_string(self.recorded_at, unit='us').tolist()
+        buffer = io.StringIO()
+        buffer.writelines(f'{methane_data_file_id}\t{cell_id}\t{recorded_at}\t{methane!r}\n'
+                          for cell_id, recorded_at, methane in zip(cell_ids.tolist(), stamps, self.methane.tolist()))
+        buffer.seek(0)
+        return buffer
+
+    def cell_copy_binary(self, methane_data_file_id:int, cell_ids:np.ndarray)->io.BytesIO:
+        """
+        Render the batch as a COPY ... (FORMAT binary) buffer in methane_cell_data column order
+        """
+        rows = np.empty(len(self), dtype=PGCOPY_METHANE_CELL_ROW)
+        rows['fields'] = len(METHANE_CELL_DATA_COLUMNS)
+        rows['file_id_len'] = 4
+        rows['file_id'] = methane_data_file_id
+        rows['cell_id_len'] = 4
+        rows['cell_id'] = cell_ids
+        rows['recorded_at_len'] = 8
+        rows['recorded_at'] = (self.recorded_at - PG_EPOCH).astype('int64')
+        rows['methane_len'] = 4
+        rows['methane'] = self.methane
+        return io.BytesIO(PGCOPY_HEADER + rows.tobytes() + PGCOPY_TRAILER)
+
+    def variable_rows(self, methane_data_file_id:int, specs:list[variable_spec], cell_ids:np.ndarray|None=None):
+        """
+        Yield one parameter tuple per cell for a mapped table: its key columns
+        (methane_data_file_id,recorded_at,latitude,longitude), or
+        (methane_data_file_id,cell_id,recorded_at) given cell ids, then one value per
+        spec, None where it is masked
+        """
+        recorded_at: list[datetime] = self.recorded_at.tolist()
+        if cell_ids is None:
+            keys = zip([methane_data_file_id]*len(self), recorded_at, self.latitude.tolist(), self.longitude.tolist())
+        else:
+            keys = zip([methane_data_file_id]*len(self), cell_ids.tolist(), recorded_at)
+        values = zip(*[self.values[spec.path].tolist() for spec in specs])
+        yield from (key + value for key, value in zip(keys, values))
+
+    def variable_copy_text(self, methane_data_file_id:int, specs:list[variable_spec], cell_ids:np.ndarray|None=None)->io.StringIO:
+        """
+        Render variable_rows as a COPY ... (FORMAT text) buffer, with \\N for NULL
+        """
+        stamps = np.datetime_as_string(self.recorded_at, unit='us').tolist()
+        if cell_ids is None:
+            keys = (f'{methane_data_file_id}\t{recorded_at}\t{latitude!r}\t{longitude!r}'
+                    for recorded_at, latitude, longitude in zip(stamps, self.latitude.tolist(), self.longitude.tolist()))
+        else:
+            keys = (f'{methane_data_file_id}\t{cell_id}\t{recorded_at}' for cell_id, recorded_at in zip(cell_ids.tolist(), stamps))
+        values = zip(*[self.values[spec.path].tolist() for spec in specs])
+        buffer = io.StringIO()
+        buffer.writelines(key + ''.join('\t\\N' if value is None else f'\t{value!r}' for value in row) + '\n'
+                          for key, row in zip(keys, values))
+        buffer.seek(0)
+        return buffer
+
+
+@dataclass
+class grid_subset:
+    """
+    The part of a granule to load.  bbox is (min_lon, min_lat, max_lon, max_lat), inclusive;
+    cells are kept when since <= recorded_at < until.  None means unbounded.
+    """
+    bbox: tuple[float,float,float,float]|None = None
+    since: datetime|None = None
+    until: datetime|None = None
+
+    def time_bounds(self)->tuple[float,float]:
+        """
+        The time window as seconds since the epoch, the unit the time variable is stored in
+        """
+        since = -np.inf if self.since is None else (np.datetime64(self.since, 'us') - TIME_EPOCH) / np.timedelta64(1, 's')
+        until = np.inf if self.until is None else (np.datetime64(self.until, 'us') - TIME_EPOCH) / np.timedelta64(1, 's')
+        return since, until
+
+
+def decode_times(seconds:np.ndarray)->np.ndarray:
+    """
+    Convert seconds since the unix epoch to datetime64[us] in one pass
+    """
+    micros = np.rint(np.asarray(seconds, dtype='float64') * 1e6).astype('int64')
+    return TIME_EPOCH + micros.astype('timedelta64[us]')
+
+
+def as_dtype(values:np.ma.MaskedArray, dtype:str='')->np.ma.MaskedArray:
+    """
+    Cast a mapped variable's values, float64 by default, without casting the fill
+    values hidden under its mask
+    """
+    return np.ma.array(np.ma.asarray(values).filled(0).astype(dtype or 'float64'), mask=np.ma.getmaskarray(values))
+
+
+def grid_coordinates(ds:nc.Dataset)->tuple[np.ndarray,np.ndarray]:
+    """
+    The lat and lon coordinate arrays, as the float64 values batches carry
+    """
+    return (np.ma.getdata(ds['lat'][:]).astype('float64'),
+            np.ma.getdata(ds['lon'][:]).astype('float64'))
+
+
+def index_range(coords:np.ndarray, low:float, high:float)->slice:
+    """
+    The smallest index slice of a monotonic 1-D coordinate array that covers [low, high]
+    """
+    inside = np.flatnonzero((coords >= low) & (coords <= high))
+    if len(inside) == 0:
+        return slice(0, 0)
+    return slice(int(inside[0]), int(inside[-1]) + 1)
+
+
+def intersect(tile:slice, window:slice)->slice|None:
+    start, stop = max(tile.start, window.start), min(tile.stop, window.stop)
+    return slice(start, stop) if start < stop else None
+
+
+def tile_shape(var:nc.Variable, tile_size:int=DEFAULT_TILE_SIZE)->tuple[int,int]:
+    """
+    Pick a (lat, lon) hyperslab shape of roughly tile_size x tile_size cells that
+    lines up with the variable's HDF5 chunks, so each tile decompresses whole chunks only
+    :param var: a (lat, lon) variable
+    :param tile_size: edge length of a tile, in cells
+    """
+    num_lats, num_lons = var.shape
+    tile_size = max(tile_size, 1)
+    chunking = var.chunking()
+    if chunking == 'contiguous' or not chunking:
+        # stored row by row: read whole rows, about tile_size**2 cells at a time
+        return min(max(tile_size * tile_size // max(num_lons, 1), 1), num_lats), num_lons
+    chunk_lats, chunk_lons = chunking
+    return (min(-(-tile_size // chunk_lats) * chunk_lats, num_lats),
+            min(-(-tile_size // chunk_lons) * chunk_lons, num_lons))
+
+
+def iter_tiles(num_lats:int, num_lons:int, shape:tuple[int,int]):
+    """
+    Yield (lat slice, lon slice) for every tile of the grid, row by row
+    """
+    tile_lats, tile_lons = shape
+    for lat_start in range(0, num_lats, tile_lats):
+        for lon_start in range(0, num_lons, tile_lons):
+            yield (slice(lat_start, min(lat_start + tile_lats, num_lats)),
+                   slice(lon_start, min(lon_start + tile_lons, num_lons)))
+
+
+def extract_tile(ds:nc.Dataset,
+                 lats:np.ndarray,
+                 lons:np.ndarray,
+                 lat_slice:slice,
+                 lon_slice:slice,
+                 time_bounds:tuple[float,float]=(-np.inf, np.inf),
+                 metrics:Metrics|None=None,
+                 variables:variable_map|None=None)->methane_batch:
+    """
+    Read one hyperslab of time and xch4 and return its usable cells.  xch4 is only
+    read when some cell of the tile falls inside the time window.  With a variable
+    map, its methane variable stands in for xch4 and the other mapped variables are
+    read from the same hyperslab, sharing the tile's coordinates and times.
+    :param ds: open methane dataset
+    :param lats: the whole lat coordinate array
+    :param lons: the whole lon coordinate array
+    :param lat_slice:
+    :param lon_slice:
+    :param time_bounds: [since, until) in seconds since the epoch
+    :param metrics: collects array_decode / time_conversion time and bytes_read
+    :param variables: the -variables map; None for xch4 alone
+    :return: columns for the cells with a valid time after the epoch, a non-fill xch4
+             and no masked required variable
+    """
+    with timed(metrics, 'array_decode'):
+        times = np.ma.asarray(ds['time'][lat_slice, lon_slice])
+    counted(metrics, 'bytes_read', times.nbytes)
+    seconds = np.ma.getdata(times)
+    # records stamped within the first minute of 1970 are placeholders, not observations
+    keep = ~np.ma.getmaskarray(times) & (np.floor(seconds / 60.0) > 0)
+    keep &= (seconds >= time_bounds[0]) & (seconds < time_bounds[1])
+    if not keep.any():
+        return methane_batch()
+    with timed(metrics, 'array_decode'):
+        xch4 = np.ma.asarray(ds[variables.methane.path if variables else 'xch4'][lat_slice, lon_slice])
+    counted(metrics, 'bytes_read', xch4.nbytes)
+    keep &= ~np.ma.getmaskarray(xch4)
+    extras = {}
+    for spec in (variables.extras if variables else []):
+        # required variables come first, so later reads can stop at an empty tile
+        if not keep.any():
+            return methane_batch()
+        with timed(metrics, 'array_decode'):
+            extras[spec.path] = np.ma.asarray(ds[spec.path][lat_slice, lon_slice])
+        counted(metrics, 'bytes_read', extras[spec.path].nbytes)
+        if spec.required:
+            keep &= ~np.ma.getmaskarray(extras[spec.path])
+    lat_grid, lon_grid = np.broadcast_arrays(lats[lat_slice, np.newaxis], lons[np.newaxis, lon_slice])
+    with timed(metrics, 'time_conversion'):
+        recorded_at = decode_times(seconds[keep])
+    return methane_batch(recorded_at=recorded_at,
+                         latitude=lat_grid[keep],
+                         longitude=lon_grid[keep],
+                         methane=np.ma.getdata(xch4)[keep].astype('float64'),
+                         values={spec.path:as_dtype(extras[spec.path][keep], spec.dtype)
+                                 for spec in (variables.extras if variables else [])})
+
+
+def iter_methane_batches(ds:nc.Dataset,
+                         batch_size:int=DEFAULT_BATCH_SIZE,
+                         tile_size:int=DEFAULT_TILE_SIZE,
+                         subset:grid_subset|None=None,
+                         skip_tiles:set[int]|frozenset[int]=frozenset(),
+                         metrics:Metrics|None=None,
+                         variables:variable_map|None=None):
+    """
+    Stream the usable cells of a dataset as columnar batches of at most batch_size rows.
+    Only one tile of time and xch4 is in memory at a time, however big the file is.
+    Every tile that is read yields at least one batch, possibly empty, and its last
+    batch has last_in_tile set.
+    :param ds: open methane dataset
+    :param batch_size: maximum rows per batch
+    :param tile_size: edge length, in cells, of the hyperslabs read from the file
+    :param subset: bounding box and time window; tiles outside the box are never read
+    :param skip_tiles: tile indexes already loaded, which are not read again
+    :param metrics: collects read and decode timings and counters
+    :param variables: the -variables map, whose variables are all read with each tile
+    """
+    subset = grid_subset() if subset is None else subset
+    lats, lons = grid_coordinates(ds)
+    lat_window, lon_window = slice(0, len(lats)), slice(0, len(lons))
+    if subset.bbox is not None:
+        min_lon, min_lat, max_lon, max_lat = subset.bbox
+        lat_window = index_range(lats, min_lat, max_lat)
+        lon_window = index_range(lons, min_lon, max_lon)
+    time_bounds = subset.time_bounds()
+    xch4 = ds[variables.methane.path if variables else 'xch4']
+    for tile_index, (lat_tile, lon_tile) in enumerate(iter_tiles(len(lats), len(lons), tile_shape(xch4, tile_size))):
+        if tile_index in skip_tiles:
+            continue
+        lat_slice, lon_slice = intersect(lat_tile, lat_window), intersect(lon_tile, lon_window)
+        if lat_slice is None or lon_slice is None:
+            continue
+        tile = extract_tile(ds, lats, lons, lat_slice, lon_slice, time_bounds, metrics, variables)
+        tile.tile_index = tile_index
+        counted(metrics, 'tiles')
+        counted(metrics, 'rows_extracted', len(tile))
+        step = batch_size if batch_size > 0 else max(len(tile), 1)
+        for start in range(0, max(len(tile), 1), step):
+            yield tile.slice(start, start + step)
@@ -0,0 +1,89 @@
+import hashlib
+import threading
+from dataclasses import dataclass, field
+import numpy as np
+from core.database import Db
+
+# cell_id is an INT column
+MAX_CELL_ID = 2**31 - 1
+
+# grid_hash -> grid_index, for the grids this process has already looked up
+_grids:dict[str,'grid_index'] = {}
+_lock = threading.Lock()
+
+
+
+@dataclass
+class grid_index:
+    """
+    A registered grid and the in-memory lookup from a cell's coordinates to its cell id
+    """
+    grid_id: int
+    base_cell_id: int
+    lats: np.ndarray
+    lons: np.ndarray
+    lat_order: np.ndarray = field(init=False)
+    lon_order: np.ndarray = field(init=False)
+
+    def __post_init__(self):
+        self.lat_order = np.argsort(self.lats, kind='stable')
+        self.lon_order = np.argsort(self.lons, kind='stable')
+
+    def cell_ids(self, latitude:np.ndarray, longitude:np.ndarray)->np.ndarray:
+        """
+        Cell ids for coordinates taken from this grid's lat and lon arrays
+        """
+        lat_index = self.lat_order[np.searchsorted(self.lats, latitude, sorter=self.lat_order)]
+        lon_index = self.lon_order[np.searchsorted(self.lons, longitude, sorter=self.lon_order)]
+        return (self.base_cell_id + lat_index * len(self.lons) + lon_index).astype('int32')
+
+
+
+def grid_hash(lats:np.ndarray, lons:np.ndarray)->str:
+    digest = hashlib.sha256(f'{len(lats)}x{len(lons)}'.encode())
+    digest.update(np.ascontiguousarray(lats, dtype='float64').tobytes())
+    digest.update(np.ascontiguousarray(lons, dtype='float64').tobytes())
+    return digest.hexdigest()
+
+
+
+def register_grid(db:Db, lats:np.ndarray, lons:np.ndarray)->grid_index:
+    """
+    The grid with these coordinates, recording it and all its cells the first time
+    it is seen.  Commits.
+    :param db:
+    :param lats: the file's lat coordinates, as from grid_coordinates
+    :param lons: the file's lon coordinates
+    """
+    key = grid_hash(lats, lons)
+    with _lock:
+        if key in _grids:
+            return _grids[key]
+    find_str = 'SELECT grid_id,base_cell_id FROM grid WHERE grid_hash=%s'
+    rows = db.query(find_str, (key,))
+    if len(rows) == 0:
+        # one registration at a time, so the cell id ranges of two grids never overlap
+        db.insert_continuous(insert_str='LOCK TABLE grid IN SHARE ROW EXCLUSIVE MODE')
+        rows = db.query(find_str, (key,))
+    if len(rows) == 0:
+        base_cell_id = db.query('SELECT COALESCE(MAX(base_cell_id::bigint+num_lats*num_lons),1) AS next_cell_id FROM grid')[0].next_cell_id
+        if base_cell_id + len(lats) * len(lons) - 1 > MAX_CELL_ID:
+            raise ValueError(f'no room for another {len(lats)}x{len(lons)} grid in the cell id range')
+        rows = db.query('INSERT INTO grid (grid_hash,num_lats,num_lons,base_cell_id) values (%s,%s,%s,%s) '
+                        'RETURNING grid_id,base_cell_id',
+                        (key, len(lats), len(lons), base_cell_id,))
+        db.insert_continuous(insert_str='INSERT INTO grid_cell (cell_id,grid_id,lat_index,lon_index,latitude,longitude) '
+                                        'SELECT %(base)s+i*%(num_lons)s+j, %(grid_id)s, i, j, '
+                                        '(%(lats)s::float8[])[i+1], (%(lons)s::float8[])[j+1] '
+                                        'FROM generate_series(0,%(num_lats)s-1) i, generate_series(0,%(num_lons)s-1) j',
+                             parms={'base':base_cell_id,
+                                    'grid_id':rows[0].grid_id,
+                                    'num_lats':len(lats),
+                                    'num_lons':len(lons),
+                                    'lats':lats.tolist(),
+                                    'lons':lons.tolist()})
+    db.commit()
+    grid = grid_index(grid_id=rows[0].grid_id, base_cell_id=rows[0].base_cell_id, lats=lats, lons=lons)
+    with _lock:
+        _grids[key] = grid
+    return grid
@@ -0,0 +1,135 @@
+import threading
+import uuid
+from typing import Iterable
+import numpy as np
+from methane.extraction import methane_batch
+from core.database import Db,get_db
+
+# (staging run, month 'YYYY-MM') -> table its rows are written to, for the months this process has seen
+_month_tables:dict[tuple[str,str],str]={}
+_partitioned:bool|None=None
+_lock=threading.Lock()
+
+
+
+def is_partitioned(db:Db)->bool:
+    """
+    Whether methane_data is the month-partitioned table of migration 003.  Asked once per process
+    """
+    global _partitioned
+    if _partitioned is None:
+        rows=db.query("SELECT relkind FROM pg_class WHERE oid=to_regclass('methane_data')")
+        _partitioned=len(rows)>0 and rows[0].relkind=='p'
+    return _partitioned
+
+
+
+def batch_months(batches:Iterable[methane_batch])->list[str]:
+    """
+    The months, as 'YYYY-MM', that the batches' cells were recorded in
+    """
+    months=set()
+    for batch in batches:
+        if len(batch):
+            months.update(str(month) for month in np.unique(batch.recorded_at.astype('datetime64[M]')))
+    return sorted(months)
+
+
+
+def new_stage_run()->str:
+    """
+    A name for one -defer_indexes run's staging tables, never reused by another run
+    """
+    return uuid.uuid4().hex
+
+
+
+def hold_stage_run(args:dict[str,str],stage_run:str)->Db:
+    """
+    Take stage_run's advisory lock (migration 009) on a connection of its own, kept
+    out of the run's pool, so adopt_staged_partitions leaves the run's tables alone
+    while it loads.  Close the Db once attach_staged_partitions has run; should the
+    process die first, the lock goes with its connection
+    """
+    db=get_db(args)
+    db.query('SELECT pg_advisory_lock(methane_data_stage_lock(%s))',(stage_run,))
+    db.commit()
+    return db
+
+
+
+def month_tables(db:Db,months:list[str],stage_run:str='')->dict[str,str]:
+    """
+    Where each month's rows go, creating its partition the first time the month is seen.
+    Creating a partition commits, so call this before the tile's rows are written, on
+    the connection that writes them, with no transaction open.
+    :param db:
+    :param months: 'YYYY-MM'
+    :param stage_run: a -defer_indexes run's name from new_stage_run: a month with no
+                      partition yet gets a bare staging table of the run's own, written
+                      directly and attached by attach_staged_partitions.  '' for none
+    :return: month -> methane_data, or the run's staging table for the month
+    """
+    with _lock:
+        missing=[month for month in months if (stage_run,month) not in _month_tables]
+    if len(missing):
+        created={}
+        for month in missing:
+            if stage_run:
+                row=db.query('SELECT table_name,attached FROM methane_data_stage_partition(%s::date,%s)',(month+'-01',stage_run,))[0]
+                created[(stage_run,month)]='methane_data' if row.attached else row.table_name
+            else:
+                db.query('SELECT methane_data_ensure_partition(%s::date)',(month+'-01',))
+                created[(stage_run,month)]='methane_data'
+        db.commit()
+        with _lock:
+            _month_tables.update(created)
+    with _lock:
+        return {month:_month_tables[(stage_run,month)] for month in months}
+
+
+
+def route_batch(batch:methane_batch,tables:dict[str,str]|None)->list[tuple[str,methane_batch]]:
+    """
+    Split a batch by the table each cell's month goes to
+    """
+    targets=set(tables.values()) if tables else set()
+    if len(targets)<=1 or len(batch)==0:
+        return [(targets.pop() if len(targets) else 'methane_data',batch)]
+    months=batch.recorded_at.astype('datetime64[M]').astype(str)
+    routes=[]
+    for table in sorted(targets):
+        keep=np.isin(months,[month for month,target in tables.items() if target==table])
+        if keep.any():
+            routes.append((table,batch.select(keep)))
+    return routes
+
+
+
+def attach_staged_partitions(db:Db,stage_run:str)->int:
+    """
+    Attach the staging tables the -defer_indexes run stage_run loaded, and no other's.
+    Attaching builds their share of methane_data's indexes, once, over the loaded rows
+    :return: tables attached
+    """
+    attached=db.query('SELECT methane_data_attach_staged(%s) AS attached',(stage_run,))[0].attached
+    db.commit()
+    with _lock:
+        for key in [key for key in _month_tables if key[0]==stage_run]:
+            del _month_tables[key]
+    return attached
+
+
+
+def adopt_staged_partitions(db:Db)->int:
+    """
+    Attach the staging tables of -defer_indexes runs that stopped before attaching them:
+    their files are marked complete and their tiles checkpointed, so nothing else would
+    load those rows again.  Runs still loading hold their lock and are skipped
+    :return: tables attached
+    """
+    if not db.query("SELECT to_regprocedure('methane_data_adopt_staged()') IS NOT NULL AS can_adopt")[0].can_adopt:
+        return 0
+    adopted=db.query('SELECT methane_data_adopt_staged() AS adopted')[0].adopted
+    db.commit()
+    return adopted
@@ -0,0 +1,95 @@
+import queue
+import threading
+from typing import Any, Callable, Iterable
+
+# tells a writer thread there is nothing more to read
+_DONE = object()
+_POLL_SECONDS = 0.1
+
+
+def _put(work:queue.Queue, item:Any, stop:threading.Event)->bool:
+    """
+    Blocking put that gives up once the pipeline is stopping
+    """
+    while not stop.is_set():
+        try:
+            work.put(item, timeout=_POLL_SECONDS)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+
+def run_pipeline(batches:Iterable,
+                 write:Callable[[Any,Any],int],
+                 open_resource:Callable[[],Any],
+                 queue_depth:int=4,
+                 writers:int=1)->int:
+    """
+    Overlap reading and writing: one reader thread pulls batches from the iterable into
+    a bounded queue, and writer threads take them off and write them.  At most
+    queue_depth batches are waiting at any time, plus one being written per writer.
+    The first error in any thread stops every thread and is raised here.
+    :param batches: produces the batches; only ever iterated from the reader thread
+    :param write: write(resource, batch) -> rows written
+    :param open_resource: called once per writer thread for what write needs, e.g. a Db.
+                          Anything returned other than None is close()d when the writer ends
+    :param queue_depth: batches that may wait between the reader and the writers
+    :param writers: number of writer threads
+    :return: rows written
+    """
+    writers = max(writers, 1)
+    work = queue.Queue(maxsize=max(queue_depth, 1))
+    stop = threading.Event()
+    errors:list[BaseException] = []
+    written = [0]
+    written_lock = threading.Lock()
+
+    def read()->None:
+        try:
+            for batch in batches:
+                if not _put(work, batch, stop):
+                    return
+        except BaseException as e:
+            errors.append(e)
+            stop.set()
+        finally:
+            for _ in range(writers):
+                _put(work, _DONE, stop)
+
+    def write_loop()->None:
+        resource = None
+        try:
+            resource = open_resource()
+            while not stop.is_set():
+                try:
+                    item = work.get(timeout=_POLL_SECONDS)
+                except queue.Empty:
+                    continue
+                if item is _DONE:
+                    return
+                rows = write(resource, item)
+                with written_lock:
+                    written[0] += rows
+        except BaseException as e:
+            errors.append(e)
+            stop.set()
+        finally:
+            if resource is not None:
+                resource.close()
+
+    threads = [threading.Thread(target=read, name='cdfreader-reader', daemon=True)]
+    threads += [threading.Thread(target=write_loop, name=f'cdfreader-writer-{i}', daemon=True) for i in range(writers)]
+    for thread in threads:
+        thread.start()
+    try:
+        for thread in threads:
+            thread.join()
+    except BaseException:
+        stop.set()
+        for thread in threads:
+            thread.join()
+        raise
+    if errors:
+        raise errors[0]
+    return written[0]
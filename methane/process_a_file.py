@@ -1,15 +1,24 @@
 import json
 import os.path
-from datetime import datetime, timezone
-import sys
+from datetime import datetime
 import psycopg2
-import netCDF4
 from dataclasses import dataclass
 from os import path
+from typing import Iterable
 import  netCDF4 as nc
-import xmltodict
-from methane.utilities import get_file_dataset,storable_metadata_json
-from core.database import Db
+from methane.utilities import get_file_dataset,storable_metadata_json,parse_xml_file
+from methane.extraction import iter_methane_batches,methane_batch,grid_subset,grid_coordinates,DEFAULT_BATCH_SIZE,DEFAULT_TILE_SIZE,METHANE_DATA_COLUMNS,METHANE_CELL_DATA_COLUMNS
+from methane.pipeline import run_pipeline
+from methane.sinks import open_sink
+from methane.grid import register_grid
+from methane.rollup import file_rollup_specs,rebuild_file_rollups,remove_file_rollups,rollup_from_table,rollup_spec_from_args
+from methane.partitions import is_partitioned,month_tables
+from methane.variables import variable_map_from_args,staged_variable_table,VARIABLE_KEY_COLUMNS,VARIABLE_CELL_KEY_COLUMNS
+from core.database import DbPool,get_db
+from core.metrics import Metrics,timed,counted,rate
+# these lived here before the csv loader and the run loop moved to their own modules
+from methane.by_year import add_methane_by_year_record,methane_by_year_by_line,resolve_country_ids,methane_by_year_batched,methane_by_year
+from methane.runner import file_result,process_one_file,pool_size_needed,process
 
 
 
@@ -21,6 +30,12 @@ class metadata_for_file:
     num_lons: int = 0
     methane_data_file_id:int=0
     processed: bool=False
+    # set when resuming an interrupted load: the tiles already committed and the tile size they used
+    completed_tiles: frozenset = frozenset()
+    tile_size: int = 0
+    # set for -replace: the unlogged table the new rows are loaded into, and the file's new columns
+    stage_table: str = ''
+    file_columns: dict = None
 
 
 
@@ -28,53 +43,76 @@ class metadata_for_file:
 def add_file_record(file_name:str,
             args:dict[str,str],
             nodb:bool=False,
-            verbose:bool=False)->metadata_for_file:
+            verbose:bool=False,
+            pool:DbPool|None=None,
+            metrics:Metrics|None=None)->metadata_for_file:
     """
     Add all the records for one data file
     :param file_name:
     :param args:
     :param nodb:
     :param verbose:
+    :param pool: the run's connection pool, if any
+    :param metrics: collects dataset_open, metadata_extraction and xml_parse time
     :return:
     """
     if not path.exists(file_name):
         print(f'could not find file {file_name}')
         return metadata_for_file(file_name=file_name)
     #  first try to open the cdf and get what we can
-    ds=get_file_dataset(file_name)
-    json_descr=storable_metadata_json(ds)
+    with timed(metrics,'dataset_open'):
+        ds=get_file_dataset(file_name)
+    if ds is None:
+        raise ValueError(f'could not open {file_name} as a netCDF dataset')
+    with timed(metrics,'metadata_extraction'):
+        json_descr=storable_metadata_json(ds)
     num_lats=ds.dimensions.get('lat').size
     num_lons=ds.dimensions.get('lon').size
-    db=None if nodb else Db(args=args)
     # see if there is an associated xml file, and if so then process it
     filename,extension=path.splitext(file_name)
     poss_xml_file=filename+'.xml'
     xmljson = None
-    insert_str = f'INSERT INTO methane_data_file (file_name,metadata) values (%s,%s) RETURNING methane_data_file_id'
-    parms=(file_name, json_descr,)
+    file_columns={'file_name':file_name,'metadata':json_descr}
     if os.path.exists(poss_xml_file):
-        with open(poss_xml_file) as xml_file:
-            data_dict = xmltodict.parse(xml_file.read())
+        with timed(metrics,'xml_parse'):
+            data_dict = parse_xml_file(poss_xml_file)
             xmljson = json.dumps(data_dict)
         if len(xmljson):
-            insert_str=f'INSERT INTO methane_data_file (file_name,metadata,xmlmetadata) values (%s,%s,%s) RETURNING methane_data_file_id'
-            parms = (file_name, json_descr,xmljson,)
+            file_columns['xmlmetadata']=xmljson
+    insert_str=(f'INSERT INTO methane_data_file ({",".join(file_columns)}) '
+                f'values ({",".join(["%s"]*len(file_columns))}) RETURNING methane_data_file_id')
+    parms=tuple(file_columns.values())
     if nodb:
         return metadata_for_file(file_name=file_name,
                                  ds=ds,
                                  num_lats=num_lats,
                                  num_lons=num_lons,
                                  methane_data_file_id=0,
-                                 processed=False)
+                                 processed=True)
+    if args.get('replace',False):
+        staged=stage_file_record(ds=ds,
+                                 file_columns=file_columns,
+                                 args=args,
+                                 pool=pool)
+        if staged is not None:
+            return staged
+    elif args.get('force',False):
+        return reload_file_record(ds=ds,
+                                  file_columns=file_columns,
+                                  args=args,
+                                  pool=pool)
     try:
-        methane_data_file_id = db.insert(
-            insert_str=insert_str,
-            with_get_id=True,
-            parms=(parms))
+        with get_db(args,pool,metrics) as db:
+            methane_data_file_id = db.insert(
+                insert_str=insert_str,
+                with_get_id=True,
+                parms=(parms))
     except psycopg2.errors.UniqueViolation:
-        if verbose:
-            print(f" skipping {file_name} because we have already loaded it")
-        return metadata_for_file(file_name=file_name)
+        return resume_file_record(file_name=file_name,
+                                  ds=ds,
+                                  args=args,
+                                  verbose=verbose,
+                                  pool=pool)
     return metadata_for_file(file_name=file_name,
                              ds=ds,
                             num_lats=num_lats,
@@ -86,197 +124,388 @@ def add_file_record(file_name:str,
 
 
 
-def methane_specific(file_name:str,
-            args:dict[str,str],
-            batch_commits:int=0,
-            nodb:bool=False,
-            maxrecords:int=0,
-            verbose:bool=False):
+def reload_file_record(ds:nc.Dataset,
+                       file_columns:dict[str,str],
+                       args:dict[str,str],
+                       pool:DbPool|None=None)->metadata_for_file:
     """
-    After loading the main data file, load all the records
-    :param file_name:
+    -force: add the file record, or refresh it and drop the rows loaded from it before,
+    in one transaction.  Its contribution at the current -rollup is rebuilt tile by tile;
+    any other resolution it rolled up to is rebuilt by mark_file_complete
+    :param ds:
+    :param file_columns: methane_data_file column -> value, including file_name
     :param args:
-    :param batch_commits:
-    :param nodb:
-    :param maxrecords:
-    :param verbose:
-    :return:
+    :param pool:
     """
-    metadata_for_the_file=add_file_record(file_name=file_name,
-                                            args=args,
-                                            nodb=nodb,
-                                            verbose=verbose)
-    if not metadata_for_the_file.processed:
-        return 0
-    unix_epoch_start = datetime(1970, 1, 1, 0, 0, tzinfo=timezone.utc)
-    start_time = datetime.now()
-    records_inserted = 0
-    times={}
-    times["units"]="seconds since 1970-1-1 0:0:0.0"
-    times["calendar"] = "gregorian"
-    db=None if nodb else Db(args=args)
-    for lon in range(0,metadata_for_the_file.num_lons-1):
-        for lat in range(0,metadata_for_the_file.num_lats-1):
-            timeofrecord = netCDF4.num2date(metadata_for_the_file.ds['time'][lat, lon].item(),
-                                                        units=times['units'],
-                                                        calendar=times['calendar'],
-                                                        only_use_cftime_datetimes=False)
-            standard_datetime = datetime(
-                timeofrecord.year,
-                timeofrecord.month,
-                timeofrecord.day,
-                timeofrecord.hour,
-                timeofrecord.minute,
-                tzinfo=timezone.utc
-            )
-            if standard_datetime > unix_epoch_start:
-                my_parms= {'insert_str':f'INSERT INTO methane_data (methane_data_file_id,recorded_at,latitude,longitude,methane) values (%s,%s,%s,%s,%s)',
-                           'with_get_id' :False,
-                           'parms':(metadata_for_the_file.methane_data_file_id,
-                                    netCDF4.num2date(metadata_for_the_file.ds['time'][lat, lon].item(),
-                                                            units=times['units'],
-                                                            calendar=times['calendar'],
-                                                            only_use_cftime_datetimes=False),
-                                  metadata_for_the_file.ds['lat'][lat].item(),
-                                  metadata_for_the_file.ds['lon'][lon].item(),
-                                  metadata_for_the_file.ds['xch4'][lat, lon].item(),)}
-                if nodb:
-                    print(my_parms)
-                elif batch_commits:
-                    db.insert_continuous(**my_parms)
-                    if records_inserted and records_inserted%batch_commits == 0:
-                        db.commit()
-                else:
-                    db.insert(**my_parms)
-                records_inserted+=1
-            if maxrecords and records_inserted>maxrecords:
-                end_time = datetime.now()
-                duration = end_time - start_time
-                print(f"""
-                        start time={start_time}            
-                        end time={end_time}            
-                        mean records per second={records_inserted /duration.seconds}            
-                            """)
-                sys.exit()
-    end_time = datetime.now()
-    duration = end_time - start_time
-    print(f'inserted {records_inserted} records from file {file_name}.  Time required={duration}')
-    if verbose:
-        print(f"""
-    start time={start_time}            
-    end time={end_time}            
-    mean records per second={records_inserted/duration.seconds}            
-        """)
-    return records_inserted
+    file_name=file_columns['file_name']
+    upsert_str=(f'INSERT INTO methane_data_file ({",".join(file_columns)}) '
+                f'values ({",".join(["%s"]*len(file_columns))}) '
+                f'ON CONFLICT (file_name) DO UPDATE SET '
+                f'{"".join(f"{column}=EXCLUDED.{column}," for column in file_columns if column!="file_name")}'
+                f'processed_at=CURRENT_TIMESTAMP RETURNING methane_data_file_id')
+    with get_db(args,pool) as db:
+        methane_data_file_id=db.insert_continuous(insert_str=upsert_str,with_get_id=True,parms=tuple(file_columns.values()))
+        db.insert_continuous(insert_str='DELETE FROM methane_data WHERE methane_data_file_id=%s',
+                             parms=(methane_data_file_id,))
+        if args.get('storage')=='cell':
+            db.insert_continuous(insert_str='DELETE FROM methane_cell_data WHERE methane_data_file_id=%s',
+                                 parms=(methane_data_file_id,))
+        for table in variable_map_from_args(args).tables():
+            db.insert_continuous(insert_str=f'DELETE FROM {table} WHERE methane_data_file_id=%s',
+                                 parms=(methane_data_file_id,))
+        rollup=rollup_spec_from_args(args)
+        if rollup is not None:
+            remove_file_rollups(db=db,methane_data_file_id=methane_data_file_id,spec=rollup)
+        db.insert_continuous(insert_str='DELETE FROM methane_ingest_progress WHERE methane_data_file_id=%s',
+                             parms=(methane_data_file_id,))
+        db.insert_continuous(insert_str='UPDATE methane_data_file SET completed_at=NULL WHERE methane_data_file_id=%s',
+                             parms=(methane_data_file_id,))
+        db.commit()
+    return metadata_for_file(file_name=file_name,
+                             ds=ds,
+                             num_lats=ds.dimensions.get('lat').size,
+                             num_lons=ds.dimensions.get('lon').size,
+                             methane_data_file_id=methane_data_file_id,
+                             processed=True)
 
 
 
-def add_methane_by_year_record(fileline:str,
-                               index:int,
-            args:dict[str,str],
-            nodb:bool=False,
-            verbose:bool=False)->int:
+def file_rows_source(methane_data_file_id:int,cells:bool=False)->str:
+    """
+    The file's loaded rows, with recorded_at, latitude, longitude and methane, as a
+    source for rollup_from_table
+    """
+    table='methane_cell_data_located' if cells else 'methane_data'
+    return f'(SELECT * FROM {table} WHERE methane_data_file_id={int(methane_data_file_id)}) AS file_rows'
+
+
+
+def stage_table_name(methane_data_file_id:int)->str:
+    return f'methane_replace_{methane_data_file_id}'
+
+
+
+def stage_file_record(ds:nc.Dataset,
+                      file_columns:dict[str,str],
+                      args:dict[str,str],
+                      pool:DbPool|None=None)->metadata_for_file|None:
     """
+    -replace: when the file is already recorded, create empty unlogged staging tables
+    shaped like the tables its rows go to, and load into those.  Its current rows stay
+    as they are until swap_in_staged_file.  None when the file is new, to load it as usual
+    :param ds:
+    :param file_columns: methane_data_file column -> value, including file_name
+    :param args:
+    :param pool:
+    """
+    file_name=file_columns['file_name']
+    with get_db(args,pool) as db:
+        file_rows=db.query('SELECT methane_data_file_id FROM methane_data_file WHERE file_name=%s',(file_name,))
+        if len(file_rows)==0:
+            return None
+        methane_data_file_id=file_rows[0].methane_data_file_id
+        stage_table=stage_table_name(methane_data_file_id)
+        target='methane_cell_data' if args.get('storage')=='cell' else 'methane_data'
+        # a staging table left by an interrupted replace holds part of a load: start again
+        for table,staged in [(target,stage_table)]+[(table,staged_variable_table(stage_table,table))
+                                                    for table in variable_map_from_args(args).tables()]:
+            db.insert_continuous(insert_str=f'DROP TABLE IF EXISTS {staged}')
+            db.insert_continuous(insert_str=f'CREATE UNLOGGED TABLE {staged} (LIKE {table} INCLUDING DEFAULTS)')
+        db.commit()
+    print(f'replacing {file_name}: loading into {stage_table}')
+    return metadata_for_file(file_name=file_name,
+                             ds=ds,
+                             num_lats=ds.dimensions.get('lat').size,
+                             num_lons=ds.dimensions.get('lon').size,
+                             methane_data_file_id=methane_data_file_id,
+                             processed=True,
+                             stage_table=stage_table,
+                             file_columns=file_columns)
+
+
 
+def swap_in_staged_file(metadata_for_the_file:metadata_for_file,
+                        args:dict[str,str],
+                        pool:DbPool|None=None,
+                        metrics:Metrics|None=None)->None:
     """
-   # see if there is an associated xml file, and if so then process it
-    records_inserted=0
-    if index==0:
-        return 0
-    vals=fileline.split(",")
-    entity=vals[0]
-    code=vals[1]
-    year=vals[2]
-    quantity=vals[3]
-    if len(entity)==0 or len(year)==0 or len(quantity)==0:
-        print(f'problem with line {index}, which looked like this={fileline}.')
-        sys.exit(1)
-    country_id =Db(args=args).query("SELECT methane_data_by_country_id FROM methane_data_by_country WHERE country_name=%s",(entity,))
-    if len(country_id)==0:
-        country_id = Db(args=args).insert(insert_str=f'INSERT INTO methane_data_by_country (country_name) values (%s) RETURNING methane_data_by_country_id',
-                                          with_get_id=True,
-                                          parms=(entity,))
-    cid=country_id if isinstance(country_id,int) else (country_id[0]).methane_data_by_country_id #if type(country_id)==int else country_id[0]
+    -replace: in one transaction, swap the file's old rows, and those of its -variables
+    tables, for the staged ones, redo its rollups from them at every resolution it rolled
+    up to before and at the current -rollup, refresh its
+    methane_data_file columns and drop the staging tables.
+    Readers see the old rows until the commit and the new ones after it
+    """
+    methane_data_file_id=metadata_for_the_file.methane_data_file_id
+    stage_table=metadata_for_the_file.stage_table
+    file_columns=metadata_for_the_file.file_columns
+    cells=args.get('storage')=='cell'
+    with timed(metrics,'replace_swap'), get_db(args,pool,metrics) as db:
+        if not cells and is_partitioned(db):
+            # partitions are created outside the swap, as a tile's are before it is written
+            months=[row.month for row in db.query(f"SELECT DISTINCT to_char(recorded_at,'YYYY-MM') AS month FROM {stage_table}")]
+            month_tables(db=db,months=months)
+        # a second replace of the same file waits here until this one commits
+        db.query('SELECT methane_data_file_id FROM methane_data_file WHERE methane_data_file_id=%s FOR UPDATE',
+                 (methane_data_file_id,))
+        db.insert_continuous(insert_str='DELETE FROM methane_data WHERE methane_data_file_id=%s',
+                             parms=(methane_data_file_id,))
+        if cells:
+            db.insert_continuous(insert_str='DELETE FROM methane_cell_data WHERE methane_data_file_id=%s',
+                                 parms=(methane_data_file_id,))
+            columns=",".join(METHANE_CELL_DATA_COLUMNS)
+            db.insert_continuous(insert_str=f'INSERT INTO methane_cell_data ({columns}) SELECT {columns} FROM {stage_table}')
+        else:
+            columns=",".join(('methane_data_id',)+METHANE_DATA_COLUMNS)
+            db.insert_continuous(insert_str=f'INSERT INTO methane_data ({columns}) SELECT {columns} FROM {stage_table}')
+        for table,specs in variable_map_from_args(args).tables().items():
+            staged=staged_variable_table(stage_table,table)
+            columns=",".join((VARIABLE_CELL_KEY_COLUMNS if cells else VARIABLE_KEY_COLUMNS)+tuple(spec.column for spec in specs))
+            db.insert_continuous(insert_str=f'DELETE FROM {table} WHERE methane_data_file_id=%s',
+                                 parms=(methane_data_file_id,))
+            db.insert_continuous(insert_str=f'INSERT INTO {table} ({columns}) SELECT {columns} FROM {staged}')
+            db.insert_continuous(insert_str=f'DROP TABLE {staged}')
+        rollups=file_rollup_specs(db=db,methane_data_file_id=methane_data_file_id)
+        rollup=rollup_spec_from_args(args)
+        if rollup is not None and rollup not in rollups:
+            rollups.append(rollup)
+        remove_file_rollups(db=db,methane_data_file_id=methane_data_file_id)
+        for rollup in rollups:
+            rollup_from_table(db=db,
+                              methane_data_file_id=methane_data_file_id,
+                              source=f'{stage_table} JOIN grid_cell USING (cell_id)' if cells else stage_table,
+                              spec=rollup)
+        columns=[column for column in file_columns if column!='file_name']
+        db.insert_continuous(insert_str=f'UPDATE methane_data_file SET {"".join(f"{column}=%s," for column in columns)}'
+                                        'processed_at=CURRENT_TIMESTAMP,completed_at=CURRENT_TIMESTAMP '
+                                        'WHERE methane_data_file_id=%s',
+                             parms=tuple(file_columns[column] for column in columns)+(methane_data_file_id,))
+        db.insert_continuous(insert_str='DELETE FROM methane_ingest_progress WHERE methane_data_file_id=%s',
+                             parms=(methane_data_file_id,))
+        db.insert_continuous(insert_str=f'DROP TABLE {stage_table}')
+        db.commit()
+
+
+
+def drop_staged_file(metadata_for_the_file:metadata_for_file,
+                     args:dict[str,str],
+                     pool:DbPool|None=None)->None:
+    """
+    -replace cut short by -maxrecords: throw the staged rows away and keep the file's
+    current rows, as a part of a granule is never swapped in
+    """
+    stage_table=metadata_for_the_file.stage_table
+    with get_db(args,pool) as db:
+        for table in [stage_table]+[staged_variable_table(stage_table,table) for table in variable_map_from_args(args).tables()]:
+            db.insert_continuous(insert_str=f'DROP TABLE IF EXISTS {table}')
+        db.commit()
 
-    db=Db(args=args)
-    insert_str = 'INSERT INTO methane_data_by_country_by_year (methane_data_by_country_id,year,carbon_tons) values (%s,%s,%s)'
 
-    parms=(cid, int(year), float(quantity),)
-    db.insert(insert_str=insert_str,with_get_id=False,parms=parms)
-    return 1
 
+def resume_file_record(file_name:str,
+                       ds:nc.Dataset,
+                       args:dict[str,str],
+                       verbose:bool=False,
+                       pool:DbPool|None=None)->metadata_for_file:
+    """
+    The file is already recorded.  Skip it if its load completed, otherwise pick up the
+    tiles its interrupted load committed so only the rest are loaded
+    """
+    with get_db(args,pool) as db:
+        file_rows=db.query('SELECT methane_data_file_id,completed_at FROM methane_data_file WHERE file_name=%s',(file_name,))
+        if len(file_rows)==0 or file_rows[0].completed_at is not None:
+            if verbose:
+                print(f" skipping {file_name} because we have already loaded it")
+            return metadata_for_file(file_name=file_name)
+        methane_data_file_id=file_rows[0].methane_data_file_id
+        progress=db.query('SELECT tile_index,tile_size FROM methane_ingest_progress WHERE methane_data_file_id=%s',
+                          (methane_data_file_id,))
+    print(f'resuming {file_name}: {len(progress)} tiles were already loaded')
+    return metadata_for_file(file_name=file_name,
+                             ds=ds,
+                             num_lats=ds.dimensions.get('lat').size,
+                             num_lons=ds.dimensions.get('lon').size,
+                             methane_data_file_id=methane_data_file_id,
+                             processed=True,
+                             completed_tiles=frozenset(row.tile_index for row in progress),
+                             tile_size=progress[0].tile_size if len(progress) else 0)
 
 
 
+def loaded_file_names(args:dict[str,str],pool:DbPool|None=None)->set[str]:
+    """
+    Every file whose load has completed, fetched in one query
+    """
+    with get_db(args,pool) as db:
+        return {row.file_name for row in db.query('SELECT file_name FROM methane_data_file WHERE completed_at IS NOT NULL')}
 
 
 
-def methane_by_year(file_name:str,args:dict[str,str])->int:
-    recs_processed=0
-    f=""
-    i=0
-    if not path.exists(file_name):
-        print(f'could not find file {file_name}')
-        return
-    try:
-        with open(file_name, 'r') as file:
-            for index,line in enumerate(file):
-                # Process each line here
-                f=line
-                i=index
-                recs_processed=+add_methane_by_year_record(fileline=line.strip(),
-                                                           index=index,
-                                                           args=args)
-    except Exception as e:
-        print(f"An error occurred: {e}")
-        print(f"line={f}, line num={i}")
-    return recs_processed
+def mark_file_complete(methane_data_file_id:int,
+                       args:dict[str,str],
+                       pool:DbPool|None=None,
+                       metrics:Metrics|None=None)->None:
+    """
+    Flag the file as fully loaded and drop its tile checkpoints, together.  Rollups
+    at resolutions other than the current -rollup, left over from an earlier load of
+    the file, are rebuilt from its rows in the same transaction
+    """
+    with get_db(args,pool,metrics) as db:
+        rollup=rollup_spec_from_args(args)
+        previous=[spec for spec in file_rollup_specs(db=db,methane_data_file_id=methane_data_file_id) if spec!=rollup]
+        if previous:
+            rebuild_file_rollups(db=db,
+                                 methane_data_file_id=methane_data_file_id,
+                                 source=file_rows_source(methane_data_file_id,cells=args.get('storage')=='cell'),
+                                 specs=previous)
+        db.insert_continuous(insert_str='UPDATE methane_data_file SET completed_at=CURRENT_TIMESTAMP WHERE methane_data_file_id=%s',
+                             parms=(methane_data_file_id,))
+        db.insert_continuous(insert_str='DELETE FROM methane_ingest_progress WHERE methane_data_file_id=%s',
+                             parms=(methane_data_file_id,))
+        db.commit()
+
+
+
+def group_tiles(batches:Iterable[methane_batch]):
+    """
+    Collect the batches of each tile into a list
+    """
+    tile=[]
+    for batch in batches:
+        tile.append(batch)
+        if batch.last_in_tile:
+            yield tile
+            tile=[]
+    if len(tile):
+        yield tile
+
 
 
+class RecordLimit:
+    """
+    -maxrecords: passes batches through until maxrecords rows have gone (0 for no
+    limit), finishing the tile the limit falls in.  Only whole tiles are written, so
+    every committed row is in a checkpointed tile and a later run resumes cleanly;
+    reached tells the caller the file was stopped early and is not complete
+    """
+    def __init__(self,maxrecords:int=0):
+        self.maxrecords=maxrecords
+        self.reached=False
+
+    def batches(self,batches:Iterable[methane_batch]):
+        emitted=0
+        for batch in batches:
+            emitted+=len(batch)
+            yield batch
+            if self.maxrecords and emitted>=self.maxrecords and batch.last_in_tile:
+                self.reached=True
+                return
 
 
 
+def limit_batches(batches:Iterable[methane_batch],maxrecords:int=0):
+    """
+    Pass batches through until maxrecords rows have gone, finishing the last tile
+    """
+    return RecordLimit(maxrecords).batches(batches)
 
 
 
-def process(file_names:list[str],
+def methane_specific(file_name:str,
             args:dict[str,str],
             batch_commits:int=0,
             nodb:bool=False,
-            verbose:bool=False):
-    run_start_time = datetime.now()
+            maxrecords:int=0,
+            verbose:bool=False,
+            pool:DbPool|None=None,
+            metrics:Metrics|None=None):
+    """
+    After loading the main data file, load all the records
+    :param file_name:
+    :param args:
+    :param batch_commits: no longer used; rows are committed once per tile
+    :param nodb:
+    :param maxrecords:
+    :param verbose:
+    :param pool: the run's connection pool, if any
+    :param metrics: collects the file's stage timings and counters
+    :return:
+    """
+    metadata_for_the_file=add_file_record(file_name=file_name,
+                                            args=args,
+                                            nodb=nodb,
+                                            verbose=verbose,
+                                            pool=pool,
+                                            metrics=metrics)
+    if not metadata_for_the_file.processed:
+        return 0
     start_time = datetime.now()
-    maxrecords = int(args.get('maxrecords',0))
-    if verbose:
-        print(f"Ready to process {len(file_names)} files.  Start time = {start_time}")
-        if not nodb:
-            print("db updates will be attempted")
-    if nodb:
-        print("No db updates will be attempted")
-    total_records=0
-    files_processed=0
-    for file_name in file_names:
-        if args.get("csv",0):
-            records_inserted=methane_by_year(file_name=file_name,args=args)
+    records_inserted = 0
+    # a resumed load has to walk the tiles exactly as the interrupted one did
+    tile_size=metadata_for_the_file.tile_size or int(args.get('tile_size',DEFAULT_TILE_SIZE))
+    limit=RecordLimit(maxrecords)
+    tiles=group_tiles(limit.batches(iter_methane_batches(metadata_for_the_file.ds,
+                                                         batch_size=int(args.get('batch_size',DEFAULT_BATCH_SIZE)),
+                                                         tile_size=tile_size,
+                                                         subset=grid_subset(bbox=args.get('bbox'),
+                                                                            since=args.get('since'),
+                                                                            until=args.get('until')),
+                                                         skip_tiles=metadata_for_the_file.completed_tiles,
+                                                         metrics=metrics,
+                                                         variables=variable_map_from_args(args))))
+    write_tile=lambda sink,batches:sink.write_tile(methane_data_file_id=metadata_for_the_file.methane_data_file_id,
+                                                   batches=batches,
+                                                   tile_size=tile_size)
+    grid=None
+    if not nodb and args.get('storage')=='cell':
+        with timed(metrics,'grid_lookup'), get_db(args,pool,metrics) as db:
+            lats,lons=grid_coordinates(metadata_for_the_file.ds)
+            grid=register_grid(db=db,lats=lats,lons=lons)
+    sink=open_sink(args=args,
+                   file_name=file_name,
+                   pool=pool,
+                   metrics=metrics,
+                   grid=grid,
+                   stage_table=metadata_for_the_file.stage_table or None)
+    try:
+        if args.get('pipeline',False):
+            records_inserted=run_pipeline(batches=tiles,
+                                          write=write_tile,
+                                          open_resource=sink.for_writer,
+                                          queue_depth=int(args.get('queue_depth',4)),
+                                          writers=int(args.get('writers',1)))
         else:
-            records_inserted=methane_specific(file_name=file_name,
-                        args=args,
-                        batch_commits=batch_commits,
-                        nodb=nodb,
-                        maxrecords=maxrecords,
-                        verbose=verbose)
-        total_records += records_inserted
-        files_processed += 1
-    run_end_time = datetime.now()
-    duration = run_end_time - run_start_time
-    print(f'run completed at {run_end_time}.')
+            for batches in tiles:
+                records_inserted+=write_tile(sink,batches)
+    finally:
+        sink.close()
+    if limit.reached and metadata_for_the_file.stage_table:
+        print(f'stopped {file_name} at -maxrecords {maxrecords}: part of a granule is not swapped in, its rows are unchanged')
+        drop_staged_file(metadata_for_the_file=metadata_for_the_file,args=args,pool=pool)
+    elif limit.reached and not nodb:
+        # a later run without -maxrecords resumes after the tiles written here
+        print(f'stopped {file_name} at -maxrecords {maxrecords}: its load is left incomplete')
+    elif metadata_for_the_file.stage_table:
+        swap_in_staged_file(metadata_for_the_file=metadata_for_the_file,
+                            args=args,
+                            pool=pool,
+                            metrics=metrics)
+    elif not nodb:
+        mark_file_complete(methane_data_file_id=metadata_for_the_file.methane_data_file_id,
+                           args=args,
+                           pool=pool,
+                           metrics=metrics)
+    counted(metrics,'rows_written',records_inserted)
+    end_time = datetime.now()
+    duration = end_time - start_time
+    print(f'inserted {records_inserted} records from file {file_name}.  Time required={duration}')
     if verbose:
         print(f"""
-    number of files processed: {files_processed}    
-    run start time={run_start_time}            
-    run end time={run_end_time}            
-    mean records per second={total_records / duration.seconds}            
-         """)
+    start time={start_time}            
+    end time={end_time}            
+    mean records per second={rate(records_inserted,duration.total_seconds())}            
+        """)
+    return records_inserted
+
 
 
 #
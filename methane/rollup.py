@@ -0,0 +1,192 @@
+from dataclasses import dataclass, field
+import numpy as np
+from methane.extraction import methane_batch
+from core.database import Db
+
+# -rollup_bucket -> the numpy unit recorded_at is floored to
+TIME_BUCKETS = {'hour':'datetime64[h]', 'day':'datetime64[D]', 'month':'datetime64[M]'}
+ROLLUP_KEY = ('resolution','time_bucket','bucket_start','lat_bin','lon_bin')
+ROLLUP_COLUMNS = ROLLUP_KEY + ('cell_count','methane_sum','methane_min','methane_max')
+
+
+
+@dataclass
+class rollup_spec:
+    """
+    The grid and time bucket methane is rolled up to: resolution degree bins, per time_bucket
+    """
+    resolution: float = 1.0
+    time_bucket: str = 'day'
+
+
+
+@dataclass
+class rollup_bins:
+    """
+    count, sum, min and max of methane per (bucket_start, lat_bin, lon_bin), sorted by key
+    """
+    bucket_start: np.ndarray = field(default_factory=lambda: np.empty(0, dtype='datetime64[us]'))
+    lat_bin: np.ndarray = field(default_factory=lambda: np.empty(0, dtype='int64'))
+    lon_bin: np.ndarray = field(default_factory=lambda: np.empty(0, dtype='int64'))
+    count: np.ndarray = field(default_factory=lambda: np.empty(0, dtype='int64'))
+    total: np.ndarray = field(default_factory=lambda: np.empty(0, dtype='float64'))
+    minimum: np.ndarray = field(default_factory=lambda: np.empty(0, dtype='float64'))
+    maximum: np.ndarray = field(default_factory=lambda: np.empty(0, dtype='float64'))
+
+    def __len__(self)->int:
+        return len(self.count)
+
+    def rows(self, spec:rollup_spec):
+        """
+        Yield one parameter tuple per bin, in ROLLUP_COLUMNS order
+        """
+        yield from zip([spec.resolution]*len(self),
+                       [spec.time_bucket]*len(self),
+                       self.bucket_start.tolist(),
+                       self.lat_bin.tolist(),
+                       self.lon_bin.tolist(),
+                       self.count.tolist(),
+                       self.total.tolist(),
+                       self.minimum.tolist(),
+                       self.maximum.tolist())
+
+
+
+def rollup_spec_from_args(args:dict[str,str])->rollup_spec|None:
+    """
+    The -rollup / -rollup_bucket settings, or None when rollups are off
+    """
+    resolution = float(args.get('rollup') or 0)
+    if resolution <= 0:
+        return None
+    return rollup_spec(resolution=resolution, time_bucket=args.get('rollup_bucket') or 'day')
+
+
+
+def bin_batches(batches:list[methane_batch], spec:rollup_spec)->rollup_bins:
+    """
+    Aggregate the cells of the batches onto the spec's bins in a few array passes
+    """
+    batches = [batch for batch in batches if len(batch)]
+    if len(batches) == 0:
+        return rollup_bins()
+    recorded_at = np.concatenate([batch.recorded_at for batch in batches])
+    latitude = np.concatenate([batch.latitude for batch in batches])
+    longitude = np.concatenate([batch.longitude for batch in batches])
+    methane = np.concatenate([batch.methane for batch in batches])
+    keys = np.stack([recorded_at.astype(TIME_BUCKETS[spec.time_bucket]).astype('int64'),
+                     np.floor((latitude + 90) / spec.resolution).astype('int64'),
+                     np.floor((longitude + 180) / spec.resolution).astype('int64')], axis=1)
+    unique_keys, inverse = np.unique(keys, axis=0, return_inverse=True)
+    inverse = inverse.reshape(-1)
+    order = np.argsort(inverse, kind='stable')
+    starts = np.flatnonzero(np.r_[True, np.diff(inverse[order]) != 0])
+    in_order = methane[order]
+    return rollup_bins(bucket_start=unique_keys[:, 0].astype(TIME_BUCKETS[spec.time_bucket]).astype('datetime64[us]'),
+                       lat_bin=unique_keys[:, 1],
+                       lon_bin=unique_keys[:, 2],
+                       count=np.bincount(inverse),
+                       total=np.bincount(inverse, weights=methane),
+                       minimum=np.minimum.reduceat(in_order, starts),
+                       maximum=np.maximum.reduceat(in_order, starts))
+
+
+
+def upsert_rollup(db:Db,
+                  methane_data_file_id:int,
+                  bins:rollup_bins,
+                  spec:rollup_spec)->None:
+    """
+    Add bins to methane_rollup and to the file's methane_rollup_file contribution.  Not
+    committed: it belongs in the transaction of the rows it summarises.  The bins are
+    sorted, so concurrent writers lock shared rollup rows in the same order
+    """
+    if len(bins) == 0:
+        return
+    key = ",".join(ROLLUP_KEY)
+    rows = list(bins.rows(spec))
+    db.insert_values(insert_str=f'INSERT INTO methane_rollup_file (methane_data_file_id,{",".join(ROLLUP_COLUMNS)}) values %s '
+                                f'ON CONFLICT (methane_data_file_id,{key}) DO UPDATE SET '
+                                'cell_count=methane_rollup_file.cell_count+EXCLUDED.cell_count, '
+                                'methane_sum=methane_rollup_file.methane_sum+EXCLUDED.methane_sum, '
+                                'methane_min=LEAST(methane_rollup_file.methane_min,EXCLUDED.methane_min), '
+                                'methane_max=GREATEST(methane_rollup_file.methane_max,EXCLUDED.methane_max)',
+                     rows=[(methane_data_file_id,)+row for row in rows])
+    db.insert_values(insert_str=f'INSERT INTO methane_rollup ({",".join(ROLLUP_COLUMNS)}) values %s '
+                                f'ON CONFLICT ({key}) DO UPDATE SET '
+                                'cell_count=methane_rollup.cell_count+EXCLUDED.cell_count, '
+                                'methane_sum=methane_rollup.methane_sum+EXCLUDED.methane_sum, '
+                                'methane_min=LEAST(methane_rollup.methane_min,EXCLUDED.methane_min), '
+                                'methane_max=GREATEST(methane_rollup.methane_max,EXCLUDED.methane_max), '
+                                'updated_at=CURRENT_TIMESTAMP',
+                     rows=rows)
+
+
+
+def file_rollup_specs(db:Db,methane_data_file_id:int)->list[rollup_spec]:
+    """
+    Every resolution and time bucket the file has contributed to methane_rollup
+    """
+    if not db.query("SELECT to_regclass('methane_rollup_file') IS NOT NULL AS has_rollups")[0].has_rollups:
+        return []
+    return [rollup_spec(resolution=row.resolution, time_bucket=row.time_bucket)
+            for row in db.query('SELECT DISTINCT resolution,time_bucket FROM methane_rollup_file '
+                                'WHERE methane_data_file_id=%s ORDER BY resolution,time_bucket',
+                                (methane_data_file_id,))]
+
+
+
+def remove_file_rollups(db:Db,methane_data_file_id:int,spec:rollup_spec|None=None)->None:
+    """
+    Take a file's contribution back out of methane_rollup: with no spec all of it, when
+    rollups exist, otherwise only the spec's resolution and time bucket (migration 008).
+    Not committed
+    """
+    if spec is not None:
+        db.query('SELECT methane_rollup_remove_file(%s,%s,%s)',(methane_data_file_id,spec.resolution,spec.time_bucket))
+    elif db.query("SELECT to_regprocedure('methane_rollup_remove_file(integer)') IS NOT NULL AS has_rollups")[0].has_rollups:
+        db.query('SELECT methane_rollup_remove_file(%s)',(methane_data_file_id,))
+
+
+
+def rollup_from_table(db:Db,
+                      methane_data_file_id:int,
+                      source:str,
+                      spec:rollup_spec)->None:
+    """
+    Roll a file's rows up in the database, from source (a table, or a join, with
+    recorded_at, latitude, longitude and methane), onto the same bins bin_batches
+    computes, and add them as upsert_rollup does.  Not committed
+    """
+    key = ",".join(ROLLUP_KEY)
+    db.insert_continuous(insert_str=f'INSERT INTO methane_rollup_file (methane_data_file_id,{",".join(ROLLUP_COLUMNS)}) '
+                                    'SELECT %(file_id)s, %(resolution)s, %(time_bucket)s, date_trunc(%(time_bucket)s,recorded_at), '
+                                    'floor((latitude+90)/%(resolution)s)::int, floor((longitude+180)/%(resolution)s)::int, '
+                                    f'count(*), sum(methane), min(methane), max(methane) FROM {source} GROUP BY 4,5,6',
+                         parms={'file_id':methane_data_file_id,
+                                'resolution':spec.resolution,
+                                'time_bucket':spec.time_bucket})
+    db.insert_continuous(insert_str=f'INSERT INTO methane_rollup ({",".join(ROLLUP_COLUMNS)}) '
+                                    f'SELECT {",".join(ROLLUP_COLUMNS)} FROM methane_rollup_file '
+                                    f'WHERE methane_data_file_id=%s AND resolution=%s AND time_bucket=%s ORDER BY {key} '
+                                    f'ON CONFLICT ({key}) DO UPDATE SET '
+                                    'cell_count=methane_rollup.cell_count+EXCLUDED.cell_count, '
+                                    'methane_sum=methane_rollup.methane_sum+EXCLUDED.methane_sum, '
+                                    'methane_min=LEAST(methane_rollup.methane_min,EXCLUDED.methane_min), '
+                                    'methane_max=GREATEST(methane_rollup.methane_max,EXCLUDED.methane_max), '
+                                    'updated_at=CURRENT_TIMESTAMP',
+                         parms=(methane_data_file_id,spec.resolution,spec.time_bucket,))
+
+
+
+def rebuild_file_rollups(db:Db,
+                         methane_data_file_id:int,
+                         source:str,
+                         specs:list[rollup_spec])->None:
+    """
+    Swap the file's contribution at each spec for one rolled up from source, as
+    rollup_from_table does.  Not committed
+    """
+    for spec in specs:
+        remove_file_rollups(db=db,methane_data_file_id=methane_data_file_id,spec=spec)
+        rollup_from_table(db=db,methane_data_file_id=methane_data_file_id,source=source,spec=spec)
@@ -0,0 +1,236 @@
+import tracemalloc
+from dataclasses import dataclass
+from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor,as_completed
+from multiprocessing.util import Finalize
+from time import perf_counter
+from core.database import DbPool,get_db
+from core.metrics import Metrics,rate,write_report
+
+# Running a set of files, netCDF granules or countries-by-year csv files, sequentially
+# or over worker processes.  The loaders are imported when a file of their kind comes
+# up, so a csv run never imports netCDF
+
+
+
+@dataclass
+class file_result:
+    file_name: str = ''
+    records: int = 0
+    error: str = ''
+    seconds: float = 0.0
+    metrics: dict|None = None
+
+
+
+def process_one_file(file_name:str,
+                     args:dict[str,str],
+                     batch_commits:int=0,
+                     nodb:bool=False,
+                     maxrecords:int=0,
+                     verbose:bool=False,
+                     pool:DbPool|None=None,
+                     country_cache:dict[str,int]|None=None)->file_result:
+    """
+    Load one file, catching whatever goes wrong so the rest of the run can carry on
+    """
+    metrics=Metrics(name=file_name)
+    metrics.start_memory()
+    start=perf_counter()
+    error=''
+    records_inserted=0
+    try:
+        if args.get("csv",0):
+            from methane.by_year import methane_by_year
+            records_inserted=methane_by_year(file_name=file_name,args=args,pool=pool,country_cache=country_cache,metrics=metrics)
+        else:
+            from methane.process_a_file import methane_specific
+            records_inserted=methane_specific(file_name=file_name,
+                        args=args,
+                        batch_commits=batch_commits,
+                        nodb=nodb,
+                        maxrecords=maxrecords,
+                        verbose=verbose,
+                        pool=pool,
+                        metrics=metrics)
+    except Exception as e:
+        print(f"Could not process file {file_name}, problem={e}")
+        error=str(e)
+    metrics.stop_memory()
+    return file_result(file_name=file_name,
+                       records=records_inserted,
+                       error=error,
+                       seconds=perf_counter()-start,
+                       metrics=metrics.to_dict())
+
+
+
+def pool_size_needed(args:dict[str,str])->int:
+    """
+    Connections one process needs at once: the file record plus one per pipeline writer
+    """
+    return 1+int(args.get('writers',1)) if args.get('pipeline',False) else 1
+
+
+
+# each worker process of a -workers run keeps its own connection and country cache
+_worker_pool:DbPool|None=None
+_worker_country_cache:dict[str,int]={}
+
+def _init_worker(args:dict[str,str],nodb:bool)->None:
+    global _worker_pool
+    if args.get('metrics_out') and not tracemalloc.is_tracing():
+        tracemalloc.start()
+    if not nodb:
+        _worker_pool=DbPool(args=args,size=pool_size_needed(args))
+        Finalize(_worker_pool,_worker_pool.close,exitpriority=10)
+
+def _process_in_worker(file_name:str,
+                       args:dict[str,str],
+                       batch_commits:int,
+                       nodb:bool,
+                       maxrecords:int,
+                       verbose:bool)->file_result:
+    return process_one_file(file_name=file_name,
+                            args=args,
+                            batch_commits=batch_commits,
+                            nodb=nodb,
+                            maxrecords=maxrecords,
+                            verbose=verbose,
+                            pool=_worker_pool,
+                            country_cache=_worker_country_cache)
+
+
+
+def process(file_names:list[str],
+            args:dict[str,str],
+            batch_commits:int=0,
+            nodb:bool=False,
+            verbose:bool=False,
+            pool:DbPool|None=None,
+            executor:ProcessPoolExecutor|None=None)->list[file_result]:
+    """
+    Load every file in file_names
+    :param file_names:
+    :param args: -workers N spreads the files over N processes, each with its own connection
+    :param batch_commits:
+    :param nodb:
+    :param verbose:
+    :param pool: connection pool created by the caller for the whole run.  Without one
+                 each file opens (and closes) its own connections
+    :param executor: worker processes, started with _init_worker, to reuse instead of
+                     starting -workers new ones for this call
+    :return: one result per file
+    """
+    run_start_time = datetime.now()
+    start_time = datetime.now()
+    maxrecords = int(args.get('maxrecords',0))
+    workers = int(args.get('workers',0) or 0)
+    if verbose:
+        print(f"Ready to process {len(file_names)} files.  Start time = {start_time}")
+        if not nodb:
+            print("db updates will be attempted")
+    if nodb:
+        print("No db updates will be attempted")
+    results:list[file_result]=[]
+    if args.get('metrics_out') and not tracemalloc.is_tracing():
+        # peak memory per file; costs some speed, so only when a report was asked for
+        tracemalloc.start()
+    if not nodb and not args.get("csv",0) and not args.get("force",False) and not args.get("replace",False):
+        # skip what's already loaded before any dataset or sidecar is opened
+        from methane.process_a_file import loaded_file_names
+        loaded=loaded_file_names(args=args,pool=pool)
+        skipped=[file_name for file_name in file_names if file_name in loaded]
+        if len(skipped):
+            print(f"skipping {len(skipped)} files that have already been loaded.  Use -force or -replace to reload them")
+            if verbose:
+                for file_name in skipped:
+                    print(f" skipping {file_name} because we have already loaded it")
+        file_names=[file_name for file_name in file_names if file_name not in loaded]
+    stage_lock=None
+    if not nodb and not args.get("csv",0):
+        from methane.partitions import adopt_staged_partitions
+        with get_db(args,pool) as db:
+            adopted=adopt_staged_partitions(db)
+        if adopted:
+            print(f'attached {adopted} staging tables left behind by -defer_indexes runs that stopped early')
+        if args.get("defer_indexes",False):
+            # this run's staging tables are named for it, and locked while it runs, so
+            # only it attaches them, or a later run once it has died
+            from methane.partitions import new_stage_run,hold_stage_run
+            args={**args,'stage_run':new_stage_run()}
+            stage_lock=hold_stage_run(args,args['stage_run'])
+    try:
+        if workers>1 and len(file_names)>1:
+            run_executor=executor or ProcessPoolExecutor(max_workers=workers,
+                                                         initializer=_init_worker,
+                                                         initargs=(args,nodb,))
+            try:
+                futures={run_executor.submit(_process_in_worker,
+                                             file_name,
+                                             args,
+                                             batch_commits,
+                                             nodb,
+                                             maxrecords,
+                                             verbose):file_name for file_name in file_names}
+                for future in as_completed(futures):
+                    try:
+                        results.append(future.result())
+                    except Exception as e:
+                        print(f"Could not process file {futures[future]}, problem={e}")
+                        results.append(file_result(file_name=futures[future],error=str(e)))
+            finally:
+                if executor is None:
+                    run_executor.shutdown()
+        else:
+            country_cache={}
+            for file_name in file_names:
+                results.append(process_one_file(file_name=file_name,
+                                                args=args,
+                                                batch_commits=batch_commits,
+                                                nodb=nodb,
+                                                maxrecords=maxrecords,
+                                                verbose=verbose,
+                                                pool=pool,
+                                                country_cache=country_cache))
+    finally:
+        if stage_lock is not None:
+            from methane.partitions import attach_staged_partitions
+            try:
+                with get_db(args,pool) as db:
+                    attached=attach_staged_partitions(db,args['stage_run'])
+                print(f'attached {attached} new month partitions to methane_data')
+            finally:
+                stage_lock.close()
+    total_records=sum(result.records for result in results)
+    files_processed=len(results)
+    failures=[result for result in results if result.error]
+    run_end_time = datetime.now()
+    duration = run_end_time - run_start_time
+    print(f'run completed at {run_end_time}.  {files_processed} files, {total_records} records, {len(failures)} failures.')
+    for failure in failures:
+        print(f'  failed: {failure.file_name}: {failure.error}')
+    if verbose:
+        print(f"""
+    number of files processed: {files_processed}    
+    run start time={run_start_time}            
+    run end time={run_end_time}            
+    mean records per second={rate(total_records,duration.total_seconds())}            
+         """)
+    if args.get('metrics_out'):
+        write_report(path=args['metrics_out'],
+                     file_reports=[{"file_name":result.file_name,
+                                    "records":result.records,
+                                    "error":result.error,
+                                    "seconds":result.seconds,
+                                    "rows_per_second":rate(result.records,result.seconds),
+                                    **(result.metrics or {})} for result in results],
+                     run_report={"files":files_processed,
+                                 "failures":len(failures),
+                                 "records":total_records,
+                                 "seconds":duration.total_seconds(),
+                                 "rows_per_second":rate(total_records,duration.total_seconds()),
+                                 "workers":workers,
+                                 "writer":args.get('writer','copy'),
+                                 "pipeline":bool(args.get('pipeline',False))})
+    return results
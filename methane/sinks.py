@@ -0,0 +1,469 @@
+import csv
+from abc import ABC, abstractmethod
+import json
+import os
+import threading
+from os import path
+import numpy as np
+from methane.extraction import methane_batch,METHANE_DATA_COLUMNS,METHANE_CELL_DATA_COLUMNS
+from methane.grid import grid_index
+from methane.rollup import rollup_spec,rollup_spec_from_args,bin_batches,upsert_rollup
+from methane.partitions import is_partitioned,batch_months,month_tables,route_batch
+from methane.variables import variable_map,variable_spec,variable_map_from_args,staged_variable_table,VARIABLE_KEY_COLUMNS,VARIABLE_CELL_KEY_COLUMNS
+from core.database import Db,DbPool,get_db
+from core.metrics import Metrics
+
+SINK_NAMES = ('postgres','null','ndjson','csv','preview','parquet','arrow')
+FILE_SINK_COLUMNS = ('file_name','recorded_at','latitude','longitude','methane')
+
+
+def write_methane_batch(db:Db,
+                        methane_data_file_id:int,
+                        batch:methane_batch,
+                        writer:str='copy',
+                        copy_format:str='text',
+                        table:str|None=None,
+                        grid:grid_index|None=None)->int:
+    """
+    Write one extracted batch to methane_data.  Not committed
+    :param db:
+    :param methane_data_file_id:
+    :param batch:
+    :param writer: copy (COPY FROM STDIN), values (multi-row INSERT) or insert (one INSERT per row)
+    :param copy_format: text or binary, for the copy writer
+    :param table: methane_data (or methane_cell_data with a grid) when None, a month's staging
+                  table during a -defer_indexes load, or the file's -replace staging table
+    :param grid: the file's grid, to write compact rows to methane_cell_data instead (-storage cell)
+    :return: rows written
+    """
+    if grid is not None:
+        write_methane_cells(db=db,
+                            methane_data_file_id=methane_data_file_id,
+                            batch=batch,
+                            cell_ids=grid.cell_ids(batch.latitude,batch.longitude),
+                            writer=writer,
+                            copy_format=copy_format,
+                            table=table or 'methane_cell_data')
+        return len(batch)
+    table=table or 'methane_data'
+    if writer == 'copy':
+        binary = copy_format == 'binary'
+        db.copy_from(table=table,
+                     columns=METHANE_DATA_COLUMNS,
+                     buffer=batch.copy_binary(methane_data_file_id) if binary else batch.copy_text(methane_data_file_id),
+                     binary=binary)
+    elif writer == 'values':
+        db.insert_values(insert_str=f'INSERT INTO {table} ({",".join(METHANE_DATA_COLUMNS)}) values %s',
+                         rows=list(batch.rows(methane_data_file_id)))
+    else:
+        insert_str=f'INSERT INTO {table} ({",".join(METHANE_DATA_COLUMNS)}) values (%s,%s,%s,%s,%s)'
+        for parms in batch.rows(methane_data_file_id):
+            db.insert_continuous(insert_str=insert_str,with_get_id=False,parms=parms)
+    return len(batch)
+
+
+
+def write_methane_cells(db:Db,
+                        methane_data_file_id:int,
+                        batch:methane_batch,
+                        cell_ids,
+                        writer:str='copy',
+                        copy_format:str='text',
+                        table:str='methane_cell_data')->None:
+    """
+    Write one batch to methane_cell_data with write_methane_batch's writers.  Not committed
+    """
+    if writer == 'copy':
+        binary = copy_format == 'binary'
+        db.copy_from(table=table,
+                     columns=METHANE_CELL_DATA_COLUMNS,
+                     buffer=batch.cell_copy_binary(methane_data_file_id,cell_ids) if binary else batch.cell_copy_text(methane_data_file_id,cell_ids),
+                     binary=binary)
+    elif writer == 'values':
+        db.insert_values(insert_str=f'INSERT INTO {table} ({",".join(METHANE_CELL_DATA_COLUMNS)}) values %s',
+                         rows=list(batch.cell_rows(methane_data_file_id,cell_ids)))
+    else:
+        insert_str=f'INSERT INTO {table} ({",".join(METHANE_CELL_DATA_COLUMNS)}) values (%s,%s,%s,%s)'
+        for parms in batch.cell_rows(methane_data_file_id,cell_ids):
+            db.insert_continuous(insert_str=insert_str,with_get_id=False,parms=parms)
+
+
+
+def write_variable_batch(db:Db,
+                         methane_data_file_id:int,
+                         batch:methane_batch,
+                         table:str,
+                         specs:list[variable_spec],
+                         writer:str='copy',
+                         grid:grid_index|None=None)->None:
+    """
+    Write the values of a batch's mapped variables to one of the -variables tables,
+    keyed like the batch's methane rows.  The copy writer always sends text.  Not committed
+    :param table: the table the variables are mapped to, or its -replace staging table
+    :param specs: the table's variables, in column order
+    """
+    if len(batch)==0:
+        return
+    cell_ids=None if grid is None else grid.cell_ids(batch.latitude,batch.longitude)
+    columns=(VARIABLE_KEY_COLUMNS if grid is None else VARIABLE_CELL_KEY_COLUMNS)+tuple(spec.column for spec in specs)
+    if writer == 'copy':
+        db.copy_from(table=table,
+                     columns=columns,
+                     buffer=batch.variable_copy_text(methane_data_file_id,specs,cell_ids),
+                     binary=False)
+    elif writer == 'values':
+        db.insert_values(insert_str=f'INSERT INTO {table} ({",".join(columns)}) values %s',
+                         rows=list(batch.variable_rows(methane_data_file_id,specs,cell_ids)))
+    else:
+        insert_str=f'INSERT INTO {table} ({",".join(columns)}) values ({",".join(["%s"]*len(columns))})'
+        for parms in batch.variable_rows(methane_data_file_id,specs,cell_ids):
+            db.insert_continuous(insert_str=insert_str,with_get_id=False,parms=parms)
+
+
+
+def write_methane_tile(db:Db,
+                       methane_data_file_id:int,
+                       batches:list[methane_batch],
+                       tile_size:int,
+                       writer:str='copy',
+                       copy_format:str='text',
+                       tables:dict[str,str]|None=None,
+                       grid:grid_index|None=None,
+                       rollup:rollup_spec|None=None,
+                       stage_table:str|None=None,
+                       variables:variable_map|None=None)->int:
+    """
+    Write the batches of one tile, their rollups and the tile's checkpoint in a single
+    transaction, so an interrupted load can resume from the last tile that committed
+    :param db:
+    :param methane_data_file_id:
+    :param batches: every batch of the tile, in order
+    :param tile_size: the tile size the file is being read with, recorded for resuming
+    :param writer:
+    :param copy_format:
+    :param tables: month -> table from month_tables, when rows go to more than methane_data
+    :param grid: the file's grid when rows go to methane_cell_data
+    :param rollup: also add the tile's cells to methane_rollup at this resolution and time bucket
+    :param stage_table: -replace: every row goes to this staging table, with no rollups or
+                        checkpoint, which are settled when the staged rows are swapped in
+    :param variables: the -variables map, whose tables other than methane_data get the
+                      batches' other variables
+    :return: rows written
+    """
+    rows=0
+    for batch in batches:
+        routes=[(stage_table,batch)] if stage_table or grid is not None else route_batch(batch,tables)
+        for table,routed in routes:
+            rows+=write_methane_batch(db=db,
+                                      methane_data_file_id=methane_data_file_id,
+                                      batch=routed,
+                                      writer=writer,
+                                      copy_format=copy_format,
+                                      table=table,
+                                      grid=grid)
+        if variables is None:
+            continue
+        for table,specs in variables.tables().items():
+            write_variable_batch(db=db,
+                                 methane_data_file_id=methane_data_file_id,
+                                 batch=batch,
+                                 table=staged_variable_table(stage_table,table) if stage_table else table,
+                                 specs=specs,
+                                 writer=writer,
+                                 grid=grid)
+    if stage_table:
+        db.commit()
+        return rows
+    if rollup is not None:
+        upsert_rollup(db=db,
+                      methane_data_file_id=methane_data_file_id,
+                      bins=bin_batches(batches,rollup),
+                      spec=rollup)
+    if len(batches) and batches[-1].last_in_tile:
+        db.insert_continuous(insert_str='INSERT INTO methane_ingest_progress (methane_data_file_id,tile_index,tile_size,rows_loaded) values (%s,%s,%s,%s)',
+                             parms=(methane_data_file_id,batches[-1].tile_index,tile_size,rows,))
+    db.commit()
+    return rows
+
+
+
+class Sink(ABC):
+    """
+    Where the ingest loop sends extracted tiles.  One sink is opened per file;
+    for_writer() gives each pipeline writer thread what it should write through.
+    """
+    @abstractmethod
+    def write_tile(self,methane_data_file_id:int,batches:list[methane_batch],tile_size:int)->int:
+        """
+        Take every batch of one tile and return the rows accepted
+        """
+
+    def for_writer(self)->'Sink':
+        return _shared_sink(self)
+
+    def close(self)->None:
+        pass
+
+
+
+class _shared_sink(Sink):
+    """
+    A writer thread's handle on a thread-safe sink; closing it leaves the sink open
+    """
+    def __init__(self,sink:Sink):
+        self.sink=sink
+
+    def write_tile(self,methane_data_file_id:int,batches:list[methane_batch],tile_size:int)->int:
+        return self.sink.write_tile(methane_data_file_id,batches,tile_size)
+
+
+
+class PostgresSink(Sink):
+    """
+    methane_data, one transaction per tile.  Each writer thread gets its own connection.
+    When methane_data is partitioned, the partitions a tile needs are created before it
+    is written.  With a grid, rows go to methane_cell_data instead.  With -rollup, each
+    tile's rollups are upserted in the tile's transaction, as are the rows of the other
+    -variables tables.  With a stage_table, every row goes there instead, for a -replace swap
+    """
+    def __init__(self,
+                 args:dict[str,str],
+                 pool:DbPool|None=None,
+                 metrics:Metrics|None=None,
+                 grid:grid_index|None=None,
+                 stage_table:str|None=None):
+        self.args=args
+        self.pool=pool
+        self.metrics=metrics
+        self.grid=grid
+        self.stage_table=stage_table
+        self.rollup=rollup_spec_from_args(args)
+        self.variables=variable_map_from_args(args)
+        self.db=get_db(args,pool,metrics)
+
+    def write_tile(self,methane_data_file_id:int,batches:list[methane_batch],tile_size:int)->int:
+        tables=None
+        if self.grid is None and self.stage_table is None and is_partitioned(self.db):
+            tables=month_tables(db=self.db,
+                                months=batch_months(batches),
+                                stage_run=self.args.get('stage_run',''))
+        return write_methane_tile(db=self.db,
+                                  methane_data_file_id=methane_data_file_id,
+                                  batches=batches,
+                                  tile_size=tile_size,
+                                  writer=self.args.get('writer','copy'),
+                                  copy_format=self.args.get('copy_format','text'),
+                                  tables=tables,
+                                  grid=self.grid,
+                                  rollup=self.rollup,
+                                  stage_table=self.stage_table,
+                                  variables=self.variables)
+
+    def for_writer(self)->Sink:
+        return PostgresSink(args=self.args,pool=self.pool,metrics=self.metrics,grid=self.grid,stage_table=self.stage_table)
+
+    def close(self)->None:
+        if self.db is not None:
+            self.db.close()
+        self.db=None
+
+
+
+class NullSink(Sink):
+    """
+    Counts rows and drops them, so a dry run times extraction alone
+    """
+    def __init__(self):
+        self.rows=0
+        self.lock=threading.Lock()
+
+    def write_tile(self,methane_data_file_id:int,batches:list[methane_batch],tile_size:int)->int:
+        rows=sum(len(batch) for batch in batches)
+        with self.lock:
+            self.rows+=rows
+        return rows
+
+
+
+class FileSink(Sink):
+    """
+    Buffered NDJSON or CSV staging file per granule, <directory>/<granule name>.<format>,
+    with the columns in FILE_SINK_COLUMNS and then one per extra -variables variable,
+    empty (CSV) or null (NDJSON) where it is masked
+    """
+    def __init__(self,file_name:str,directory:str='.',file_format:str='ndjson',variables:variable_map|None=None):
+        os.makedirs(directory,exist_ok=True)
+        self.file_name=file_name
+        self.file_format=file_format
+        self.extra_columns=variables.extra_columns() if variables else []
+        self.quoted_extra_columns=[json.dumps(column) for column,_ in self.extra_columns]
+        self.path=path.join(directory,path.splitext(path.basename(file_name))[0]+'.'+file_format)
+        self.out=open(self.path,'w',newline='',buffering=1<<20)
+        self.lock=threading.Lock()
+        self.quoted_file_name=json.dumps(file_name)
+        if file_format=='csv':
+            self.csv_writer=csv.writer(self.out)
+            self.csv_writer.writerow(FILE_SINK_COLUMNS+tuple(column for column,_ in self.extra_columns))
+
+    def write_tile(self,methane_data_file_id:int,batches:list[methane_batch],tile_size:int)->int:
+        rows=0
+        for batch in batches:
+            if len(batch)==0:
+                continue
+            stamps=np.datetime_as_string(batch.recorded_at,unit='us').tolist()
+            columns=zip(stamps,batch.latitude.tolist(),batch.longitude.tolist(),batch.methane.tolist())
+            extras=list(zip(*[batch.values[spec.path].tolist() for _,spec in self.extra_columns])) or [()]*len(batch)
+            with self.lock:
+                if self.file_format=='csv':
+                    self.csv_writer.writerows((self.file_name,)+row+extra for row,extra in zip(columns,extras))
+                else:
+                    self.out.writelines(f'{{"file_name":{self.quoted_file_name},"recorded_at":"{recorded_at}",'
+                                        f'"latitude":{latitude!r},"longitude":{longitude!r},"methane":{methane!r}'
+                                        +''.join(f',{column}:{"null" if value is None else repr(value)}'
+                                                 for column,value in zip(self.quoted_extra_columns,extra))
+                                        +'}\n'
+                                        for (recorded_at,latitude,longitude,methane),extra in zip(columns,extras))
+            rows+=len(batch)
+        return rows
+
+    def close(self)->None:
+        if not self.out.closed:
+            self.out.close()
+
+
+
+class PreviewSink(Sink):
+    """
+    Prints the first max_rows rows of the file, each extra -variables value after the
+    methane_data columns, and counts the rest
+    """
+    def __init__(self,file_name:str,max_rows:int=10,variables:variable_map|None=None):
+        self.file_name=file_name
+        self.max_rows=max_rows
+        self.extras=variables.extras if variables else []
+        self.rows=0
+        self.lock=threading.Lock()
+
+    def write_tile(self,methane_data_file_id:int,batches:list[methane_batch],tile_size:int)->int:
+        rows=0
+        for batch in batches:
+            with self.lock:
+                if self.rows<self.max_rows and len(batch):
+                    shown=batch.slice(0,self.max_rows-self.rows)
+                    extras=list(zip(*[shown.values[spec.path].tolist() for spec in self.extras])) or [()]*len(shown)
+                    for parms,extra in zip(shown.rows(methane_data_file_id),extras):
+                        print(parms+extra)
+                self.rows+=len(batch)
+            rows+=len(batch)
+        return rows
+
+    def close(self)->None:
+        if self.rows>self.max_rows:
+            print(f'... and {self.rows-self.max_rows} more rows from {self.file_name}')
+
+
+
+class ColumnarSink(Sink):
+    """
+    Parquet (with row-group statistics) or Arrow IPC files partitioned by day:
+    <directory>/date=YYYY-MM-DD/<granule name>.parquet|arrow.  Each tile becomes
+    one row group per day it covers, so readers can prune on recorded_at, latitude
+    and longitude without scanning postgres.  Extra -variables variables follow xch4,
+    one nullable column each.
+    """
+    def __init__(self,file_name:str,directory:str='.',file_format:str='parquet',variables:variable_map|None=None):
+        try:
+            import pyarrow
+            import pyarrow.ipc
+            import pyarrow.parquet
+        except ImportError:
+            raise ValueError(f'the {file_format} sink needs pyarrow: pip install pyarrow')
+        self.pa=pyarrow
+        self.file_name=file_name
+        self.file_format=file_format
+        self.directory=directory
+        self.stem=path.splitext(path.basename(file_name))[0]
+        self.extra_columns=variables.extra_columns() if variables else []
+        self.schema=pyarrow.schema([('methane_data_file_id',pyarrow.int32()),
+                                    ('file_name',pyarrow.dictionary(pyarrow.int32(),pyarrow.string())),
+                                    ('recorded_at',pyarrow.timestamp('us')),
+                                    ('latitude',pyarrow.float64()),
+                                    ('longitude',pyarrow.float64()),
+                                    ('xch4',pyarrow.float64())]+
+                                   [(column,pyarrow.from_numpy_dtype(np.dtype(spec.dtype or 'float64')))
+                                    for column,spec in self.extra_columns])
+        self.writers={}
+        self.lock=threading.Lock()
+
+    def writer_for(self,day:str):
+        if day not in self.writers:
+            partition=path.join(self.directory,f'date={day}')
+            os.makedirs(partition,exist_ok=True)
+            file_path=path.join(partition,f'{self.stem}.{self.file_format}')
+            if self.file_format=='parquet':
+                self.writers[day]=self.pa.parquet.ParquetWriter(file_path,self.schema,compression='zstd',write_statistics=True)
+            else:
+                self.writers[day]=self.pa.ipc.new_file(file_path,self.schema)
+        return self.writers[day]
+
+    def write_tile(self,methane_data_file_id:int,batches:list[methane_batch],tile_size:int)->int:
+        batches=[batch for batch in batches if len(batch)]
+        if len(batches)==0:
+            return 0
+        recorded_at=np.concatenate([batch.recorded_at for batch in batches])
+        latitude=np.concatenate([batch.latitude for batch in batches])
+        longitude=np.concatenate([batch.longitude for batch in batches])
+        xch4=np.concatenate([batch.methane for batch in batches])
+        extras=[np.ma.concatenate([batch.values[spec.path] for batch in batches]) for _,spec in self.extra_columns]
+        days=recorded_at.astype('datetime64[D]')
+        for day in np.unique(days):
+            on_day=days==day
+            rows=int(on_day.sum())
+            table=self.pa.Table.from_arrays([self.pa.array(np.full(rows,methane_data_file_id,dtype='int32')),
+                                             self.pa.DictionaryArray.from_arrays(self.pa.array(np.zeros(rows,dtype='int32')),
+                                                                                 self.pa.array([self.file_name])),
+                                             self.pa.array(recorded_at[on_day]),
+                                             self.pa.array(latitude[on_day]),
+                                             self.pa.array(longitude[on_day]),
+                                             self.pa.array(xch4[on_day])]+
+                                            [self.pa.array(np.ma.getdata(values)[on_day],mask=np.ma.getmaskarray(values)[on_day])
+                                             for values in extras],
+                                            schema=self.schema)
+            with self.lock:
+                self.writer_for(str(day)).write_table(table)
+        return len(recorded_at)
+
+    def close(self)->None:
+        with self.lock:
+            for writer in self.writers.values():
+                writer.close()
+            self.writers={}
+
+
+
+def open_sink(args:dict[str,str],
+              file_name:str,
+              pool:DbPool|None=None,
+              metrics:Metrics|None=None,
+              grid:grid_index|None=None,
+              stage_table:str|None=None)->Sink:
+    """
+    The sink named by args['sink'] for one file
+    :param grid: the file's registered grid, for -storage cell
+    :param stage_table: the file's -replace staging table
+    """
+    sink=args.get('sink') or 'postgres'
+    if sink=='postgres':
+        return PostgresSink(args=args,pool=pool,metrics=metrics,grid=grid,stage_table=stage_table)
+    if sink=='null':
+        return NullSink()
+    if sink in ('ndjson','csv'):
+        return FileSink(file_name=file_name,directory=args.get('sink_out') or '.',file_format=sink,
+                        variables=variable_map_from_args(args))
+    if sink in ('parquet','arrow'):
+        return ColumnarSink(file_name=file_name,directory=args.get('sink_out') or '.',file_format=sink,
+                            variables=variable_map_from_args(args))
+    if sink=='preview':
+        return PreviewSink(file_name=file_name,max_rows=int(args.get('preview_rows',10)),
+                           variables=variable_map_from_args(args))
+    raise ValueError(f'unknown sink {sink}, expected one of {", ".join(SINK_NAMES)}')
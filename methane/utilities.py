@@ -1,20 +1,106 @@
+import fnmatch
 import glob
+import io
 import json
+from contextlib import contextmanager
+from os import path
+from xml.etree import ElementTree
+from typing import TYPE_CHECKING
 
-import  netCDF4 as nc
+# netCDF4 is imported when a dataset is first opened, so finding files (and the csv
+# loader that shares get_files) doesn't pay for it
+if TYPE_CHECKING:
+    import  netCDF4 as nc
+
+# what a bare zip archive given to get_files stands for
+DEFAULT_ARCHIVE_MEMBERS = '*.csv'
 
 def walktree(top):
     yield top.groups.values()
     for value in top.groups.values():
         yield from walktree(value)
 
-def get_files(name:str)->list[str]:
-    file_names = glob.glob(name)
-    if len(file_names)==0:
+def split_archive_name(name:str)->tuple[str,str|None]:
+    """
+    (archive, member pattern) for a name inside a zip archive such as data/x.zip/*.csv,
+    otherwise (name, None).  A bare archive name stands for its csv members
+    """
+    lowered=name.lower()
+    if lowered.endswith('.zip'):
+        return name,DEFAULT_ARCHIVE_MEMBERS
+    at=lowered.find('.zip/')
+    if at<0:
+        return name,None
+    return name[:at+4],name[at+5:]
+
+
+def archive_members(archive:str,pattern:str)->list[str]:
+    import zipfile
+    try:
+        with zipfile.ZipFile(archive) as zipped:
+            return [f'{archive}/{member}' for member in zipped.namelist()
+                    if not member.endswith('/') and fnmatch.fnmatchcase(member,pattern)]
+    except (OSError,zipfile.BadZipFile) as e:
+        print(f"could not read archive {archive}, problem={e}")
+        return []
+
+
+def get_files(name:str,quiet:bool=False)->list[str]:
+    """
+    The files matching a glob.  Members of zip archives are named archive.zip/member,
+    and may be globbed too: data/*.zip/*.csv
+    """
+    archive,pattern=split_archive_name(name)
+    if pattern is None:
+        file_names = glob.glob(name)
+    else:
+        file_names = [member for archive_name in sorted(glob.glob(archive)) for member in archive_members(archive_name,pattern)]
+    if len(file_names)==0 and not quiet:
         print(f"no files found in {name}")
     return file_names
 
-def get_file_dataset(filename:str)->nc.Dataset|None:
+
+def source_exists(file_name:str)->bool:
+    """
+    Whether get_files' file_name, which may be a zip archive member, is there
+    """
+    archive,member=split_archive_name(file_name)
+    if member is None:
+        return path.exists(file_name)
+    import zipfile
+    try:
+        with zipfile.ZipFile(archive) as zipped:
+            return member in zipped.namelist()
+    except (OSError,zipfile.BadZipFile):
+        return False
+
+
+@contextmanager
+def open_text(file_name:str,newline:str|None=None):
+    """
+    Open a file from get_files for reading text, decompressing zip members, .gz and
+    .bz2 files as they are read, so nothing is extracted to disk
+    """
+    archive,member=split_archive_name(file_name)
+    lowered=file_name.lower()
+    if member is not None:
+        import zipfile
+        with zipfile.ZipFile(archive) as zipped, zipped.open(member) as raw:
+            yield io.TextIOWrapper(raw,encoding='utf-8',newline=newline)
+    elif lowered.endswith('.gz'):
+        import gzip
+        with gzip.open(file_name,'rt',encoding='utf-8',newline=newline) as file:
+            yield file
+    elif lowered.endswith('.bz2'):
+        import bz2
+        with bz2.open(file_name,'rt',encoding='utf-8',newline=newline) as file:
+            yield file
+    else:
+        with open(file_name,'r',newline=newline) as file:
+            yield file
+
+def get_file_dataset(filename:str)->'nc.Dataset|None':
+    import  netCDF4 as nc
     try:
         return nc.Dataset(filename)
     except Exception as e:
@@ -22,7 +108,7 @@ def get_file_dataset(filename:str)->nc.Dataset|None:
         return None
 
 
-def display_dataset_metadata(ds:nc.Dataset)->None:
+def display_dataset_metadata(ds:'nc.Dataset')->None:
     print(f'raw data set: \n{ds}')
     print('raw dict')
 
@@ -41,25 +127,115 @@ def display_dataset_metadata(ds:nc.Dataset)->None:
         print(var)
 
 
-def get_metadata_to_store(dict_to_store:dict[str,dict[str,str]],ds:nc.Dataset,group_name:str)->None:
+# groups whose variables' attributes are stored in methane_data_file.metadata; a
+# variable in a later group replaces one of the same name in an earlier group
+METADATA_GROUPS = ('apriori_data','geolocation')
+
+
+def get_metadata_to_store(dict_to_store:dict[str,dict[str,str]],ds:'nc.Dataset',group_name:str)->None:
+    dict_to_store.update(collect_group_metadata(ds,(group_name,)))
+
+
+def collect_group_metadata(ds:'nc.Dataset',group_names:tuple[str,...]=METADATA_GROUPS)->dict[str,dict[str,str]]:
+    """
+    The attributes of every variable in the named groups, from one walk of the group tree
+    :param ds:
+    :param group_names: in the order their variables are added
+    """
+    found:dict[str,list]={name:[] for name in group_names}
     for children in walktree(ds):
         for child in children:
-            if child.name==group_name:
-                for name,value in child.variables.items():
-                    tdict={}
-                    for attr in value.ncattrs():
-                        tdict[attr]=str(value.getncattr(attr))
-                    dict_to_store[name] = tdict
+            if child.name in found:
+                found[child.name].append(child)
+    metadata={}
+    for name in group_names:
+        for group in found[name]:
+            for variable_name,variable in group.variables.items():
+                # __dict__ reads all of a variable's attributes in one call
+                metadata[variable_name]={attr:str(value) for attr,value in variable.__dict__.items()}
+    return metadata
 
 
-def accumulate_get_metadata_to_store(ds:nc.Dataset)->dict[str,dict[str,str]]:
-    accumulator = {}
-    get_metadata_to_store(accumulator, ds, 'apriori_data')
-    get_metadata_to_store(accumulator, ds, 'geolocation')
-    return accumulator
+def accumulate_get_metadata_to_store(ds:'nc.Dataset')->dict[str,dict[str,str]]:
+    return collect_group_metadata(ds,METADATA_GROUPS)
 
 
-def storable_metadata_json(ds:nc.Dataset)->str:
+def storable_metadata_json(ds:'nc.Dataset')->str:
     data = accumulate_get_metadata_to_store(ds)
     return json.dumps(data)
 
+
+def _xml_name(tag:str,prefixes:dict[str,str])->str:
+    """
+    ElementTree's {uri}name as the prefix:name written in the document
+    """
+    if tag[0]!='{':
+        return tag
+    uri,name=tag[1:].split('}',1)
+    prefix=prefixes.get(uri)
+    return f'{prefix}:{name}' if prefix else name
+
+
+def parse_xml_file(file_name:str)->dict:
+    """
+    An xml sidecar as the dict xmltodict.parse gives: attributes as @name, text as
+    #text when the element also has attributes or children, repeated children as a
+    list and empty elements as None.  The text of mixed content is the element's own
+    text and its children's tails, joined then stripped.  The file is parsed
+    incrementally and each element is detached from its parent once converted, so only
+    the open elements are ever held in memory
+    """
+    prefixes:dict[str,str]={}
+    # namespaces declared on the element about to start, which xmltodict keeps as attributes
+    declared:dict[str,str]={}
+    # per open element: the element, its converted children and attributes, and the
+    # tails of the children detached so far
+    stack:list[tuple[ElementTree.Element,dict,list[str]]]=[]
+    root=None
+    for event,item in ElementTree.iterparse(file_name,events=('start-ns','start','end')):
+        if event=='start-ns':
+            prefix,uri=item
+            prefixes.setdefault(uri,prefix)
+            declared[f'@xmlns:{prefix}' if prefix else '@xmlns']=uri
+        elif event=='start':
+            if len(stack):
+                # the previous sibling's tail has been read by now
+                _detach_children(*stack[-1])
+            converted=declared
+            declared={}
+            converted.update((f'@{_xml_name(name,prefixes)}',value) for name,value in item.attrib.items())
+            stack.append((item,converted,[]))
+        else:
+            element,converted,tails=stack.pop()
+            _detach_children(element,converted,tails)
+            text=((item.text or '')+''.join(tails)).strip()
+            if text:
+                if len(converted):
+                    converted['#text']=text
+                else:
+                    converted=text
+            elif not len(converted):
+                converted=None
+            name=_xml_name(item.tag,prefixes)
+            item.clear()
+            if len(stack)==0:
+                root={name:converted}
+                break
+            parent=stack[-1][1]
+            if name not in parent:
+                parent[name]=converted
+            elif isinstance(parent[name],list):
+                parent[name].append(converted)
+            else:
+                parent[name]=[parent[name],converted]
+    return root
+
+
+def _detach_children(element:ElementTree.Element,converted:dict,tails:list[str])->None:
+    """
+    Take the tails of element's converted children and remove them from it
+    """
+    for child in list(element):
+        if child.tail:
+            tails.append(child.tail)
+        element.remove(child)
@@ -0,0 +1,134 @@
+"""
+The map from netCDF variables to the columns they are loaded into, read from
+variables.json or the file given with -variables:
+
+    {"variables": [
+        {"path": "xch4", "table": "methane_data", "column": "methane", "required": true},
+        {"path": "apriori_data/surface_pressure", "table": "methane_data_extra", "column": "surface_pressure"},
+        {"path": "qa_value", "table": "methane_data_extra", "column": "qa_value", "dtype": "int16"}
+    ]}
+
+Exactly one entry feeds methane_data.methane.  Every variable is a (lat, lon)
+variable read tile by tile with it; a cell is loaded when its time is valid and no
+required variable is masked there, and a masked optional value is loaded as NULL.
+Variables mapped to other tables are written, in the tile's transaction, to tables
+keyed like the methane rows: (methane_data_file_id, recorded_at, latitude, longitude),
+or (methane_data_file_id, cell_id, recorded_at) with -storage cell.  Those tables
+are created by the user, before the load.  The sinks other than postgres write
+each of them as one more column after methane.
+"""
+import json
+import re
+import threading
+from dataclasses import dataclass
+from os import path
+
+DEFAULT_VARIABLES_FILE = path.join(path.dirname(__file__), 'variables.json')
+METHANE_TABLE = 'methane_data'
+METHANE_COLUMN = 'methane'
+# key columns of the rows written to a mapped table other than methane_data
+VARIABLE_KEY_COLUMNS = ('methane_data_file_id','recorded_at','latitude','longitude')
+VARIABLE_CELL_KEY_COLUMNS = ('methane_data_file_id','cell_id','recorded_at')
+IDENTIFIER = re.compile(r'^[a-z_][a-z0-9_]*$')
+
+# variables file -> its map, for the files this process has already read
+_maps:dict[str,'variable_map'] = {}
+_lock = threading.Lock()
+
+
+
+@dataclass
+class variable_spec:
+    """
+    One netCDF variable (a path such as apriori_data/surface_pressure) and the column it goes to
+    """
+    path: str
+    table: str
+    column: str
+    required: bool = False
+    # numpy dtype the values are cast to, e.g. int16 for an INT column; float64 when empty
+    dtype: str = ''
+
+
+
+@dataclass
+class variable_map:
+    variables: list[variable_spec]
+
+    @property
+    def methane(self)->variable_spec:
+        return next(spec for spec in self.variables if spec.table == METHANE_TABLE and spec.column == METHANE_COLUMN)
+
+    @property
+    def extras(self)->list[variable_spec]:
+        """
+        Every variable other than the methane payload, required ones first
+        """
+        return sorted((spec for spec in self.variables if spec is not self.methane), key=lambda spec: not spec.required)
+
+    def tables(self)->dict[str,list[variable_spec]]:
+        """
+        Table -> its variables, for the tables other than methane_data
+        """
+        tables:dict[str,list[variable_spec]] = {}
+        for spec in self.extras:
+            tables.setdefault(spec.table, []).append(spec)
+        return tables
+
+    def extra_columns(self)->list[tuple[str,variable_spec]]:
+        """
+        (column name, spec) for every extra variable, as the sinks other than postgres
+        write them next to methane: the column, or table_column where two tables share it
+        """
+        columns = [spec.column for spec in self.extras]
+        return [(spec.column if columns.count(spec.column) == 1 else f'{spec.table}_{spec.column}', spec)
+                for spec in self.extras]
+
+
+
+def load_variable_map(file_name:str|None=None)->variable_map:
+    """
+    Read and check a variables file
+    :param file_name: None for the default map, which loads xch4 alone
+    """
+    file_name = file_name or DEFAULT_VARIABLES_FILE
+    with open(file_name) as variables_file:
+        entries = json.load(variables_file).get('variables', [])
+    variables = [variable_spec(path=entry['path'],
+                               table=entry['table'],
+                               column=entry['column'],
+                               required=bool(entry.get('required', False)),
+                               dtype=entry.get('dtype', '')) for entry in entries]
+    for spec in variables:
+        if not IDENTIFIER.match(spec.table) or not IDENTIFIER.match(spec.column):
+            raise ValueError(f'{file_name}: {spec.table}.{spec.column} is not a plain table and column name')
+        if spec.table == METHANE_TABLE and spec.column != METHANE_COLUMN:
+            raise ValueError(f'{file_name}: only methane can be mapped into {METHANE_TABLE}')
+        if spec.table != METHANE_TABLE and spec.column in VARIABLE_KEY_COLUMNS + VARIABLE_CELL_KEY_COLUMNS:
+            raise ValueError(f'{file_name}: {spec.column} is a key column of {spec.table}')
+    if sum(spec.table == METHANE_TABLE for spec in variables) != 1:
+        raise ValueError(f'{file_name}: exactly one variable must be mapped to {METHANE_TABLE}.{METHANE_COLUMN}')
+    columns = [(spec.table, spec.column) for spec in variables]
+    if len(set(columns)) != len(columns):
+        raise ValueError(f'{file_name}: a column is mapped more than once')
+    return variable_map(variables=variables)
+
+
+
+def variable_map_from_args(args:dict[str,str])->variable_map:
+    """
+    The -variables map, read once per process
+    """
+    file_name = args.get('variables') or DEFAULT_VARIABLES_FILE
+    with _lock:
+        if file_name not in _maps:
+            _maps[file_name] = load_variable_map(file_name)
+        return _maps[file_name]
+
+
+
+def staged_variable_table(stage_table:str, table:str)->str:
+    """
+    Where a -replace load stages the rows of a mapped table
+    """
+    return f'{stage_table}_{table}'
@@ -0,0 +1,210 @@
+import json
+import os
+import signal
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timezone
+from os import path
+from time import monotonic, time
+from methane.utilities import get_files
+from methane.runner import process,_init_worker
+from core.database import DbPool
+
+STATE_FILE_NAME = '.cdfreader-state.json'
+MAX_RETRY_SECONDS = 3600.0
+
+
+
+class WatchState:
+    """
+    The files a watch has dealt with, kept in a json file so a restarted watch
+    doesn't load them again: path -> signature, status (loaded or failed) and when.
+    A failed file is tried again after retry_seconds, doubling with each further
+    failure up to MAX_RETRY_SECONDS, and given up on after max_attempts (0 for never)
+    """
+    def __init__(self,file_name:str,retry_seconds:float=30.0,max_attempts:int=0):
+        self.file_name=file_name
+        self.retry_seconds=retry_seconds
+        self.max_attempts=max_attempts
+        self.files:dict[str,dict]={}
+        if path.exists(file_name):
+            try:
+                with open(file_name) as state_file:
+                    self.files=json.load(state_file)
+            except (OSError,ValueError) as e:
+                print(f'could not read watch state {file_name}, starting afresh: {e}')
+
+    def is_done(self,file_name:str,signature:list)->bool:
+        """
+        True when file_name was loaded in exactly this state
+        """
+        entry=self.files.get(file_name)
+        return entry is not None and entry['status']=='loaded' and entry['signature']==signature
+
+    def failure(self,file_name:str,signature:list)->dict|None:
+        """
+        The entry of a failed load of file_name in exactly this state, if there was one
+        """
+        entry=self.files.get(file_name)
+        if entry is None or entry['status']!='failed' or entry['signature']!=signature:
+            return None
+        return entry
+
+    def retry_due(self,file_name:str,signature:list,now:float)->bool:
+        """
+        True when a failed file's wait is over and it has attempts left
+        """
+        entry=self.failure(file_name,signature)
+        if entry is None:
+            return False
+        if self.max_attempts and entry.get('attempts',1)>=self.max_attempts:
+            return False
+        return now>=entry.get('retry_at',0)
+
+    def record(self,file_name:str,signature:list,error:str='')->None:
+        entry={'signature':signature,
+               'status':'failed' if error else 'loaded',
+               'error':error,
+               'at':datetime.now(timezone.utc).isoformat()}
+        if error:
+            previous=self.failure(file_name,signature)
+            entry['attempts']=1 if previous is None else previous.get('attempts',1)+1
+            entry['retry_at']=time()+min(self.retry_seconds*2**(entry['attempts']-1),MAX_RETRY_SECONDS)
+        self.files[file_name]=entry
+
+    def save(self)->None:
+        """
+        Write the state through a temporary file, so a crash never leaves it half written
+        """
+        temporary=self.file_name+'.tmp'
+        with open(temporary,'w') as state_file:
+            json.dump(self.files,state_file)
+        os.replace(temporary,self.file_name)
+
+
+
+def file_signature(file_name:str)->list|None:
+    """
+    Size and modification time of the granule and of its xml sidecar, if any.  None
+    when the granule has gone
+    """
+    try:
+        granule=os.stat(file_name)
+    except OSError:
+        return None
+    signature=[granule.st_size,granule.st_mtime_ns]
+    try:
+        sidecar=os.stat(path.splitext(file_name)[0]+'.xml')
+        signature+=[sidecar.st_size,sidecar.st_mtime_ns]
+    except OSError:
+        pass
+    return signature
+
+
+
+class DirectoryWatch:
+    """
+    Notices new granules in a directory.  A granule is ready once neither it nor its
+    xml sidecar has changed for settle_seconds, and the sidecar exists or
+    xml_wait_seconds have gone by without one turning up.  A granule that failed to
+    load is ready again, unchanged, when the state says its retry is due.
+    """
+    def __init__(self,
+                 directory:str,
+                 state:WatchState,
+                 settle_seconds:float=5.0,
+                 xml_wait_seconds:float=30.0):
+        self.pattern=path.join(directory,'*.nc')
+        self.state=state
+        self.settle_seconds=settle_seconds
+        self.xml_wait_seconds=xml_wait_seconds
+        # file name -> (signature, when it was last seen to change, when it was first seen)
+        self.pending:dict[str,tuple[list,float,float]]={}
+
+    def ready_files(self)->list[tuple[str,list]]:
+        now=monotonic()
+        ready=[]
+        seen=set()
+        for file_name in sorted(get_files(self.pattern,quiet=True)):
+            signature=file_signature(file_name)
+            if signature is None or self.state.is_done(file_name,signature):
+                continue
+            if self.state.failure(file_name,signature) is not None:
+                # it settled before it failed
+                if self.state.retry_due(file_name,signature,time()):
+                    ready.append((file_name,signature))
+                continue
+            seen.add(file_name)
+            previous=self.pending.get(file_name)
+            if previous is None or previous[0]!=signature:
+                first_seen=now if previous is None else previous[2]
+                self.pending[file_name]=(signature,now,first_seen)
+                continue
+            _,changed_at,first_seen=previous
+            has_xml=len(signature)>2
+            if now-changed_at>=self.settle_seconds and (has_xml or now-first_seen>=self.xml_wait_seconds):
+                ready.append((file_name,signature))
+        # forget files that went away before they were picked up
+        self.pending={file_name:entry for file_name,entry in self.pending.items() if file_name in seen}
+        for file_name,_ in ready:
+            self.pending.pop(file_name,None)
+        return ready
+
+
+
+def watch(directory:str,
+          args:dict[str,str],
+          nodb:bool=False,
+          verbose:bool=False,
+          pool:DbPool|None=None,
+          stop:threading.Event|None=None)->None:
+    """
+    Load granules as they arrive in directory, until stop is set.  The run's pool and,
+    with -workers, one process pool stay open between files, so each granule is
+    loaded as soon as it has settled
+    :param directory:
+    :param args: -poll_seconds, -settle_seconds, -xml_wait_seconds, -retry_seconds,
+                 -max_attempts and -watch_state
+    :param nodb:
+    :param verbose:
+    :param pool: the run's connection pool, kept for the whole watch
+    :param stop: set to end the watch after the current files
+    """
+    stop=threading.Event() if stop is None else stop
+    if threading.current_thread() is threading.main_thread():
+        # a service manager's stop lets the files in hand finish
+        signal.signal(signal.SIGTERM,lambda signum,frame:stop.set())
+    state=WatchState(args.get('watch_state') or path.join(directory,STATE_FILE_NAME),
+                     retry_seconds=float(args.get('retry_seconds',30)),
+                     max_attempts=int(args.get('max_attempts',0) or 0))
+    watcher=DirectoryWatch(directory=directory,
+                           state=state,
+                           settle_seconds=float(args.get('settle_seconds',5)),
+                           xml_wait_seconds=float(args.get('xml_wait_seconds',30)))
+    poll_seconds=float(args.get('poll_seconds',2))
+    workers=int(args.get('workers',0) or 0)
+    executor=None
+    if workers>1:
+        executor=ProcessPoolExecutor(max_workers=workers,initializer=_init_worker,initargs=(args,nodb,))
+    print(f'watching {directory} for new granules, {len(state.files)} already handled')
+    try:
+        while not stop.is_set():
+            ready=watcher.ready_files()
+            if len(ready):
+                signatures=dict(ready)
+                results=process(file_names=[file_name for file_name,_ in ready],
+                                args=args,
+                                nodb=nodb,
+                                verbose=verbose,
+                                pool=pool,
+                                executor=executor)
+                for result in results:
+                    state.record(result.file_name,signatures.pop(result.file_name),result.error)
+                # what process skipped was already in the database
+                for file_name,signature in signatures.items():
+                    state.record(file_name,signature)
+                state.save()
+            stop.wait(poll_seconds)
+    finally:
+        if executor is not None:
+            executor.shutdown()
@@ -0,0 +1,68 @@
+from collections import namedtuple
+import pytest
+import methane.by_year as by_year
+
+country_row = namedtuple('country_row', 'methane_data_by_country_id country_name')
+
+
+class RecordingDb:
+    """
+    Stands in for the run's Db: countries get ids in the order they are first upserted
+    """
+    def __init__(self):
+        self.countries = {}
+        self.years = []
+        self.committed = False
+        self.rolled_back = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def insert_values(self, insert_str, rows, page_size=1000, fetch=False):
+        if 'methane_data_by_country_by_year' in insert_str:
+            self.years.extend(rows)
+            return None
+        for (entity,) in rows:
+            self.countries.setdefault(entity, 100 + len(self.countries))
+        return [country_row(self.countries[entity], entity) for (entity,) in rows]
+
+    def commit(self):
+        self.committed = True
+
+    def rollback(self):
+        self.rolled_back = True
+
+
+@pytest.fixture
+def db(monkeypatch):
+    db = RecordingDb()
+    monkeypatch.setattr(by_year, 'get_db', lambda args, pool=None, metrics=None: db)
+    return db
+
+
+def test_batched_parser(tmp_path, db):
+    csv_file = tmp_path / 'by_year.csv'
+    csv_file.write_text('Entity,Code,Year,Annual methane emissions in CO₂ equivalents\n'
+                        'Afghanistan,AFG,1850,3594926.2\n'
+                        '\n'
+                        '"Bonaire, Sint Eustatius and Saba",BES,1990,12.5\n'
+                        'World,,1850,1e9\n', encoding='utf-8')
+    cache = {'World': 7}
+    assert by_year.methane_by_year_batched(str(csv_file), args={}, country_cache=cache) == 3
+    assert db.committed
+    assert sorted(db.countries) == ['Afghanistan', 'Bonaire, Sint Eustatius and Saba']
+    assert db.years == [(db.countries['Afghanistan'], 1850, 3594926.2),
+                        (db.countries['Bonaire, Sint Eustatius and Saba'], 1990, 12.5),
+                        (7, 1850, 1e9)]
+    assert cache == {'World': 7, **db.countries}
+
+
+def test_batched_parser_names_the_bad_line(tmp_path, db):
+    csv_file = tmp_path / 'by_year.csv'
+    csv_file.write_text('Entity,Code,Year,Quantity\nAfghanistan,AFG,1850,1.0\nAlbania,ALB,,2.0\n', encoding='utf-8')
+    with pytest.raises(ValueError, match='line 3'):
+        by_year.methane_by_year_batched(str(csv_file), args={})
+    assert db.years == [] and not db.committed
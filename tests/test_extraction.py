@@ -0,0 +1,135 @@
+import struct
+from datetime import datetime, timedelta
+import numpy as np
+import netCDF4 as nc
+from methane.extraction import methane_batch, iter_methane_batches, METHANE_DATA_COLUMNS, METHANE_CELL_DATA_COLUMNS
+
+PG_EPOCH = datetime(2000, 1, 1)
+
+
+def sample_batch()->methane_batch:
+    return methane_batch(recorded_at=np.array(['1999-12-31T23:59:59.5', '2024-01-01T00:00:00', '2024-06-30T12:34:56.789012'],
+                                              dtype='datetime64[us]'),
+                         latitude=np.array([-89.5, 0.0, 45.25]),
+                         longitude=np.array([-179.5, 12.125, 179.5]),
+                         methane=np.array([1850.5, 1900.0, 1923.4567]))
+
+
+def read_pgcopy(buffer:bytes, formats:list[str])->list[tuple]:
+    """
+    Parse a binary COPY buffer independently of the dtypes that wrote it: header, then
+    per row a field count and a length before each field, then the trailer
+    """
+    assert buffer[:11] == b'PGCOPY\n\xff\r\n\x00'
+    flags, extension = struct.unpack_from('>ii', buffer, 11)
+    assert (flags, extension) == (0, 0)
+    offset = 19
+    rows = []
+    while True:
+        (fields,) = struct.unpack_from('>h', buffer, offset)
+        offset += 2
+        if fields == -1:
+            break
+        assert fields == len(formats)
+        row = []
+        for fmt in formats:
+            (length,) = struct.unpack_from('>i', buffer, offset)
+            offset += 4
+            assert length == struct.calcsize('>' + fmt)
+            (value,) = struct.unpack_from('>' + fmt, buffer, offset)
+            offset += length
+            row.append(value)
+        rows.append(tuple(row))
+    assert offset == len(buffer)
+    return rows
+
+
+def read_copy_text(buffer:str)->list[list[str]]:
+    return [line.split('\t') for line in buffer.splitlines()]
+
+
+def test_copy_binary_matches_copy_text():
+    batch = sample_batch()
+    binary = read_pgcopy(batch.copy_binary(7).getvalue(), ['i', 'q', 'd', 'd', 'd'])
+    text = read_copy_text(batch.copy_text(7).getvalue())
+    assert len(binary) == len(text) == len(batch)
+    for (file_id, micros, latitude, longitude, methane), line in zip(binary, text):
+        assert len(line) == len(METHANE_DATA_COLUMNS)
+        assert file_id == int(line[0])
+        assert PG_EPOCH + timedelta(microseconds=micros) == datetime.fromisoformat(line[1])
+        assert (latitude, longitude, methane) == (float(line[2]), float(line[3]), float(line[4]))
+
+
+def test_cell_copy_binary_matches_cell_copy_text():
+    batch = sample_batch()
+    cell_ids = np.array([3, 70000, 2**31 - 1])
+    binary = read_pgcopy(batch.cell_copy_binary(7, cell_ids).getvalue(), ['i', 'i', 'q', 'f'])
+    text = read_copy_text(batch.cell_copy_text(7, cell_ids).getvalue())
+    assert len(binary) == len(text) == len(batch)
+    for (file_id, cell_id, micros, methane), line in zip(binary, text):
+        assert len(line) == len(METHANE_CELL_DATA_COLUMNS)
+        assert (file_id, cell_id) == (int(line[0]), int(line[1]))
+        assert PG_EPOCH + timedelta(microseconds=micros) == datetime.fromisoformat(line[2])
+        # methane_cell_data.methane is a REAL
+        assert methane == np.float32(float(line[3]))
+
+
+def test_copy_binary_of_an_empty_batch():
+    assert read_pgcopy(methane_batch().copy_binary(7).getvalue(), ['i', 'q', 'd', 'd', 'd']) == []
+
+
+def write_granule(path, times:np.ndarray, xch4:np.ndarray, chunks:tuple[int,int]=(2, 3)):
+    num_lats, num_lons = times.shape
+    ds = nc.Dataset(path, 'w')
+    ds.createDimension('lat', num_lats)
+    ds.createDimension('lon', num_lons)
+    ds.createVariable('lat', 'f4', ('lat',))[:] = np.linspace(-10, 10, num_lats)
+    ds.createVariable('lon', 'f4', ('lon',))[:] = np.linspace(100, 130, num_lons)
+    ds.createVariable('time', 'f8', ('lat', 'lon'), fill_value=-9999.0, chunksizes=chunks)[:] = times
+    ds.createVariable('xch4', 'f4', ('lat', 'lon'), fill_value=-1.0, chunksizes=chunks)[:] = xch4
+    ds.close()
+
+
+def per_cell_rows(ds:nc.Dataset)->list[tuple]:
+    """
+    What the per-cell num2date loop loaded: cells whose time, cut to the minute, is after
+    the epoch, skipping masked times and fill xch4, over the whole grid
+    """
+    unix_epoch_start = datetime(1970, 1, 1)
+    rows = []
+    for lat in range(ds.dimensions['lat'].size):
+        for lon in range(ds.dimensions['lon'].size):
+            time, xch4 = ds['time'][lat, lon], ds['xch4'][lat, lon]
+            if np.ma.is_masked(time) or np.ma.is_masked(xch4):
+                continue
+            timeofrecord = nc.num2date(time.item(), units='seconds since 1970-1-1 0:0:0.0', calendar='gregorian',
+                                       only_use_cftime_datetimes=False)
+            if timeofrecord.replace(second=0, microsecond=0) > unix_epoch_start:
+                rows.append((timeofrecord, float(ds['lat'][lat]), float(ds['lon'][lon]), float(xch4)))
+    return rows
+
+
+def test_extraction_matches_the_per_cell_loop(tmp_path):
+    times = 1.7e9 + np.arange(5 * 7).reshape(5, 7) * 3600.5
+    # placeholders in the first minute of 1970, the first minute after it, before the epoch, fill
+    times[0, 0], times[0, 1], times[0, 2], times[1, 1], times[4, 6] = 0.0, 59.0, 60.0, -3600.0, -9999.0
+    xch4 = 1800 + np.arange(5 * 7, dtype='f4').reshape(5, 7)
+    xch4[2, 3], xch4[4, 0] = -1.0, -1.0
+    write_granule(tmp_path / 'granule.nc', times, xch4)
+    with nc.Dataset(tmp_path / 'granule.nc') as ds:
+        expected = per_cell_rows(ds)
+        batches = list(iter_methane_batches(ds, batch_size=4, tile_size=2))
+    assert all(len(batch) <= 4 for batch in batches)
+    got = [row[1:] for batch in batches for row in batch.rows(7)]
+    assert sorted(got) == sorted(expected)
+    assert len(got) == 5 * 7 - 6
+
+
+def test_extraction_of_an_empty_window(tmp_path):
+    times = np.full((3, 4), 30.0)
+    write_granule(tmp_path / 'granule.nc', times, np.full((3, 4), 1800, dtype='f4'))
+    with nc.Dataset(tmp_path / 'granule.nc') as ds:
+        batches = list(iter_methane_batches(ds, tile_size=2))
+    # every tile read still yields one batch, closing it
+    assert [len(batch) for batch in batches] == [0] * len(batches)
+    assert all(batch.last_in_tile for batch in batches)
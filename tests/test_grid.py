@@ -0,0 +1,21 @@
+import numpy as np
+from methane.grid import grid_index
+
+
+def test_cell_ids_are_row_major_from_the_base():
+    lats = np.linspace(-10, 10, 5)
+    lons = np.linspace(100, 130, 7)
+    grid = grid_index(grid_id=1, base_cell_id=1000, lats=lats, lons=lons)
+    lat_index, lon_index = np.meshgrid(np.arange(5), np.arange(7), indexing='ij')
+    cell_ids = grid.cell_ids(lats[lat_index.ravel()], lons[lon_index.ravel()])
+    assert cell_ids.dtype == np.int32
+    assert cell_ids.tolist() == (1000 + lat_index * 7 + lon_index).ravel().tolist()
+
+
+def test_cell_ids_of_descending_and_unordered_coordinates():
+    lats = np.array([10.0, 5.0, 0.0, -5.0])
+    lons = np.array([120.0, 100.0, 130.0, 110.0])
+    grid = grid_index(grid_id=1, base_cell_id=1, lats=lats, lons=lons)
+    for i in range(len(lats)):
+        for j in range(len(lons)):
+            assert grid.cell_ids(np.array([lats[i]]), np.array([lons[j]])).tolist() == [1 + i * len(lons) + j]
@@ -0,0 +1,51 @@
+from collections import namedtuple
+from core.query import MethaneQuery, tile_rectangles, RAW_COLUMNS
+
+
+def covered(rectangles)->list[tuple[int,int]]:
+    return sorted((lat_tile, lon_tile) for lat_tiles, lon_tiles in rectangles
+                  for lat_tile in lat_tiles for lon_tile in lon_tiles)
+
+
+def test_tile_rectangles_cover_only_the_missing_tiles():
+    block = [(lat_tile, lon_tile) for lat_tile in range(2, 5) for lon_tile in range(-3, 1)]
+    assert tile_rectangles(block) == [(range(2, 5), range(-3, 1))]
+    # a cached tile in the middle of the block is left out
+    holed = [tile for tile in block if tile != (3, -1)]
+    assert covered(tile_rectangles(holed)) == sorted(holed)
+    scattered = [(0, 0), (0, 9), (7, 3), (8, 3), (9, 3), (12, 3), (12, 4)]
+    rectangles = tile_rectangles(scattered)
+    assert covered(rectangles) == sorted(scattered)
+    assert sorted(rectangles, key=lambda rectangle: (rectangle[0].start, rectangle[1].start)) == \
+        [(range(0, 1), range(0, 1)), (range(0, 1), range(9, 10)), (range(7, 10), range(3, 4)), (range(12, 13), range(3, 5))]
+    assert tile_rectangles([]) == []
+
+
+class UnionDb:
+    """
+    Answers the union query with the rows given per part, tagged with the part
+    """
+    def __init__(self, rows_by_part:dict[int,list[tuple]]):
+        self.rows_by_part = rows_by_part
+        self.queries = []
+
+    def query(self, query_str, parms=None):
+        self.queries.append((query_str, parms))
+        row = namedtuple('row', RAW_COLUMNS + ('part',))
+        return [row(*values, part) for part, rows in self.rows_by_part.items() for values in rows]
+
+
+def test_fetch_tiles_reads_and_splits_each_rectangle():
+    query = MethaneQuery(args={}, tile_degrees=10.0)
+    # the two tiles either side of a cached (0, 1)
+    missing = [(0, 0), (0, 2)]
+    db = UnionDb({0: [('2024-01-01T00:00:00', 5.0, 5.0, 1800.0)],
+                  1: [('2024-01-01T00:00:00', 5.0, 25.0, 1900.0), ('2024-01-02T00:00:00', 9.9, 29.9, 1901.0)]})
+    tiles = query.fetch_tiles(db, missing, None, None, 0, 'day', ('methane_data',))
+    (query_str, parms), = db.queries
+    assert query_str.count(' UNION ALL ') == 1
+    assert parms[:4] == [0.0, 0.0, 10.0, 10.0] and parms[8:12] == [20.0, 0.0, 30.0, 10.0]
+    assert sorted(tiles) == missing
+    assert tiles[(0, 0)]['methane'].tolist() == [1800.0]
+    assert tiles[(0, 2)]['methane'].tolist() == [1900.0, 1901.0]
+    assert query.cache.get(('methane_data', None, None, 0, 2)) is tiles[(0, 2)]
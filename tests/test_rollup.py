@@ -0,0 +1,53 @@
+import math
+from datetime import datetime
+import numpy as np
+from methane.extraction import methane_batch
+from methane.rollup import rollup_spec, bin_batches
+
+
+def per_cell_bins(batches:list[methane_batch], spec:rollup_spec)->dict[tuple,list[float]]:
+    bins = {}
+    for batch in batches:
+        for recorded_at, latitude, longitude, methane in zip(batch.recorded_at.tolist(), batch.latitude.tolist(),
+                                                             batch.longitude.tolist(), batch.methane.tolist()):
+            if spec.time_bucket == 'hour':
+                bucket = recorded_at.replace(minute=0, second=0, microsecond=0)
+            elif spec.time_bucket == 'day':
+                bucket = datetime(recorded_at.year, recorded_at.month, recorded_at.day)
+            else:
+                bucket = datetime(recorded_at.year, recorded_at.month, 1)
+            key = (bucket, math.floor((latitude + 90) / spec.resolution), math.floor((longitude + 180) / spec.resolution))
+            bins.setdefault(key, []).append(methane)
+    return bins
+
+
+def test_bin_batches_matches_per_cell_binning():
+    rng = np.random.default_rng(4)
+    batches = [methane_batch(recorded_at=np.datetime64('2024-01-30T00:00:00', 'us')
+                                         + (rng.random(n) * 4 * 86400e6).astype('timedelta64[us]'),
+                             latitude=rng.uniform(-90, 89.99, n),
+                             longitude=rng.uniform(-180, 179.99, n),
+                             methane=rng.uniform(1700, 2000, n)) for n in (300, 0, 200)]
+    # cells on bin edges
+    batches.append(methane_batch(recorded_at=np.array(['2024-02-01T00:00:00'] * 3, dtype='datetime64[us]'),
+                                 latitude=np.array([-90.0, 0.0, 45.0]),
+                                 longitude=np.array([-180.0, 0.0, 179.5]),
+                                 methane=np.array([1800.0, 1801.0, 1802.0])))
+    for spec in (rollup_spec(resolution=10.0, time_bucket='day'),
+                 rollup_spec(resolution=0.25, time_bucket='hour'),
+                 rollup_spec(resolution=45.0, time_bucket='month')):
+        bins = bin_batches(batches, spec)
+        expected = per_cell_bins(batches, spec)
+        assert len(bins) == len(expected)
+        keys = list(zip(bins.bucket_start.tolist(), bins.lat_bin.tolist(), bins.lon_bin.tolist()))
+        assert keys == sorted(keys)
+        for key, count, total, minimum, maximum in zip(keys, bins.count.tolist(), bins.total.tolist(),
+                                                       bins.minimum.tolist(), bins.maximum.tolist()):
+            cells = expected[key]
+            assert count == len(cells)
+            assert math.isclose(total, sum(cells))
+            assert (minimum, maximum) == (min(cells), max(cells))
+
+
+def test_bin_batches_of_nothing():
+    assert len(bin_batches([methane_batch()], rollup_spec())) == 0
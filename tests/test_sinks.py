@@ -0,0 +1,52 @@
+import csv
+import json
+import numpy as np
+import pytest
+from methane.extraction import methane_batch
+from methane.sinks import FileSink, Sink, FILE_SINK_COLUMNS
+from methane.variables import variable_map, variable_spec
+
+VARIABLES = variable_map(variables=[variable_spec(path='xch4', table='methane_data', column='methane', required=True),
+                                    variable_spec(path='surface_pressure', table='methane_data_extra', column='surface_pressure'),
+                                    variable_spec(path='qa', table='methane_data_extra', column='qa_value', dtype='int16')])
+
+
+def batch_with_extras()->methane_batch:
+    return methane_batch(recorded_at=np.array(['2024-01-01T00:00:00', '2024-01-01T00:00:01'], dtype='datetime64[us]'),
+                         latitude=np.array([1.5, 2.5]),
+                         longitude=np.array([10.0, 11.0]),
+                         methane=np.array([1800.0, 1801.0]),
+                         values={'surface_pressure': np.ma.array([1013.25, 0.0], mask=[False, True]),
+                                 'qa': np.ma.array(np.array([7, 8], dtype='int16'))})
+
+
+def test_file_sinks_write_the_extra_variables(tmp_path):
+    for file_format in ('ndjson', 'csv'):
+        sink = FileSink(file_name='granule.nc', directory=str(tmp_path), file_format=file_format, variables=VARIABLES)
+        assert sink.write_tile(1, [methane_batch(), batch_with_extras()], tile_size=2) == 2
+        sink.close()
+        with open(tmp_path / f'granule.{file_format}', newline='') as written:
+            if file_format == 'ndjson':
+                rows = [json.loads(line) for line in written]
+                assert [(row['surface_pressure'], row['qa_value']) for row in rows] == [(1013.25, 7), (None, 8)]
+            else:
+                rows = list(csv.reader(written))
+                assert rows[0] == list(FILE_SINK_COLUMNS) + ['surface_pressure', 'qa_value']
+                assert [row[5:] for row in rows[1:]] == [['1013.25', '7'], ['', '8']]
+
+
+def test_file_sink_without_extras(tmp_path):
+    sink = FileSink(file_name='granule.nc', directory=str(tmp_path), file_format='csv')
+    sink.write_tile(1, [batch_with_extras()], tile_size=2)
+    sink.close()
+    with open(tmp_path / 'granule.csv', newline='') as written:
+        rows = list(csv.reader(written))
+    assert rows[0] == list(FILE_SINK_COLUMNS) and len(rows[1]) == len(FILE_SINK_COLUMNS)
+
+
+def test_a_sink_without_write_tile_cannot_be_opened():
+    class Incomplete(Sink):
+        pass
+
+    with pytest.raises(TypeError):
+        Incomplete()
@@ -0,0 +1,30 @@
+from methane.utilities import parse_xml_file
+
+
+def parse(tmp_path, xml:str)->dict:
+    xml_file = tmp_path / 'sidecar.xml'
+    xml_file.write_text(xml)
+    return parse_xml_file(str(xml_file))
+
+
+def test_mixed_content_keeps_tail_text(tmp_path):
+    # what xmltodict.parse gives for the same documents
+    assert parse(tmp_path, '<mixed>before<b>bold</b>after</mixed>') == {'mixed': {'b': 'bold', '#text': 'beforeafter'}}
+    assert parse(tmp_path, '<m k="1">x<b>y</b> z <b>w</b>t</m>') == {'m': {'@k': '1', 'b': ['y', 'w'], '#text': 'x z t'}}
+    assert parse(tmp_path, '<m>a<b/>b<b/>c</m>') == {'m': {'b': [None, None], '#text': 'abc'}}
+
+
+def test_xmltodict_shape(tmp_path):
+    xml = ('<?xml version="1.0"?>\n'
+           '<a:root xmlns:a="http://a" v="1">\n'
+           '  <item id="1">one</item>\n'
+           '  <item id="2"/>\n'
+           '  <item>three</item>\n'
+           '  <empty/>\n'
+           '  <nested><deep>z</deep></nested>\n'
+           '</a:root>\n')
+    assert parse(tmp_path, xml) == {'a:root': {'@xmlns:a': 'http://a',
+                                               '@v': '1',
+                                               'item': [{'@id': '1', '#text': 'one'}, {'@id': '2'}, 'three'],
+                                               'empty': None,
+                                               'nested': {'deep': 'z'}}}
@@ -0,0 +1,45 @@
+import json
+import threading
+import methane.watch as watch_module
+from methane.runner import file_result
+from methane.watch import WatchState, watch
+
+
+def test_failed_granule_is_retried_on_next_poll(tmp_path, monkeypatch):
+    granule = tmp_path / 'granule.nc'
+    granule.write_bytes(b'not really netcdf')
+    stop = threading.Event()
+    calls = []
+
+    def fake_process(file_names, args, nodb, verbose, pool, executor):
+        calls.append(list(file_names))
+        if len(calls) >= 2:
+            stop.set()
+            return [file_result(file_name=file_name) for file_name in file_names]
+        return [file_result(file_name=file_name, error='database is down') for file_name in file_names]
+
+    monkeypatch.setattr(watch_module, 'process', fake_process)
+    watch(directory=str(tmp_path),
+          args={'poll_seconds': 0.01, 'settle_seconds': 0, 'xml_wait_seconds': 0, 'retry_seconds': 0},
+          nodb=True,
+          stop=stop)
+    assert calls == [[str(granule)], [str(granule)]]
+    with open(tmp_path / watch_module.STATE_FILE_NAME) as state_file:
+        assert json.load(state_file)[str(granule)]['status'] == 'loaded'
+
+
+def test_failure_is_not_done_and_backs_off(tmp_path):
+    state = WatchState(str(tmp_path / 'state.json'), retry_seconds=10, max_attempts=2)
+    signature = [1, 2]
+    state.record('a.nc', signature, error='boom')
+    assert not state.is_done('a.nc', signature)
+    assert not state.retry_due('a.nc', signature, now=state.files['a.nc']['retry_at'] - 1)
+    assert state.retry_due('a.nc', signature, now=state.files['a.nc']['retry_at'])
+    state.record('a.nc', signature, error='boom')
+    # the second failure used up the attempts
+    assert state.files['a.nc']['attempts'] == 2
+    assert not state.retry_due('a.nc', signature, now=state.files['a.nc']['retry_at'])
+    # a changed granule starts over
+    assert state.failure('a.nc', [1, 3]) is None
+    state.record('a.nc', signature)
+    assert state.is_done('a.nc', signature)